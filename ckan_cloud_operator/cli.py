@@ -30,6 +30,8 @@ from ckan_cloud_operator.drivers.rancher import cli as driver_rancher_cli
 from ckan_cloud_operator.drivers.jenkins import cli as driver_jenkins_cli
 from ckan_cloud_operator.drivers.helm import cli as driver_helm_cli
 from ckan_cloud_operator.providers.apps import cli as apps_cli
+from ckan_cloud_operator.monitoring.access_logs import cli as access_logs_cli
+from ckan_cloud_operator.monitoring import cli as monitoring_cli
 
 
 CLICK_CLI_MAX_CONTENT_WIDTH = 200
@@ -59,6 +61,8 @@ main.add_command(ckan_cli.ckan)
 main.add_command(storage_cli.storage)
 main.add_command(solr_cli.solr)
 main.add_command(apps_cli.apps)
+main.add_command(access_logs_cli.logs_group, 'logs')
+main.add_command(monitoring_cli.monitoring_group, 'monitoring')
 
 
 @main.group()
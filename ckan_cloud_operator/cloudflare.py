@@ -10,9 +10,58 @@ def get_zone_id(auth_email, auth_key, zone_name):
     return zones[0] if len(zones) > 0 else None
 
 
-def get_zone_rate_limits(auth_email, auth_key, zone_name):
-    zone_id = get_zone_id(auth_email, auth_key, zone_name)
-    return curl(auth_email, auth_key, f'zones/{zone_id}/rate_limits?page=1&per_page=1000')
+# maximal page size of the rate limits list
+RATE_LIMITS_PER_PAGE = 1000
+
+
+def get_zone_rate_limits(auth_email, auth_key, zone_name, zone_id=None):
+    """Returns the rate limits of all the pages, in the same format as a single page response"""
+    if not zone_id:
+        zone_id = get_zone_id(auth_email, auth_key, zone_name)
+    rate_limits = []
+    page = total_pages = 1
+    while page <= total_pages:
+        data = curl(auth_email, auth_key, f'zones/{zone_id}/rate_limits?page={page}&per_page={RATE_LIMITS_PER_PAGE}')
+        assert data.get('success'), f'Failed to get rate limits of zone {zone_name}: {data.get("errors")}'
+        rate_limits += data['result']
+        total_pages = data.get('result_info', {}).get('total_pages') or 1
+        page += 1
+    return {'success': True, 'result': rate_limits, 'result_info': {'count': len(rate_limits)}}
+
+
+def apply_rate_limits_diff(auth_email, auth_key, zone_id, diff):
+    """Applies a diff of create / update / delete rate limit rules, update and delete rules include the rule id
+
+    rules are deleted first, to free the zone quota for the created rules
+    """
+    for rule in diff['delete']:
+        rule_id = rule['id']
+        data = curl(auth_email, auth_key, f'zones/{zone_id}/rate_limits/{rule_id}', method='DELETE')
+        assert data.get('success'), f'Failed to delete rate limit {rule["description"]}: {data.get("errors")}'
+    for rule in diff['update']:
+        rule_id = rule['id']
+        data = curl(auth_email, auth_key, f'zones/{zone_id}/rate_limits/{rule_id}', rule, 'PUT')
+        assert data.get('success'), f'Failed to update rate limit {rule["description"]}: {data.get("errors")}'
+    for rule in diff['create']:
+        data = curl(auth_email, auth_key, f'zones/{zone_id}/rate_limits', rule, 'POST')
+        assert data.get('success'), f'Failed to create rate limit {rule["description"]}: {data.get("errors")}'
+
+
+# page size of the dns records list
+DNS_RECORDS_PER_PAGE = 100
+
+
+def get_zone_dns_records(auth_email, auth_key, zone_id):
+    """Returns the dns records of all the pages"""
+    records = []
+    page = total_pages = 1
+    while page <= total_pages:
+        data = curl(auth_email, auth_key, f'zones/{zone_id}/dns_records?page={page}&per_page={DNS_RECORDS_PER_PAGE}')
+        assert data.get('success'), f'Failed to get dns records of zone {zone_id}: {data.get("errors")}'
+        records += data['result']
+        total_pages = data.get('result_info', {}).get('total_pages') or 1
+        page += 1
+    return records
 
 
 def get_record_id(auth_email, auth_key, zone_id, record_name):
@@ -78,6 +78,22 @@ def delete(secret_name=None, configmap_name=None, namespace=None, exists_ok=Fals
     _delete(cache_key, exists_ok)
 
 
+def prefetch_by_extra_operator_labels(extra_operator_labels, is_secret=False, namespace=None):
+    """Fetches all the secrets or configmaps with the given extra operator labels in one request and caches them
+
+    following gets of these configs are served from the cache, returns the number of fetched configs
+    """
+    config_type = 'secret' if is_secret else 'configmap'
+    _, namespace = cluster_manager.get_operator_configmap_namespace_defaults(None, namespace)
+    labels = labels_manager.get_resource_labels(extra_operator_labels)
+    items = kubectl.get_items_by_labels(config_type, labels, required=False, namespace=namespace) or []
+    for item in items:
+        cache_key = f'{config_type}:{namespace}:{item["metadata"]["name"]}'
+        __CACHED_VALUES[cache_key] = (kubectl.decode_secret(item) if is_secret else item.get('data')) or {}
+    logs.debug('prefetched configs', config_type=config_type, namespace=namespace, num_configs=len(items))
+    return len(items)
+
+
 def delete_by_extra_operator_labels(extra_operator_labels):
     labels = labels_manager.get_resource_labels(extra_operator_labels)
     labels_manager.delete_by_labels(labels, kinds=['configmap', 'secret'])
@@ -182,6 +182,12 @@ def config_get(singular, name, key=None, default=None, required=False, namespace
     )
 
 
+def config_prefetch(singular, namespace=None, is_secret=False):
+    """fetch the configs of all resources of a crd in one request, so following config_get calls don't fetch each one"""
+    return config_manager.prefetch_by_extra_operator_labels({'crd-singular': singular}, is_secret=is_secret,
+                                                            namespace=namespace)
+
+
 def config_delete(singular, name, namespace=None, is_secret=False, exists_ok=False, by_labels=False):
     resource_name = get_resource_name(singular, name)
     if by_labels:
@@ -43,6 +43,22 @@ SECRET_ANNOTATIONS = [
 
 __NONE__ = object()
 
+# label of the instances annotations secrets, used to fetch the secrets of all the instances in a single request
+SECRET_LABEL = 'ckan-cloud/instance-annotations-secret'
+
+
+def prefetch_secrets():
+    """Returns the labeled annotations secrets of all the instances, keyed by instance id
+
+    secrets which were saved before they were labeled are not included
+    """
+    secrets = kubectl.get(f'secrets --all-namespaces -l {SECRET_LABEL}=true', required=False)
+    return {
+        secret['metadata']['namespace']: secret
+        for secret in (secrets or {}).get('items', [])
+        if secret['metadata']['name'] == f'{secret["metadata"]["namespace"]}-annotations'
+    }
+
 
 class DeisCkanInstanceAnnotations(object):
     """Manage annotations related to the instance which are used to store instance metadata"""
@@ -128,7 +144,8 @@ class DeisCkanInstanceAnnotations(object):
             'kind': 'Secret',
             'metadata': {
                 'name': f'{self.instance.id}-annotations',
-                'namespace': self.instance.id
+                'namespace': self.instance.id,
+                'labels': {SECRET_LABEL: 'true'}
             },
             'type': 'Opaque',
             'data': secret['data']
@@ -140,6 +157,15 @@ class DeisCkanInstanceAnnotations(object):
     def set_secret(self, key, value):
         self.set_secrets({key: value})
 
+    def set_prefetched_secret(self, secret):
+        """Sets the secret which was fetched by prefetch_secrets, so that get_secret doesn't fetch it"""
+        self._secret = secret
+
+    def label_secret(self):
+        """Labels a secret which was saved before the secrets were labeled, so that prefetch_secrets includes it"""
+        kubectl.call(f'label secret {self.instance.id}-annotations {SECRET_LABEL}=true --overwrite',
+                     namespace=self.instance.id)
+
     def get_secret(self, key, default=None):
         assert key in SECRET_ANNOTATIONS, f'invalid secret key: {key}'
         secret = getattr(self, '_secret', None)
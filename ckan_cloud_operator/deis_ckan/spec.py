@@ -2,6 +2,7 @@ import yaml
 import copy
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
+from ckan_cloud_operator.providers.db.proxy.pgbouncer.constants import DB_POOL_SETTINGS
 
 
 class DeisCkanInstanceSpec(object):
@@ -70,6 +71,10 @@ class DeisCkanInstanceSpec(object):
                         assert vv in ['yes', 'no', ''], 'only valid values for no-db-proxy are: "yes", "no", ""'
                     elif kk == 'dbPrefix':
                         assert not vv or type(vv) == str
+                    elif kk == 'pgbouncer':
+                        assert type(vv) == dict and all(
+                            setting in DB_POOL_SETTINGS and int(value) >= 0 for setting, value in vv.items()
+                        ), f'only valid pgbouncer settings are: {DB_POOL_SETTINGS}'
                     else:
                         raise ValueError(f'Invalid db spec attribute: {kk}={vv}')
             elif k == 'solrCloudCollection':
@@ -1,5 +1,19 @@
+import csv
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from ckan_cloud_operator import logs
+
+
+HARVEST_MAX_WORKERS = 8
+
+# fetches the build metadata needed for harvesting together with the builds list, in a single request
+JOB_BUILDS_TREE = 'builds[number,url,timestamp,building,result]'
+
 
 def curl(jenkins_user, jenkins_token, jenkins_url, post_json_data=None, raw=False):
     res = requests.post(jenkins_url, auth=(jenkins_user, jenkins_token), json=post_json_data)
@@ -9,7 +23,76 @@ def curl(jenkins_user, jenkins_token, jenkins_url, post_json_data=None, raw=Fals
         return res.json()
 
 
-def get_session(jenkins_user, jenkins_token):
+def get_session(jenkins_user, jenkins_token, pool_maxsize=None):
     session = requests.session()
     session.auth = (jenkins_user, jenkins_token)
+    if pool_maxsize:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
     return session
+
+
+def harvest_builds(session, job_api_url, artifact_path, cache_path, max_workers=HARVEST_MAX_WORKERS):
+    """Yields a tuple of (build, artifact csv rows) for each finished build of a job
+
+    Only builds which are not in the cache path are fetched, concurrently over the given session.
+    Only completed builds which were fetched successfully are cached, other builds are yielded without rows
+    and fetched again on the next harvest.
+    """
+    builds = session.get(job_api_url, params={'tree': JOB_BUILDS_TREE}).json()['builds']
+    new_builds, num_cached = [], 0
+    for build in builds:
+        if build.get('building'):
+            continue
+        cached = _load_cached_build(cache_path, build['number'])
+        if cached:
+            num_cached += 1
+            yield cached['build'], cached['rows']
+        else:
+            new_builds.append(build)
+    logs.info('Harvesting Jenkins builds', builds=len(builds), cached=num_cached, new=len(new_builds))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for build, rows, completed in executor.map(lambda build: _fetch_build(session, build, artifact_path),
+                                                   new_builds):
+            if completed:
+                _save_cached_build(cache_path, build, rows)
+            yield build, rows
+
+
+def _fetch_build(session, build, artifact_path):
+    """Returns a tuple of (build, rows, completed), completed is False if the build or its artifact are not final"""
+    try:
+        if not build.get('timestamp') or not build.get('result'):
+            build = dict(build, **session.get('{}api/json'.format(build['url'])).json())
+        build_result = build.get('result')
+        build = {k: build.get(k) for k in ('number', 'url', 'timestamp')}
+        if not build['timestamp'] or not build_result:
+            logs.warning('build is not completed', build=build)
+            return build, [], False
+        res = session.get('{}artifact/{}'.format(build['url'], artifact_path))
+        if res.status_code != 200:
+            logs.warning('failed to get build artifact', build=build, status_code=res.status_code)
+            return build, [], False
+        return build, list(csv.DictReader(io.StringIO(res.text))), True
+    except Exception as e:
+        build = {k: build.get(k) for k in ('number', 'url', 'timestamp')}
+        logs.warning(f'failed to fetch build: {e}', build=build)
+        return build, [], False
+
+
+def _load_cached_build(cache_path, build_number):
+    filename = os.path.join(cache_path, f'{build_number}.json')
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    else:
+        return None
+
+
+def _save_cached_build(cache_path, build, rows):
+    os.makedirs(cache_path, exist_ok=True)
+    filename = os.path.join(cache_path, '{}.json'.format(build['number']))
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump({'build': build, 'rows': rows}, f)
+    os.replace(f'{filename}.tmp', filename)
@@ -42,7 +42,7 @@ def db_role_info(db_name, admin_connection_string):
 @click.option('--validate', is_flag=True)
 def db_names(admin_connection_string, full, validate):
     with _get_admin_connection(admin_connection_string) as admin_conn:
-        print(yaml.dump(list(driver.list_db_names(admin_conn, full, validate)), default_flow_style=False))
+        _print_yaml_list(driver.list_db_names(admin_conn, full, validate))
 
 
 @postgres.command()
@@ -51,7 +51,13 @@ def db_names(admin_connection_string, full, validate):
 @click.option('--validate', is_flag=True)
 def roles(admin_connection_string, full, validate):
     with _get_admin_connection(admin_connection_string) as admin_conn:
-        print(yaml.dump(list(driver.list_roles(admin_conn, full, validate)), default_flow_style=False))
+        _print_yaml_list(driver.list_roles(admin_conn, full, validate))
+
+
+def _print_yaml_list(items):
+    # prints each item as it's fetched, the output is a single yaml list
+    for item in items:
+        print(yaml.dump([item], default_flow_style=False), end='', flush=True)
 
 
 def _get_admin_connection_string(connection_string):
@@ -61,7 +67,7 @@ def _get_admin_connection_string(connection_string):
 
 
 def _get_admin_connection(connection_string):
-    return driver.connect(_get_admin_connection_string(connection_string))
+    return driver.connect(_get_admin_connection_string(connection_string), pooled=True)
 
 
 def _generate_password(size):
@@ -1,17 +1,72 @@
 import psycopg2
+import atexit
 import contextlib
+import itertools
+import threading
+import time
 import traceback
 
 from ckan_cloud_operator import logs
 
 
+# maximal number of idle connections which are kept per connection string, extra connections are closed when released
+POOL_MAX_SIZE = 4
+
+# idle connections are closed after this time, to not hold server / pgbouncer connections of finished operations
+POOL_MAX_IDLE_SECONDS = 300
+
+# connections which were idle longer than this are checked with a query before they are reused
+POOL_HEALTH_CHECK_IDLE_SECONDS = 30
+
+# connection key -> list of idle (connection, last used time)
+_pool = {}
+_pool_lock = threading.Lock()
+
+
 @contextlib.contextmanager
-def connect(*args, **kwargs):
-    with psycopg2.connect(*args, **kwargs) as conn:
-        yield conn
+def connect(*args, pooled=False, **kwargs):
+    """Yields a connection in a transaction, which is committed on success or rolled back on exception
+
+    pooled connections are borrowed from a process-wide pool of idle connections keyed by the connection arguments,
+    so repeated operations against the same endpoint reuse the connection instead of reconnecting.
+    pooling should be used only for the admin connections, which are used for many operations,
+    a pooled connection is already logged in, so it can't be used to check the login credentials
+    """
+    if not pooled:
+        conn = psycopg2.connect(*args, **kwargs)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+        return
+    key = _get_pool_key(args, kwargs)
+    conn = _borrow(key) or psycopg2.connect(*args, **kwargs)
+    try:
+        with conn:
+            yield conn
+    except Exception:
+        _release(key, conn)
+        raise
+    _release(key, conn)
+
+
+def close_pool():
+    """Closes all the idle pooled connections"""
+    with _pool_lock:
+        connections = [conn for idle in _pool.values() for conn, _ in idle]
+        _pool.clear()
+    for conn in connections:
+        _close(conn)
+
+
+def get_pool_stats():
+    with _pool_lock:
+        return {'keys': len(_pool), 'idle-connections': sum(len(idle) for idle in _pool.values())}
 
 
 def create_base_db(admin_conn, db_name, db_password, grant_to_user=None):
+    """Creates a role and a db owned by it, with the same ownership as create_base_dbs_bulk"""
     db_info = get_db_role_info(admin_conn, db_name)
     errors = []
     if db_info.get('role'):
@@ -19,6 +74,12 @@ def create_base_db(admin_conn, db_name, db_password, grant_to_user=None):
         errors.append('role-exists')
     else:
         create_role_if_not_exists(admin_conn, db_name, db_password)
+    # the admin user must be a member of the owner role to create a db owned by it
+    if grant_to_user:
+        _set_session_autocommit(admin_conn)
+        with admin_conn.cursor() as cur:
+            cur.execute(f'GRANT "{db_name}" to "{grant_to_user}";')
+        _unset_session_autocommit(admin_conn)
     if db_info.get('db'):
         logs.info(f'DB already exists: {db_name}')
         errors.append('db-exists')
@@ -26,17 +87,65 @@ def create_base_db(admin_conn, db_name, db_password, grant_to_user=None):
         logs.info(f'Creating DB: {db_name}')
         _set_session_autocommit(admin_conn)
         with admin_conn.cursor() as cur:
-            cur.execute(f'CREATE DATABASE "{db_name}";')
-        _unset_session_autocommit(admin_conn)
-    if grant_to_user:
-        _set_session_autocommit(admin_conn)
-        with admin_conn.cursor() as cur:
-            cur.execute(f'GRANT "{db_name}" to "{grant_to_user}";')
+            cur.execute(f'CREATE DATABASE "{db_name}" OWNER "{db_name}";')
         _unset_session_autocommit(admin_conn)
 
     return errors
 
 
+def get_existing_dbs_and_roles(admin_conn, names):
+    """Returns a tuple of (existing db names, existing role names) out of the given names, in a single query"""
+    names = sorted(set(names))
+    dbs, roles = set(), set()
+    with admin_conn.cursor() as cur:
+        cur.execute("select 'db', datname from pg_database where datname = any(%s) "
+                    "union all select 'role', rolname from pg_roles where rolname = any(%s)", (names, names))
+        for kind, name in cur:
+            (dbs if kind == 'db' else roles).add(name)
+    return dbs, roles
+
+
+def create_base_dbs_bulk(admin_conn, dbs, roles, grant_to_user=None):
+    """Creates many roles and dbs over a single autocommit session, skips the existing ones
+
+    dbs: list of db names, a created db is owned by the role with the same name, if there is such a role
+    roles: list of (role name, password)
+    grant_to_user: the owner roles of the dbs are granted to this user, before the dbs are created
+    Returns a tuple of (created db names, created role names)
+    """
+    existing_dbs, existing_roles = get_existing_dbs_and_roles(admin_conn, dbs + [name for name, _ in roles])
+    created_dbs, created_roles = [], []
+    _set_session_autocommit(admin_conn)
+    try:
+        with admin_conn.cursor() as cur:
+            for role_name, role_password in roles:
+                if role_name in existing_roles:
+                    continue
+                logs.info(f'Creating role: {role_name}')
+                cur.execute(f'CREATE ROLE "{role_name}" WITH LOGIN PASSWORD %s NOSUPERUSER NOCREATEDB NOCREATEROLE;',
+                            (role_password,))
+                cur.execute(f'GRANT "{role_name}" TO postgres;')
+                created_roles.append(role_name)
+            owner_roles = existing_roles.union(created_roles)
+            # the admin user must be a member of the owner role to create a db owned by it
+            if grant_to_user:
+                for db_name in dbs:
+                    if db_name in owner_roles:
+                        cur.execute(f'GRANT "{db_name}" to "{grant_to_user}";')
+            for db_name in dbs:
+                if db_name in existing_dbs:
+                    continue
+                logs.info(f'Creating DB: {db_name}')
+                if db_name in owner_roles:
+                    cur.execute(f'CREATE DATABASE "{db_name}" OWNER "{db_name}";')
+                else:
+                    cur.execute(f'CREATE DATABASE "{db_name}";')
+                created_dbs.append(db_name)
+    finally:
+        _unset_session_autocommit(admin_conn)
+    return created_dbs, created_roles
+
+
 def create_role_if_not_exists(admin_conn, role_name, role_password):
     roles = list(list_roles(admin_conn, role_name=role_name))
     if len(roles) == 0:
@@ -104,58 +213,77 @@ def delete_base_db(admin_conn, db_name):
     return errors
 
 
+ROLE_FIELDS = 'rolname | rolsuper | rolinherit | rolcreaterole | rolcreatedb | rolcanlogin | rolreplication | rolconnlimit | rolpassword | rolvaliduntil | rolbypassrls | rolconfig |  oid'.split(' | ')
+DB_FIELDS = 'datname | datdba | encoding | datcollate | datctype | datistemplate | datallowconn | datconnlimit | datlastsysoid | datfrozenxid | datminmxid | dattablespace | datacl'.split(' | ')
+
+# number of rows fetched from the server at a time by the streaming catalog queries
+CATALOG_ITER_SIZE = 2000
+
+_cursor_ids = itertools.count()
+
+
 def get_db_role_info(admin_conn, db_name):
-    res = {'role': None, 'db': None}
-    cur = admin_conn.cursor()
-    fields = 'rolname | rolsuper | rolinherit | rolcreaterole | rolcreatedb | rolcanlogin | rolreplication | rolconnlimit | rolpassword | rolvaliduntil | rolbypassrls | rolconfig |  oid'.split(' | ')
-    fields_select = ', '.join(fields)
-    cur.execute(f'select {fields_select} from pg_roles where rolname=%s', (db_name,))
-    row = cur.fetchone()
-    res['role'] = dict(zip(fields, row)) if row else None
-    fields = 'datname | datdba | encoding | datcollate | datctype | datistemplate | datallowconn | datconnlimit | datlastsysoid | datfrozenxid | datminmxid | dattablespace | datacl'.split(' | ')
-    fields_select = ', '.join(fields)
-    cur.execute(f'select {fields_select} from pg_database where datname=%s', (db_name,))
-    row = cur.fetchone()
-    res['db'] = dict(zip(fields, row)) if row else None
-    cur.close()
-    return res
+    rows = list(iter_db_role_info(admin_conn, 'all', name=db_name))
+    return rows[0] if rows else {'role': None, 'db': None}
+
+
+def iter_db_role_info(admin_conn, from_, name=None):
+    """Streams the role and db info of all dbs, roles or both (from_ = 'db' / 'role' / 'all') in a single query
+
+    Roles and dbs are matched by name, yields dicts of {'role': role info or None, 'db': db info or None}
+    """
+    join = {'db': 'pg_database d left join pg_roles r', 'role': 'pg_roles r left join pg_database d',
+            'all': 'pg_database d full outer join pg_roles r'}[from_]
+    fields_select = ', '.join([f'r.{field.strip()}' for field in ROLE_FIELDS] + [f'd.{field}' for field in DB_FIELDS])
+    where, args = (' where coalesce(r.rolname, d.datname) = %s', (name,)) if name is not None else ('', ())
+    order = {'db': 'd.datname', 'role': 'r.rolname', 'all': 'coalesce(r.rolname, d.datname)'}[from_]
+    num_role_fields = len(ROLE_FIELDS)
+    # server side cursor, so the rows are streamed instead of loaded to memory (requires a transaction)
+    cursor_name = None if admin_conn.autocommit else f'iter_db_role_info_{next(_cursor_ids)}'
+    with admin_conn.cursor(name=cursor_name) as cur:
+        cur.itersize = CATALOG_ITER_SIZE
+        cur.execute(f'select {fields_select} from {join} on r.rolname = d.datname{where} order by {order}', args)
+        for row in cur:
+            role_row, db_row = row[:num_role_fields], row[num_role_fields:]
+            yield {
+                'role': dict(zip(ROLE_FIELDS, role_row)) if role_row[0] is not None else None,
+                'db': dict(zip(DB_FIELDS, db_row)) if db_row[0] is not None else None,
+            }
 
 
 def list_db_names(admin_conn, full=False, validate=False):
     if validate: full = True
     failures = []
-    cur = admin_conn.cursor()
-    cur.execute('select datname from pg_database')
-    for row in cur:
-        db_name = row[0]
-        if full:
-            data = get_db_role_info(admin_conn, db_name)
-            if validate and not (data.get('db') and data.get('role')): failures.append(db_name)
+    if full:
+        for data in iter_db_role_info(admin_conn, 'db'):
+            if validate and not (data.get('db') and data.get('role')): failures.append(data['db']['datname'])
             yield data
-        else:
-            yield db_name
+    else:
+        with admin_conn.cursor() as cur:
+            cur.execute('select datname from pg_database')
+            for row in cur:
+                yield row[0]
     if validate and len(failures) > 0: raise Exception(f'Failed to get role for following dbs: {failures}')
 
 
 def list_roles(admin_conn, full=False, validate=False, role_name=None):
     if validate: full=True
     failures = []
-    cur = admin_conn.cursor()
-    if role_name is not None:
-        where = ' where rolname=%s'
-        args = (role_name,)
-    else:
-        where = ''
-        args = ()
-    cur.execute(f'select rolname from pg_roles{where}', args)
-    for row in cur:
-        role_name = row[0]
-        if full:
-            data = get_db_role_info(admin_conn, role_name)
-            if validate and not (data.get('db') and data.get('role')): failures.append(role_name)
+    if full:
+        for data in iter_db_role_info(admin_conn, 'role', name=role_name):
+            if validate and not (data.get('db') and data.get('role')): failures.append(data['role']['rolname'])
             yield data
+    else:
+        if role_name is not None:
+            where = ' where rolname=%s'
+            args = (role_name,)
         else:
-            yield role_name
+            where = ''
+            args = ()
+        with admin_conn.cursor() as cur:
+            cur.execute(f'select rolname from pg_roles{where}', args)
+            for row in cur:
+                yield row[0]
     if validate and len(failures) > 0: raise Exception(f'Failed to get db for following roles: {failures}')
 
 
@@ -175,3 +303,72 @@ def _set_session_autocommit(conn):
 def _unset_session_autocommit(conn):
     conn.commit()
     conn.set_session(autocommit=False)
+
+
+def _get_pool_key(args, kwargs):
+    return repr((args, sorted(kwargs.items())))
+
+
+def _borrow(key):
+    # most recently used connections are borrowed first, so the older connections become idle and are evicted
+    while True:
+        now = time.time()
+        with _pool_lock:
+            idle = _pool.get(key)
+            if not idle:
+                return None
+            conn, last_used = idle.pop()
+        if conn.closed or now - last_used > POOL_MAX_IDLE_SECONDS:
+            _close(conn)
+        elif now - last_used > POOL_HEALTH_CHECK_IDLE_SECONDS and not _is_healthy(conn):
+            _close(conn)
+        else:
+            return conn
+
+
+def _release(key, conn):
+    if not conn.closed:
+        try:
+            # reset the session state (e.g. SET ROLE, search_path) and restore the session defaults,
+            # DISCARD ALL can't run inside a transaction so it runs with autocommit
+            conn.rollback()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('DISCARD ALL')
+            conn.autocommit = False
+        except psycopg2.Error:
+            _close(conn)
+    now = time.time()
+    expired = []
+    with _pool_lock:
+        for idle_key, idle in _pool.items():
+            expired += [c for c, last_used in idle if now - last_used > POOL_MAX_IDLE_SECONDS]
+            idle[:] = [(c, last_used) for c, last_used in idle if now - last_used <= POOL_MAX_IDLE_SECONDS]
+        if not conn.closed:
+            idle = _pool.setdefault(key, [])
+            if len(idle) < POOL_MAX_SIZE:
+                idle.append((conn, now))
+            else:
+                expired.append(conn)
+    for expired_conn in expired:
+        _close(expired_conn)
+
+
+def _is_healthy(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute('select 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+atexit.register(close_pool)
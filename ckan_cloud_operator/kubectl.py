@@ -164,13 +164,16 @@ def get_item_detailed_status(item):
     return item_status
 
 
-def get_deployment_detailed_status(deployment, pod_label_selector, main_container_name, namespace='ckan-cloud'):
+def get_deployment_detailed_status(deployment, pod_label_selector, main_container_name, namespace='ckan-cloud',
+                                   pods=None):
+    """pods - optional list of the deployment's pods, if not provided the pods are fetched using the label selector"""
     status = get_item_detailed_status(deployment)
     ready = len(status.get('error', [])) == 0
     status['pods'] = []
-    pods = get(f'pods -l {pod_label_selector}', namespace=namespace, required=False)
+    if pods is None:
+        pods = (get(f'pods -l {pod_label_selector}', namespace=namespace, required=False) or {}).get('items')
     if pods:
-        for pod in pods['items']:
+        for pod in pods:
             pod_status = get_item_detailed_status(pod)
             pod_status['other-containers'] = []
             for container in pod['spec']['containers']:
@@ -198,6 +201,15 @@ def create(resource, is_yaml=False):
     subprocess.run('kubectl create -f -', input=yaml.dump(resource).encode(), shell=True, check=True)
 
 
+def create_or_replace(resource):
+    """Creates the resource, or replaces it if its metadata has a resourceVersion
+
+    returns False if the resource was created or modified since the resourceVersion was read, or on other failures
+    """
+    cmd = 'replace' if resource['metadata'].get('resourceVersion') else 'create'
+    return subprocess.run(f'kubectl {cmd} -f -', input=yaml.dump(resource).encode(), shell=True).returncode == 0
+
+
 def apply(resource, is_yaml=False, reconcile=False, dry_run=False):
     if is_yaml: resource = yaml.load(resource)
     cmd = 'auth reconcile' if reconcile else 'apply'
@@ -478,8 +490,9 @@ class BaseAnnotations(object):
         ans.append(f"{key}='{value}'")
         self._annotate(*ans, overwrite=overwrite)
 
-    def get_json_annotation(self, key):
-        return json.loads(self._get_annotation(key))
+    def get_json_annotation(self, key, default=None):
+        value = self._get_annotation(key)
+        return default if value is None else json.loads(value)
 
     def _annotate(self, *annotations, overwrite=False):
         cmd = f'kubectl -n ckan-cloud annotate {self.resource_kind} {self.resource_id}'
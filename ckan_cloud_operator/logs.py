@@ -24,7 +24,9 @@ def debug(*args, **kwargs):
 
 
 def debug_verbose(*args, **kwargs):
-    log(DEBUG_VERBOSE, yaml.dump([args, kwargs], default_flow_style=False))
+    # the yaml dump is expensive, skip it if verbose debug is disabled
+    if not _skip_log_level(DEBUG_VERBOSE):
+        log(DEBUG_VERBOSE, yaml.dump([args, kwargs], default_flow_style=False))
 
 
 def warning(*args, **kwargs):
@@ -0,0 +1,247 @@
+import collections
+import concurrent.futures
+import functools
+import gzip
+import json
+import re
+import sys
+import time
+import zlib
+
+import httpagentparser
+
+from ckan_cloud_operator import logs
+
+from . import latency
+
+
+DEFAULT_BATCH_SIZE = 2000
+
+# batches submitted to the worker processes and not yet merged, per worker
+MAX_PENDING_BATCHES_PER_WORKER = 4
+
+# matches the request host in a raw JSON access log line, to shard lines without parsing the JSON
+_REQUEST_HOST_RE = re.compile(r'"RequestHost"\s*:\s*"([^"]+)"')
+
+
+@functools.lru_cache(maxsize=10000)
+def get_user_agent(user_agent):
+    """Returns a tuple of (os name, browser name) of a user agent string, user agents repeat so parsing is cached"""
+    try:
+        user_agent = httpagentparser.detect(user_agent)
+        return user_agent.get('os', {}).get('name'), user_agent.get('browser', {}).get('name')
+    except Exception:
+        return None, None
+
+
+def aggregate_row(aggregates, row):
+    """Adds a Traefik access log row to the aggregates dict of request host -> {'stats', 'metadata', 'latency',
+    'minute-requests'}
+
+    latency is a dict of route (Traefik backend) name -> latency sketch in milliseconds
+    minute-requests is a dict of start minute (YYYY-MM-DDTHH:MM) -> number of requests, used for peak rates
+    """
+    request_host = row['RequestHost']
+    aggregate = aggregates.get(request_host)
+    if aggregate is None:
+        aggregate = aggregates[request_host] = _new_aggregate()
+    stats, metadata = aggregate['stats'], aggregate['metadata']
+    stats['total-requests'] += 1
+    status_code = row['DownstreamStatus']
+    stats[f'status-{status_code}'] += 1
+    duration_seconds = int(row['Duration'])/1000000000
+    if duration_seconds > 10:
+        duration_tag = 'more_then_10s'
+    elif duration_seconds > 5:
+        duration_tag = 'more_then_5s'
+    elif duration_seconds > 3:
+        duration_tag = 'more_then_3s'
+    else:
+        duration_tag = None
+    if duration_tag:
+        stats[f'duration-{duration_tag}'] += 1
+    route_name = row.get('BackendName') or ''
+    route_latency = aggregate['latency'].get(route_name)
+    if route_latency is None:
+        route_latency = aggregate['latency'][route_name] = latency.new()
+    latency.add(route_latency, int(row['Duration']) / 1000000)
+    start_time = row['StartUTC']
+    minute_requests = aggregate['minute-requests']
+    minute = start_time[:16]
+    minute_requests[minute] = minute_requests.get(minute, 0) + 1
+    if not metadata.get('first-start-time') or metadata['first-start-time'] > start_time:
+        metadata['first-start-time'] = start_time
+    if not metadata.get('last-start-time') or metadata['last-start-time'] < start_time:
+        metadata['last-start-time'] = start_time
+    referer = row.get('request_Referer')
+    referer = referer.strip() if referer else None
+    if not referer:
+        referer_tag = None
+    elif referer.startswith(f'https://{request_host}'):
+        referer_tag = 'self'
+    else:
+        referer_tag = 'external'
+    if referer_tag:
+        stats[f'referer-{referer_tag}'] += 1
+    user_agent_os, user_agent_browser = get_user_agent(row.get('request_User-Agent'))
+    if user_agent_os:
+        stats[f'ua-os-{user_agent_os}'] += 1
+    if user_agent_browser:
+        stats[f'ua-browser-{user_agent_browser}'] += 1
+
+
+def merge(target, source):
+    """Merges the source aggregates into the target aggregates, returns the target"""
+    for request_host, source_aggregate in source.items():
+        aggregate = target.get(request_host)
+        if aggregate is None:
+            aggregate = target[request_host] = _new_aggregate()
+        for k, v in source_aggregate['stats'].items():
+            aggregate['stats'][k] += v
+        for route_name, route_latency in source_aggregate['latency'].items():
+            latency.merge(aggregate['latency'].setdefault(route_name, latency.new()), route_latency)
+        for minute, requests in source_aggregate['minute-requests'].items():
+            aggregate['minute-requests'][minute] = aggregate['minute-requests'].get(minute, 0) + requests
+        metadata, source_metadata = aggregate['metadata'], source_aggregate['metadata']
+        for key, func in (('first-start-time', min), ('last-start-time', max)):
+            values = [v for v in (metadata.get(key), source_metadata.get(key)) if v]
+            if values:
+                metadata[key] = func(values)
+    return target
+
+
+def get_host_latency(aggregate):
+    """Returns the latency sketch of all the routes of a request host aggregate"""
+    host_latency = latency.new()
+    for route_latency in aggregate['latency'].values():
+        latency.merge(host_latency, route_latency)
+    return host_latency
+
+
+def get_latency_rows(aggregates, by_route=False):
+    """Returns a latency row per request host or per route, including the serialized sketch for later merging"""
+    sketches = {}
+    for request_host, aggregate in aggregates.items():
+        if by_route:
+            for route_name, route_latency in aggregate['latency'].items():
+                latency.merge(sketches.setdefault(route_name, latency.new()), route_latency)
+        else:
+            sketches[request_host] = get_host_latency(aggregate)
+    for name, sketch in sketches.items():
+        yield {
+            'route' if by_route else 'request_host': name,
+            'requests': sketch['count'],
+            **latency.get_summary(sketch),
+            'latency-sketch': latency.dumps(sketch),
+        }
+
+
+def get_stats_rows(aggregates):
+    """Returns a stats row per request host, all rows have the same keys"""
+    all_stats_keys = set()
+    all_metadata_keys = set()
+    for aggregate in aggregates.values():
+        all_stats_keys.update(aggregate['stats'])
+        all_metadata_keys.update(aggregate['metadata'])
+    for request_host, aggregate in aggregates.items():
+        row = {k: 0 for k in all_stats_keys}
+        row.update({k: None for k in all_metadata_keys})
+        row.update(**aggregate['stats'], **aggregate['metadata'])
+        row.update(**latency.get_summary(get_host_latency(aggregate)))
+        row['request_host'] = request_host
+        yield row
+
+
+def read_lines(source):
+    """Streams the lines of a JSON lines access log from a file path (optionally gzipped), url or '-' for stdin"""
+    if source == '-':
+        yield from sys.stdin
+    elif source.startswith('http://') or source.startswith('https://'):
+        import requests
+        with requests.get(source, stream=True) as res:
+            res.raise_for_status()
+            yield from res.iter_lines(decode_unicode=True)
+    else:
+        with (gzip.open(source, 'rt') if source.endswith('.gz') else open(source)) as f:
+            yield from f
+
+
+def aggregate_lines(lines, workers=1, batch_size=DEFAULT_BATCH_SIZE, progress=None):
+    """Aggregates JSON access log lines, using the given number of worker processes
+
+    Lines are sharded to the workers by request host, so each worker batch aggregates a disjoint set of hosts
+    Lines without a request host are skipped, in both the single and the multi process modes
+    progress - optional dict which is updated with the number of processed and skipped lines
+    """
+    if progress is None:
+        progress = {}
+    progress['lines'] = progress['skipped'] = 0
+    if workers <= 1:
+        aggregates = {}
+        for line in lines:
+            if line.strip():
+                row = json.loads(line)
+                if row.get('RequestHost'):
+                    progress['lines'] += 1
+                    aggregate_row(aggregates, row)
+                else:
+                    progress['skipped'] += 1
+        return aggregates
+    aggregates = {}
+    pending = set()
+
+    def _merge_done(return_when):
+        # result() re-raises worker errors in the parent
+        done, not_done = concurrent.futures.wait(pending, return_when=return_when)
+        for future in done:
+            merge(aggregates, future.result())
+        return not_done
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        batches = [[] for _ in range(workers)]
+        for line in lines:
+            if not line.strip():
+                continue
+            match = _REQUEST_HOST_RE.search(line)
+            if not match:
+                progress['skipped'] += 1
+                continue
+            progress['lines'] += 1
+            shard = zlib.crc32(match.group(1).encode()) % workers
+            batch = batches[shard]
+            batch.append(line)
+            if len(batch) >= batch_size:
+                # limit the batches in flight, so a slow worker does not buffer the whole log in memory
+                if len(pending) >= workers * MAX_PENDING_BATCHES_PER_WORKER:
+                    pending = _merge_done(concurrent.futures.FIRST_COMPLETED)
+                pending.add(executor.submit(_aggregate_batch, batch))
+                batches[shard] = []
+        for batch in batches:
+            if batch:
+                pending.add(executor.submit(_aggregate_batch, batch))
+        _merge_done(concurrent.futures.ALL_COMPLETED)
+    return aggregates
+
+
+def aggregate(source, workers=1, batch_size=DEFAULT_BATCH_SIZE):
+    """Aggregates an access log source (see read_lines), returns the aggregates"""
+    progress = {}
+    start_time = time.time()
+    aggregates = aggregate_lines(read_lines(source), workers=workers, batch_size=batch_size, progress=progress)
+    seconds = time.time() - start_time
+    logs.info('Aggregated access logs', source=source, workers=workers, lines=progress['lines'],
+              skipped_lines=progress['skipped'],
+              hosts=len(aggregates), seconds=round(seconds, 2),
+              lines_per_second=round(progress['lines'] / seconds) if seconds else None)
+    return aggregates
+
+
+def _aggregate_batch(batch):
+    aggregates = {}
+    for line in batch:
+        aggregate_row(aggregates, json.loads(line))
+    return {host: dict(a, stats=dict(a['stats'])) for host, a in aggregates.items()}
+
+
+def _new_aggregate():
+    return {'stats': collections.defaultdict(int), 'metadata': {}, 'latency': {}, 'minute-requests': {}}
@@ -0,0 +1,183 @@
+import collections
+import json
+import os
+
+from ckan_cloud_operator import logs
+
+from . import aggregate as access_logs_aggregate
+from . import latency
+
+
+# Incremental access logs processing
+# The state path contains a high-watermark of the processed log rows and the stored aggregates per hour,
+# each run processes only the rows after the watermark and merges them into the hourly aggregates
+# Changed hours are written to new files and the state file, which has the watermark and the current file of
+# each hour, is replaced last, so an interrupted run leaves the previous state as-is
+
+DEFAULT_STATE_PATH = 'data/access_logs_state'
+
+STATE_FILENAME = 'state.json'
+
+
+def get_watermark(state_path=DEFAULT_STATE_PATH):
+    """Returns the high-watermark of the processed rows
+
+    first-start-utc: start time of the first row of the log, identifies the log in case it was rotated
+    offset: number of processed rows of the log
+    byte-offset: position in the log file after the processed rows, if the log was processed from a file
+    last-start-utc: latest start time of the processed rows
+    """
+    return _load_state(state_path)['watermark']
+
+
+def process_source(source, state_path=DEFAULT_STATE_PATH):
+    """Processes the new lines of an access log source (see aggregate.read_lines)
+
+    Uncompressed local files are read from the byte offset of the watermark, other sources are read from the start
+    """
+    if source == '-' or source.endswith('.gz') or source.startswith('http://') or source.startswith('https://'):
+        return process_lines(access_logs_aggregate.read_lines(source), state_path)
+    with open(source, 'rb') as f:
+        return process_lines(f, state_path, seek=f.seek)
+
+
+def process_lines(lines, state_path=DEFAULT_STATE_PATH, parse=json.loads, seek=None):
+    """Aggregates the lines after the watermark into the stored hourly aggregates and advances the watermark
+
+    Only the first line and the lines after the watermark are parsed, if seek is given (the lines are read from
+    a binary file), the file is seeked to the watermark byte offset instead of reading the processed lines
+    parse - function which returns the row of a line, None if the lines are already parsed rows
+    """
+    state = _load_state(state_path)
+    watermark = state['watermark']
+    hours = {}
+    offset = byte_offset = 0
+    first_start_utc = None
+    last_start_utc = watermark.get('last-start-utc')
+    for line in lines:
+        if seek:
+            byte_offset += len(line)
+        if parse and not line.strip():
+            continue
+        row = None
+        if first_start_utc is None:
+            row = parse(line) if parse else line
+            first_start_utc = row['StartUTC']
+            if watermark and watermark.get('first-start-utc') != first_start_utc:
+                logs.warning('access log was rotated, processing all rows', watermark=watermark,
+                             first_start_utc=first_start_utc)
+                watermark = {}
+            elif seek and watermark.get('byte-offset'):
+                seek(watermark['byte-offset'])
+                offset, byte_offset = watermark['offset'], watermark['byte-offset']
+                continue
+        offset += 1
+        if offset <= watermark.get('offset', 0):
+            continue
+        if row is None:
+            row = parse(line) if parse else line
+        start_utc = row['StartUTC']
+        access_logs_aggregate.aggregate_row(hours.setdefault(start_utc[:13], {}), row)
+        if not last_start_utc or start_utc > last_start_utc:
+            last_start_utc = start_utc
+    if offset < watermark.get('offset', 0):
+        logs.warning('access log has less rows than the watermark, no rows were processed', watermark=watermark,
+                     rows=offset)
+        return {'rows': offset, 'processed-rows': 0, 'hours': []}
+    if offset > 0:
+        _save_state(state_path, state, {
+            'first-start-utc': first_start_utc, 'offset': offset, 'last-start-utc': last_start_utc,
+            **({'byte-offset': byte_offset} if seek else {}),
+        }, {
+            hour: access_logs_aggregate.merge(_load_hour(state_path, state['hours'].get(hour)), aggregates)
+            for hour, aggregates in hours.items()
+        })
+    processed_rows = offset - watermark.get('offset', 0)
+    logs.info('Processed access log rows', rows=offset, processed_rows=processed_rows, hours=len(hours))
+    return {'rows': offset, 'processed-rows': processed_rows, 'hours': sorted(hours)}
+
+
+def process_rows(rows, state_path=DEFAULT_STATE_PATH):
+    """Aggregates the rows after the watermark, see process_lines"""
+    return process_lines(rows, state_path, parse=None)
+
+
+def get_hours(state_path=DEFAULT_STATE_PATH):
+    """Returns the sorted hours which have stored aggregates, in the format YYYY-MM-DDTHH"""
+    return sorted(_load_state(state_path)['hours'])
+
+
+def load_hour(hour, state_path=DEFAULT_STATE_PATH):
+    return _load_hour(state_path, _load_state(state_path)['hours'].get(hour))
+
+
+def load_history(from_hour=None, to_hour=None, state_path=DEFAULT_STATE_PATH):
+    """Returns the merged aggregates of the stored hours in the given range (inclusive, YYYY-MM-DDTHH)"""
+    aggregates = {}
+    for hour, filename in sorted(_load_state(state_path)['hours'].items()):
+        if (not from_hour or hour >= from_hour) and (not to_hour or hour <= to_hour):
+            access_logs_aggregate.merge(aggregates, _load_hour(state_path, filename))
+    return aggregates
+
+
+def _load_hour(state_path, filename):
+    data = _load_json(os.path.join(state_path, 'hours', filename)) if filename else {}
+    return {
+        request_host: {
+            'stats': collections.defaultdict(int, aggregate['stats']),
+            'metadata': aggregate['metadata'],
+            'latency': {route_name: latency.from_dict(sketch) for route_name, sketch in aggregate['latency'].items()},
+            'minute-requests': aggregate.get('minute-requests', {}),
+        }
+        for request_host, aggregate in data.items()
+    }
+
+
+def _load_state(state_path):
+    state = _load_json(os.path.join(state_path, STATE_FILENAME)) or {}
+    return {'watermark': state.get('watermark', {}), 'generation': state.get('generation', 0),
+            'hours': state.get('hours', {})}
+
+
+def _save_state(state_path, state, watermark, hours):
+    """Writes the changed hours to new files, then replaces the state file and deletes the replaced hour files"""
+    generation = state['generation'] + 1
+    hour_filenames = dict(state['hours'])
+    for hour, aggregates in hours.items():
+        hour_filenames[hour] = f'{hour}.{generation}.json'
+        _save_hour(os.path.join(state_path, 'hours', hour_filenames[hour]), aggregates)
+    _save_json(os.path.join(state_path, STATE_FILENAME),
+               {'watermark': watermark, 'generation': generation, 'hours': hour_filenames})
+    hours_path = os.path.join(state_path, 'hours')
+    current_filenames = set(hour_filenames.values())
+    for filename in (os.listdir(hours_path) if os.path.isdir(hours_path) else []):
+        # replaced files, or files of a previous run which was interrupted before saving the state
+        if filename not in current_filenames:
+            os.remove(os.path.join(hours_path, filename))
+
+
+def _save_hour(filename, aggregates):
+    _save_json(filename, {
+        request_host: {
+            'stats': dict(aggregate['stats']),
+            'metadata': aggregate['metadata'],
+            'latency': {route_name: latency.to_dict(sketch) for route_name, sketch in aggregate['latency'].items()},
+            'minute-requests': aggregate['minute-requests'],
+        }
+        for request_host, aggregate in aggregates.items()
+    })
+
+
+def _load_json(filename):
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    else:
+        return None
+
+
+def _save_json(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(f'{filename}.tmp', filename)
@@ -0,0 +1,67 @@
+import click
+import multiprocessing
+
+from ckan_cloud_operator import logs
+
+from . import aggregate as access_logs_aggregate
+from . import checkpoints as access_logs_checkpoints
+
+
+@click.group('logs')
+def logs_group():
+    """Process Traefik access logs"""
+    pass
+
+
+@logs_group.command('aggregate')
+@click.argument('SOURCE')
+@click.option('--workers', type=int, default=multiprocessing.cpu_count(),
+              help='number of worker processes, rows are sharded to workers by request host')
+@click.option('--batch-size', type=int, default=access_logs_aggregate.DEFAULT_BATCH_SIZE)
+@click.option('--output-path', help='dump the per-host stats and per-route latency as a datapackage to this path')
+def aggregate(source, workers, batch_size, output_path):
+    """Aggregate per-host stats and latency percentiles from a JSON lines access log
+
+    SOURCE is a file path (can be gzipped), url, or - for stdin
+    """
+    aggregates = access_logs_aggregate.aggregate(source, workers=workers, batch_size=batch_size)
+    _dump_aggregates(aggregates, output_path)
+
+
+@logs_group.command('process')
+@click.argument('SOURCE')
+@click.option('--state-path', default=access_logs_checkpoints.DEFAULT_STATE_PATH)
+def process(source, state_path):
+    """Incrementally aggregate the new rows of an access log into stored hourly aggregates
+
+    Only the rows after the stored high-watermark are processed, SOURCE is the same as for aggregate,
+    uncompressed local files are read from the position of the watermark
+    """
+    logs.print_yaml_dump(access_logs_checkpoints.process_source(source, state_path))
+
+
+@logs_group.command('history')
+@click.option('--from-hour', help='first hour to include (YYYY-MM-DDTHH)')
+@click.option('--to-hour', help='last hour to include (YYYY-MM-DDTHH)')
+@click.option('--state-path', default=access_logs_checkpoints.DEFAULT_STATE_PATH)
+@click.option('--output-path', help='dump the per-host stats and per-route latency as a datapackage to this path')
+def history(from_hour, to_hour, state_path, output_path):
+    """Get the stats of a time range from the stored hourly aggregates, without reprocessing the logs"""
+    _dump_aggregates(access_logs_checkpoints.load_history(from_hour, to_hour, state_path), output_path)
+
+
+def _dump_aggregates(aggregates, output_path):
+    stats_rows = list(access_logs_aggregate.get_stats_rows(aggregates))
+    if output_path:
+        from dataflows import Flow, update_resource, dump_to_path
+        Flow(
+            stats_rows,
+            update_resource(['res_1'], name='host-stats', path='host-stats.csv'),
+            access_logs_aggregate.get_latency_rows(aggregates),
+            update_resource(['res_2'], name='host-latency', path='host-latency.csv'),
+            access_logs_aggregate.get_latency_rows(aggregates, by_route=True),
+            update_resource(['res_3'], name='route-latency', path='route-latency.csv'),
+            dump_to_path(output_path)
+        ).process()
+    else:
+        logs.print_yaml_dump(stats_rows)
@@ -0,0 +1,86 @@
+import json
+import math
+
+
+# Latency sketch - a histogram with logarithmic buckets, quantiles are estimated with the given relative accuracy
+# Sketches are merged by adding the bucket counts, so merging the sketches of log chunks, days or workers
+# gives exactly the same sketch as aggregating all the values together
+
+RELATIVE_ACCURACY = 0.01
+
+# values below the minimal value are counted in a zero bucket
+MIN_VALUE = 0.001
+
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+def new():
+    return {'count': 0, 'zero': 0, 'max': None, 'buckets': {}}
+
+
+def add(sketch, value, count=1):
+    sketch['count'] += count
+    if sketch['max'] is None or value > sketch['max']:
+        sketch['max'] = value
+    if value < MIN_VALUE:
+        sketch['zero'] += count
+    else:
+        bucket = math.ceil(math.log(value) / _LOG_GAMMA)
+        sketch['buckets'][bucket] = sketch['buckets'].get(bucket, 0) + count
+
+
+def merge(target, source):
+    """Merges the source sketch into the target sketch, returns the target"""
+    target['count'] += source['count']
+    target['zero'] += source['zero']
+    if source['max'] is not None and (target['max'] is None or source['max'] > target['max']):
+        target['max'] = source['max']
+    for bucket, count in source['buckets'].items():
+        target['buckets'][bucket] = target['buckets'].get(bucket, 0) + count
+    return target
+
+
+def quantile(sketch, q):
+    if not sketch['count']:
+        return None
+    if q >= 1:
+        return sketch['max']
+    rank = q * (sketch['count'] - 1)
+    total = sketch['zero']
+    if total > rank:
+        return 0
+    for bucket in sorted(sketch['buckets']):
+        total += sketch['buckets'][bucket]
+        if total > rank:
+            return min(2 * _GAMMA ** bucket / (_GAMMA + 1), sketch['max'])
+    return sketch['max']
+
+
+def get_summary(sketch, prefix='latency-', suffix='-ms'):
+    """Returns a dict of the quantiles and max of the sketch, rounded to 3 decimal places"""
+    summary = {
+        f'{prefix}{name}{suffix}': quantile(sketch, q)
+        for name, q in QUANTILES.items()
+    }
+    summary[f'{prefix}max{suffix}'] = sketch['max']
+    return {k: (round(v, 3) if v is not None else None) for k, v in summary.items()}
+
+
+def to_dict(sketch):
+    """Returns a JSON serializable copy of the sketch"""
+    return dict(sketch, buckets={str(k): v for k, v in sorted(sketch['buckets'].items())})
+
+
+def from_dict(data):
+    return dict(data, buckets={int(k): v for k, v in data['buckets'].items()})
+
+
+def dumps(sketch):
+    return json.dumps(to_dict(sketch))
+
+
+def loads(data):
+    return from_dict(json.loads(data))
@@ -0,0 +1,41 @@
+import click
+import sys
+
+from ckan_cloud_operator import logs
+
+from . import probe as monitoring_probe
+
+
+@click.group('monitoring')
+def monitoring_group():
+    """Monitor the routed instances"""
+    pass
+
+
+@monitoring_group.command('probe')
+@click.option('--concurrency', type=int, default=monitoring_probe.DEFAULT_CONCURRENCY,
+              help='maximal number of concurrent connections')
+@click.option('--timeout', type=float, default=monitoring_probe.DEFAULT_TIMEOUT_SECONDS, help='request timeout seconds')
+@click.option('--measurements', type=int, default=1, help='number of requests to each url')
+@click.option('--path', 'paths', multiple=True,
+              help='TARGET_TYPE=PATH to probe for a target type instead of the default paths, can be repeated')
+@click.option('--scheme', default='https')
+@click.option('--output-file', default='-', help='write the results csv to this file, defaults to stdout')
+def probe(concurrency, timeout, measurements, paths, scheme, output_file):
+    """Probe the frontend hostnames of all routes concurrently and record status, TTFB and total time
+
+    Target types: ckan, app, datapusher, backend-url
+    The output csv has the same format as the instance request time Jenkins job artifacts
+    """
+    target_paths = {}
+    for path in paths:
+        target_type, path = path.split('=', 1)
+        target_paths.setdefault(target_type, []).append(path)
+    rows = monitoring_probe.probe(monitoring_probe.get_targets(), target_paths=target_paths,
+                                  measurements=measurements, concurrency=concurrency, timeout=timeout, scheme=scheme)
+    if output_file == '-':
+        monitoring_probe.write_csv(rows, sys.stdout)
+    else:
+        with open(output_file, 'w', newline='') as f:
+            monitoring_probe.write_csv(rows, f)
+        logs.info('Wrote probe results', output_file=output_file)
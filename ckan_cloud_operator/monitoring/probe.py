@@ -0,0 +1,134 @@
+import asyncio
+import csv
+import time
+from urllib.parse import urlparse
+
+from ckan_cloud_operator import logs
+
+
+DEFAULT_CONCURRENCY = 50
+DEFAULT_TIMEOUT_SECONDS = 30
+
+# paths probed for each target type, can be overridden per target type
+DEFAULT_TARGET_PATHS = {
+    'ckan': ['/api/3/action/status_show', '/api/3/action/datastore_search?resource_id=_table_metadata&limit=1'],
+    'app': ['/'],
+    'datapusher': ['/'],
+    'backend-url': ['/'],
+}
+
+# route type -> (target type, route spec attribute of the instance id)
+ROUTE_TARGET_TYPES = {
+    'deis-instance-subdomain': ('ckan', 'deis-instance-id'),
+    'ckan-instance-subdomain': ('ckan', 'ckan-instance-id'),
+    'app-instance-subdomain': ('app', 'app-instance-id'),
+    'datapusher-subdomain': ('datapusher', 'datapusher-name'),
+    'backend-url-subdomain': ('backend-url', None),
+}
+
+# same columns as the output.csv of the instance request time Jenkins job, which the request times aggregation reads
+OUTPUT_FIELDS = ['instance_id', 'pod_name', 'test_url', 'measurement_num', 'status_code', 'minutes', 'seconds',
+                 'comments', 'ttfb_seconds', 'target_type', 'hostname']
+
+
+def get_targets(routes=None):
+    """Returns a probe target for each unique frontend hostname of the given routes (or all routes)"""
+    from ckan_cloud_operator.routers import manager as routers_manager
+    from ckan_cloud_operator.routers.routes import manager as routes_manager
+    if routes is None:
+        routes = routes_manager.list({})
+    targets = {}
+    for route in routes:
+        route_type = route['spec']['type']
+        if route_type not in ROUTE_TARGET_TYPES:
+            continue
+        hostname = routers_manager.get_route_frontend_hostname(route)
+        if hostname in targets:
+            continue
+        target_type, instance_id_attr = ROUTE_TARGET_TYPES[route_type]
+        targets[hostname] = {
+            'hostname': hostname,
+            'target-type': target_type,
+            'instance-id': route['spec'][instance_id_attr] if instance_id_attr else route['metadata']['name'],
+        }
+    return list(targets.values())
+
+
+def probe(targets, target_paths=None, measurements=1, concurrency=DEFAULT_CONCURRENCY,
+          timeout=DEFAULT_TIMEOUT_SECONDS, scheme='https'):
+    """Probes the paths of all targets concurrently, returns a row per request with the OUTPUT_FIELDS
+
+    At most concurrency connections are open at the same time, each request uses a new connection so the times
+    include the connection setup, as the clients experience it.
+    """
+    target_paths = dict(DEFAULT_TARGET_PATHS, **(target_paths or {}))
+    requests = [
+        (target, f'{scheme}://{target["hostname"]}{path}', measurement_num)
+        for target in targets
+        for path in target_paths.get(target['target-type'], ['/'])
+        for measurement_num in range(1, measurements + 1)
+    ]
+    start_time = time.time()
+    rows = asyncio.run(_probe_all(requests, concurrency, timeout))
+    logs.info('Probed targets', targets=len(targets), requests=len(rows), concurrency=concurrency,
+              errors=len([row for row in rows if row['status_code'] != 200]),
+              seconds=round(time.time() - start_time, 2))
+    return rows
+
+
+def write_csv(rows, f):
+    writer = csv.DictWriter(f, OUTPUT_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+async def _probe_all(requests, concurrency, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _probe_request(target, url, measurement_num):
+        async with semaphore:
+            try:
+                status_code, ttfb_seconds, total_seconds = await asyncio.wait_for(_get(url), timeout)
+                comments = ''
+            except Exception as e:
+                status_code, ttfb_seconds, total_seconds = 0, None, None
+                comments = f'{type(e).__name__}: {e}'
+        return {
+            'instance_id': target['instance-id'],
+            'pod_name': '',
+            'test_url': url,
+            'measurement_num': measurement_num,
+            'status_code': status_code,
+            'minutes': 0,
+            'seconds': round(total_seconds, 4) if total_seconds is not None else timeout,
+            'comments': comments,
+            'ttfb_seconds': round(ttfb_seconds, 4) if ttfb_seconds is not None else None,
+            'target_type': target['target-type'],
+            'hostname': target['hostname'],
+        }
+
+    return await asyncio.gather(*(_probe_request(*request) for request in requests))
+
+
+async def _get(url):
+    """Makes a GET request, returns a tuple of (status code, seconds to first byte, total seconds)"""
+    url = urlparse(url)
+    https = url.scheme == 'https'
+    path = (url.path or '/') + (f'?{url.query}' if url.query else '')
+    start_time = time.perf_counter()
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or (443 if https else 80),
+                                                   ssl=True if https else None)
+    try:
+        writer.write(
+            f'GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n'
+            f'User-Agent: ckan-cloud-operator-probe\r\nConnection: close\r\n\r\n'.encode()
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        ttfb_seconds = time.perf_counter() - start_time
+        status_code = int(status_line.split()[1])
+        while await reader.read(65536):
+            pass
+        return status_code, ttfb_seconds, time.perf_counter() - start_time
+    finally:
+        writer.close()
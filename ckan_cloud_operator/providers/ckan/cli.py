@@ -74,6 +74,37 @@ def migrate_deis_dbs(old_site_id, db_name, datastore_name, force, rerun, recreat
         )
 
 
+@ckan.command()
+@click.argument('OLD_SITE_IDS', nargs=-1)
+@click.option('--from-file', help='yaml list of old site ids or restore specs '
+                                  '(dicts with db_name, datastore_name, db_import_url, datastore_import_url)')
+@click.option('--workers', type=int, default=db_migration_manager.DEFAULT_BULK_WORKERS)
+@click.option('--import-concurrency', type=int, default=db_migration_manager.DEFAULT_IMPORT_CONCURRENCY,
+              help='maximal number of concurrent Cloud SQL import operations')
+@click.option('--recreate-dbs', is_flag=True)
+@click.option('--instances', is_flag=True, help='run full end-to-end instance migrations, not only the dbs')
+def migrate_bulk(old_site_ids, from_file, workers, import_concurrency, recreate_dbs, instances):
+    """Migrate many sites in parallel, rerun to resume failed or interrupted migrations from the failed step"""
+    sites = list(old_site_ids)
+    if from_file:
+        with open(from_file) as f:
+            sites += yaml.safe_load(f)
+    assert sites, 'no sites to migrate'
+    assert not instances or all(isinstance(site, str) for site in sites), \
+        'restore specs are not supported with --instances, only old site ids'
+    results = db_migration_manager.migrate_bulk(
+        sites, workers=workers, import_concurrency=import_concurrency, recreate_dbs=recreate_dbs,
+        migrate_func=(
+            lambda old_site_id, **kwargs: manager.migrate_deis_instance(old_site_id, rerun=True, recreate_dbs=recreate_dbs)
+        ) if instances else None
+    )
+    logs.print_yaml_dump(results)
+    if all(result['status'] == db_migration_manager.STATUS_SUCCESS for result in results):
+        logs.exit_great_success()
+    else:
+        logs.exit_catastrophic_failure()
+
+
 @ckan.command()
 @click.option('--db-name')
 def migrate_list(db_name):
@@ -1,8 +1,11 @@
 import binascii
+import contextlib
 import os
 import datetime
+import threading
 import traceback
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from ckan_cloud_operator import logs
 from ckan_cloud_operator import kubectl
@@ -31,6 +34,15 @@ from .constants import (
 )
 
 
+DEFAULT_BULK_WORKERS = 4
+
+# Cloud SQL runs one import operation at a time per instance, further imports wait for a slot instead of failing
+DEFAULT_IMPORT_CONCURRENCY = 1
+
+# set by bulk migrations to limit the concurrent Cloud SQL imports
+_import_semaphore = None
+
+
 def initialize(log_kwargs=None, interactive=False):
     log_kwargs = log_kwargs or {}
     logs.info(f'Installing crds', **log_kwargs)
@@ -86,7 +98,7 @@ def delete(name, delete_dbs=False):
         datastore_name = migration.get('spec', {}).get('db-name')
         datastore_ro_name = crds_manager.config_get(CRD_SINGULAR, name, key='datastore-readonly-user-name', is_secret=True, required=False)
         if db_name or datastore_name or datastore_ro_name:
-            with postgres_driver.connect(admin_connection_string) as admin_conn:
+            with postgres_driver.connect(admin_connection_string, pooled=True) as admin_conn:
                 _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name)
     crds_manager.delete(CRD_SINGULAR, name)
 
@@ -94,6 +106,27 @@ def delete(name, delete_dbs=False):
 def migrate_deis_dbs(old_site_id=None, db_name=None, datastore_name=None, force=False, rerun=False, recreate_dbs=False,
                      dbs_suffix=None, skip_create_dbs=False, skip_datastore_import=False,
                      db_import_url=None, datastore_import_url=None, db_prefix=None):
+    migration_name, spec = get_deis_dbs_migration_name_spec(
+        old_site_id, db_name, datastore_name, dbs_suffix=dbs_suffix, skip_datastore_import=skip_datastore_import,
+        db_import_url=db_import_url, datastore_import_url=datastore_import_url, db_prefix=db_prefix
+    )
+    migration = create(
+        name=migration_name,
+        spec=spec,
+        force=force,
+        exists_ok=rerun and not force,
+        delete_dbs=recreate_dbs
+    )
+    yield {'step': 'created-migration-resource',
+           'msg': f'Created the migration custom resource: {migration_name}',
+           'migration-name': migration_name}
+    yield from update(migration, recreate_dbs=recreate_dbs, skip_create_dbs=skip_create_dbs)
+    yield {'step': 'migration-complete', 'msg': f'Migration completed successfully for: {migration_name}', 'status': STATUS_SUCCESS}
+
+
+def get_deis_dbs_migration_name_spec(old_site_id=None, db_name=None, datastore_name=None, dbs_suffix=None,
+                                     skip_datastore_import=False, db_import_url=None, datastore_import_url=None,
+                                     db_prefix=None):
     if not dbs_suffix: dbs_suffix = ''
     if not db_prefix: db_prefix = db_manager.get_default_db_prefix()
     if db_import_url or datastore_import_url:
@@ -120,27 +153,16 @@ def migrate_deis_dbs(old_site_id=None, db_name=None, datastore_name=None, force=
             migration_name = f'dd-{old_site_id}-{db_name}'
         if db_prefix:
             migration_name += f'-{db_prefix}'
-    migration = create(
-        name=migration_name,
-        spec={
-            'type': 'deis-ckan',
-            'old-site-id': old_site_id,
-            'db-name': db_name,
-            'datastore-name': datastore_name,
-            'skip-datastore-import': skip_datastore_import,
-            'db-import-url': db_import_url,
-            'datastore-import-url': datastore_import_url,
-            'db-prefix': db_prefix
-        },
-        force=force,
-        exists_ok=rerun and not force,
-        delete_dbs=recreate_dbs
-    )
-    yield {'step': 'created-migration-resource',
-           'msg': f'Created the migration custom resource: {migration_name}',
-           'migration-name': migration_name}
-    yield from update(migration, recreate_dbs=recreate_dbs, skip_create_dbs=skip_create_dbs)
-    yield {'step': 'migration-complete', 'msg': f'Migration completed successfully for: {migration_name}', 'status': STATUS_SUCCESS}
+    return migration_name, {
+        'type': 'deis-ckan',
+        'old-site-id': old_site_id,
+        'db-name': db_name,
+        'datastore-name': datastore_name,
+        'skip-datastore-import': skip_datastore_import,
+        'db-import-url': db_import_url,
+        'datastore-import-url': datastore_import_url,
+        'db-prefix': db_prefix
+    }
 
 
 def update(migration, recreate_dbs=False, skip_create_dbs=False):
@@ -154,17 +176,26 @@ def update(migration, recreate_dbs=False, skip_create_dbs=False):
             datastore_name = migration['spec']['datastore-name']
             datastore_ro_name = _get_or_create_datastore_readonly_user_name(migration_name, datastore_name)
             db_prefix = migration['spec'].get('db-prefix')
+            if recreate_dbs:
+                migration['spec']['completed-steps'] = []
             if not skip_create_dbs:
-                yield from _create_base_dbs_and_roles(migration_name, db_name, datastore_name, recreate_dbs, datastore_ro_name,
-                                                      db_prefix=db_prefix)
-                yield from _initialize_postgis_extensions(db_name, db_prefix)
-            yield from _import_data(migration['spec']['old-site-id'], db_name, datastore_name,
-                                    skip_datastore_import=migration['spec'].get('skip-datastore-import'),
-                                    db_import_url=migration['spec'].get('db-import-url'),
-                                    datastore_import_url=migration['spec'].get('datastore-import-url'),
-                                    db_prefix=db_prefix)
+                yield from _run_step(migration, 'create-base-dbs-and-roles', lambda: _create_base_dbs_and_roles(
+                    migration_name, db_name, datastore_name, recreate_dbs, datastore_ro_name, db_prefix=db_prefix
+                ))
+                yield from _run_step(migration, 'initialize-postgis',
+                                     lambda: _initialize_postgis_extensions(db_name, db_prefix))
+            import_kwargs = dict(skip_datastore_import=migration['spec'].get('skip-datastore-import'),
+                                 db_import_url=migration['spec'].get('db-import-url'),
+                                 datastore_import_url=migration['spec'].get('datastore-import-url'),
+                                 db_prefix=db_prefix)
+            yield from _run_step(migration, 'import-db-data', lambda: _import_data(
+                migration['spec']['old-site-id'], db_name, datastore_name, skip_datastore=True, **import_kwargs
+            ))
+            yield from _run_step(migration, 'import-datastore-data', lambda: _import_data(
+                migration['spec']['old-site-id'], db_name, datastore_name, skip_db=True, **import_kwargs
+            ))
             migration['spec']['imported-data'] = True
-            kubectl.apply(migration)
+            _apply(migration)
     elif migration_type == 'new-db':
         if migration['spec'].get('created-db'):
             yield {'step': 'created-db', 'msg': 'DB Already created'}
@@ -175,7 +206,7 @@ def update(migration, recreate_dbs=False, skip_create_dbs=False):
             yield from _create_base_dbs_and_roles(migration_name, db_name, None, recreate_dbs, None, db_prefix=db_prefix)
             yield from _initialize_postgis_extensions(db_name, db_prefix)
             migration['spec']['created-db'] = True
-            kubectl.apply(migration)
+            _apply(migration)
     elif migration_type == 'new-datastore':
         if migration['spec'].get('created-datastore'):
             yield {'step': 'created-datastore', 'msg': 'Datastore Already created'}
@@ -186,14 +217,133 @@ def update(migration, recreate_dbs=False, skip_create_dbs=False):
             db_prefix = migration['spec'].get('db-prefix')
             yield from _create_base_dbs_and_roles(migration_name, None, datastore_name, recreate_dbs, datastore_ro_name, db_prefix=db_prefix)
             migration['spec']['created-datastore'] = True
-            kubectl.apply(migration)
+            _apply(migration)
     else:
         raise Exception(f'Unknown migration type: {migration_type}')
 
 
+def migrate_bulk(sites, workers=DEFAULT_BULK_WORKERS, import_concurrency=DEFAULT_IMPORT_CONCURRENCY,
+                 bulk_create_dbs=True, recreate_dbs=False, db_prefix=None, migrate_func=None):
+    """Runs the db migrations of many sites in a bounded worker pool, returns a result per site
+
+    sites: list of old site ids or dicts of migrate_deis_dbs kwargs (e.g. to restore from backup urls)
+    The migrations are resumable - each step is recorded in the migration resource, so a rerun after a failure or
+    an interruption continues from the failed step. The base dbs and roles of all sites are provisioned together
+    before the imports, and at most import_concurrency Cloud SQL imports run at the same time.
+    migrate_func: optional function which runs a full migration of a site, defaults to the dbs migration
+    """
+    sites = [site if isinstance(site, dict) else {'old_site_id': site} for site in sites]
+    for site in sites:
+        site.setdefault('db_prefix', db_prefix)
+    global _import_semaphore
+    _import_semaphore = threading.BoundedSemaphore(import_concurrency) if import_concurrency else None
+    if bulk_create_dbs and not migrate_func:
+        bulk_create_errors = _bulk_create_dbs(sites, recreate_dbs)
+        recreate_dbs = False
+    else:
+        bulk_create_errors = [None] * len(sites)
+
+    def _migrate_site(site, bulk_create_error):
+        result = {'site': site.get('old_site_id') or site.get('db_name'), 'migration-name': None}
+        if bulk_create_error:
+            result.update(status=STATUS_FAILURE, error=bulk_create_error, **{'failed-step': 'create-migration'})
+            return result
+        try:
+            if migrate_func:
+                migrate_func(**site)
+            else:
+                for event in migrate_deis_dbs(**site, rerun=True, recreate_dbs=recreate_dbs):
+                    result['migration-name'] = get_event_migration_created_name(event) or result['migration-name']
+                    logs.info(f'{result["site"]}: {event["step"]}: {event["msg"]}')
+            result['status'] = STATUS_SUCCESS
+        except Exception as e:
+            logs.error(f'{result["site"]}: migration failed: {e}')
+            result.update(status=STATUS_FAILURE, error=str(e))
+            if result['migration-name']:
+                result['failed-step'] = (get(result['migration-name'], required=False) or {}).get('spec', {}).get('failed-step')
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_migrate_site, sites, bulk_create_errors))
+    finally:
+        _import_semaphore = None
+    logs.info('Bulk migration completed', sites=len(sites),
+              failed=len([result for result in results if result['status'] != STATUS_SUCCESS]))
+    return results
+
+
+def _bulk_create_dbs(sites, recreate_dbs):
+    """Provisions the base dbs and roles of all the sites migrations which did not complete this step
+
+    Returns a list of the sites errors (None if the site has no error), a failed site doesn't stop the other sites.
+    If the bulk provisioning fails, the step is not completed and each site migration runs it separately.
+    """
+    errors = [None] * len(sites)
+    migrations = []
+    for i, site in enumerate(sites):
+        try:
+            migration_name, spec = get_deis_dbs_migration_name_spec(**site)
+            migration = create(migration_name, spec, exists_ok=not recreate_dbs, force=recreate_dbs,
+                               delete_dbs=recreate_dbs)
+        except Exception as e:
+            logs.error(f'{site.get("old_site_id") or site.get("db_name")}: failed to create migration: {e}')
+            errors[i] = str(e)
+            continue
+        if 'create-base-dbs-and-roles' not in migration['spec'].get('completed-steps', []) \
+                and not migration['spec'].get('imported-data'):
+            migrations.append(migration)
+    for db_prefix in sorted({migration['spec'].get('db-prefix') or '' for migration in migrations}):
+        prefix_migrations = [migration for migration in migrations
+                             if (migration['spec'].get('db-prefix') or '') == db_prefix]
+        try:
+            create_base_dbs_and_roles_bulk([{'migration-name': migration['spec']['name'],
+                                             'db-name': migration['spec']['db-name'],
+                                             'datastore-name': migration['spec']['datastore-name']}
+                                            for migration in prefix_migrations], db_prefix=db_prefix or None)
+        except Exception as e:
+            logs.error(f'bulk dbs creation failed, the dbs will be created by each site migration: {e}',
+                       db_prefix=db_prefix)
+            continue
+        for migration in prefix_migrations:
+            migration['spec'].setdefault('completed-steps', []).append('create-base-dbs-and-roles')
+            _apply(migration)
+    return errors
+
+
+def _apply(migration):
+    """Applies the changes of a migration resource
+
+    the resource version of a fetched resource is dropped, otherwise it conflicts on the next apply of the resource
+    """
+    migration['metadata'].pop('resourceVersion', None)
+    kubectl.apply(migration)
+
+
+def _run_step(migration, step, func):
+    """Runs a migration step unless it was completed, records the completed or failed step in the migration resource"""
+    completed_steps = migration['spec'].setdefault('completed-steps', [])
+    if step in completed_steps:
+        yield {'step': step, 'msg': 'step already completed'}
+        return
+    try:
+        yield from func()
+    except Exception:
+        migration['spec']['failed-step'] = step
+        _apply(migration)
+        raise
+    completed_steps.append(step)
+    migration['spec'].pop('failed-step', None)
+    _apply(migration)
+
+
 def get_all_dbs_users():
     dbs, users = [], []
-    for migration in crds_manager.get(CRD_SINGULAR)['items']:
+    migrations = crds_manager.get(CRD_SINGULAR)['items']
+    # the migration secrets are fetched with a single request, instead of one request per migration
+    crds_manager.config_prefetch(CRD_SINGULAR, is_secret=True)
+    db_host_port = None
+    for migration in migrations:
         migration_name = migration['spec']['name']
         spec = migration['spec']
         if spec.get('type') == 'deis-ckan':
@@ -202,7 +352,7 @@ def get_all_dbs_users():
             datastore_name = spec['datastore-name']
             db_password, datastore_password, datastore_ro_password = get_dbs_passwords(migration_name, required=False)
             if all([db_password, datastore_password, datastore_ro_password, db_name, datastore_name, datastore_ro_name]):
-                db_host, db_port = db_manager.get_internal_unproxied_db_host_port()
+                db_host, db_port = db_host_port = db_host_port or db_manager.get_internal_unproxied_db_host_port()
                 dbs.append((db_name, db_host, db_port))
                 dbs.append((datastore_name, db_host, db_port))
                 users.append((db_name, db_password))
@@ -212,7 +362,7 @@ def get_all_dbs_users():
             db_name = spec['db-name']
             db_password, _, _ = get_dbs_passwords(migration_name, required=False)
             if db_password:
-                db_host, db_port = db_manager.get_internal_unproxied_db_host_port()
+                db_host, db_port = db_host_port = db_host_port or db_manager.get_internal_unproxied_db_host_port()
                 dbs.append((db_name, db_host, db_port))
                 users.append((db_name, db_password))
         elif spec.get('type') == 'new-datastore':
@@ -220,7 +370,7 @@ def get_all_dbs_users():
             datastore_name = spec['datastore-name']
             _, datastore_password, datastore_ro_password = get_dbs_passwords(migration_name, required=False)
             if datastore_password and datastore_ro_password:
-                db_host, db_port = db_manager.get_internal_unproxied_db_host_port()
+                db_host, db_port = db_host_port = db_host_port or db_manager.get_internal_unproxied_db_host_port()
                 dbs.append((datastore_name, db_host, db_port))
                 users.append((datastore_name, datastore_password))
                 users.append((datastore_ro_name, datastore_ro_password))
@@ -378,35 +528,111 @@ def _initialize_postgis_extensions(db_name, db_prefix):
 
 def _update_db_proxy(db_name, datastore_name, datastore_ro_name, db_password, datastore_password, datastore_ro_password, db_prefix):
     logs.info('Updating db proxy')
-    db_proxy_manager.update(wait_updated=False)
-    ok = False
+    db_proxy_manager.update(wait_updated=True)
+    _wait_db_proxy_connections([(db_name, db_password, db_name),
+                                (datastore_name, datastore_password, datastore_name),
+                                (datastore_ro_name, datastore_ro_password, datastore_name)], db_prefix)
+    yield {'step': 'update-db-proxy',
+           'msg': f'Updated DB Proxy with the new dbs and roles: {db_name}, {datastore_name}, {datastore_ro_name} ({db_prefix})'}
+
+
+def _wait_db_proxy_connections(credentials, db_prefix):
+    """Waits until all the (user, password, db) credentials can connect through the db proxy
+
+    The db proxy update waits until all the proxy pods loaded the updated config, so retries are only needed
+    for transient connection errors
+    """
+    pending_credentials = [(user, password, db) for user, password, db in credentials if user]
     for i in range(5):
-        try:
-            for user, password, db in [(db_name, db_password, db_name),
-                                       (datastore_name, datastore_password, datastore_name),
-                                       (datastore_ro_name, datastore_ro_password, datastore_name)]:
-                if user:
-                    db_manager.check_connection_string(
-                        db_manager.get_external_connection_string(user, password, db, db_prefix=db_prefix)
-                    )
-            ok = True
+        for user, password, db in list(pending_credentials):
+            try:
+                db_manager.check_connection_string(
+                    db_manager.get_external_connection_string(user, password, db, db_prefix=db_prefix)
+                )
+                pending_credentials.remove((user, password, db))
+            except Exception as e:
+                logs.warning(str(e))
+        if not pending_credentials:
             break
-        except Exception as e:
-            logs.warning(str(e))
         logs.info(f'Waiting for connection to db proxy...')
-        # 40 seconds on first iteration - to ensure secret is updated in pgbouncer volume
-        time.sleep(40 if i == 0 else 1)
-        db_proxy_manager.reload()
-        time.sleep(10 if i == 2 else 5)
-    assert ok, 'failed to get connection to db proxy'
-    yield {'step': 'update-db-proxy',
-           'msg': f'Updated DB Proxy with the new dbs and roles: {db_name}, {datastore_name}, {datastore_ro_name} ({db_prefix})'}
+        time.sleep(2)
+    assert not pending_credentials, 'failed to get connection to db proxy'
+
+
+def create_base_dbs_and_roles_bulk(specs, db_prefix=None, recreate_dbs=False, update_db_proxy=True):
+    """Provisions the base dbs and roles of many migrations at once
+
+    specs: list of dicts with migration-name, db-name and datastore-name (each of the dbs is optional)
+    Existence of all dbs and roles is checked with one catalog query, the DDL runs over one admin session,
+    each migration secret is written once and the db proxy is updated once at the end.
+    Returns a list of results per spec with the created dbs and roles
+    """
+    admin_user = db_manager.get_admin_db_user(db_prefix=db_prefix)
+    results, roles, dbs, credentials = [], [], [], []
+    for spec in specs:
+        migration_name, db_name, datastore_name = spec['migration-name'], spec.get('db-name'), spec.get('datastore-name')
+        config, created_keys = _get_or_create_migration_db_config_bulk(migration_name, db_name, datastore_name)
+        datastore_ro_name = config.get('datastore-readonly-user-name')
+        spec_roles = [
+            (name, password_key) for name, password_key in [(db_name, 'database-password'),
+                                                            (datastore_name, 'datastore-password'),
+                                                            (datastore_ro_name, 'datastore-readonly-password')]
+            if name
+        ]
+        roles += [(name, config[password_key]) for name, password_key in spec_roles]
+        dbs += [name for name in (db_name, datastore_name) if name]
+        credentials += [(name, config[password_key], datastore_name if name == datastore_ro_name else name)
+                        for name, password_key in spec_roles]
+        results.append({'migration-name': migration_name, 'db-name': db_name, 'datastore-name': datastore_name,
+                        'datastore-ro-name': datastore_ro_name, 'roles': spec_roles, 'created-keys': created_keys})
+    admin_connection_string = db_manager.get_external_admin_connection_string(db_prefix=db_prefix)
+    with postgres_driver.connect(admin_connection_string, pooled=True) as admin_conn:
+        if recreate_dbs:
+            for result in results:
+                _delete_dbs(admin_conn, result['db-name'], result['datastore-name'], result['datastore-ro-name'])
+        else:
+            _, existing_roles = postgres_driver.get_existing_dbs_and_roles(admin_conn, [name for name, _ in roles])
+            for result in results:
+                for role_name, password_key in result['roles']:
+                    assert role_name not in existing_roles or password_key not in result['created-keys'], \
+                        f'role {role_name} exists but its password was not stored, we cannot know the right password'
+        created_dbs, created_roles = postgres_driver.create_base_dbs_bulk(admin_conn, dbs, roles,
+                                                                          grant_to_user=admin_user)
+    created_dbs, created_roles = set(created_dbs), set(created_roles)
+    for result in results:
+        result['created-dbs'] = [name for name in (result['db-name'], result['datastore-name']) if name in created_dbs]
+        result['created-roles'] = [name for name, _ in result.pop('roles') if name in created_roles]
+    logs.info('Created base dbs and roles', migrations=len(specs), dbs=len(created_dbs), roles=len(created_roles))
+    if update_db_proxy:
+        logs.info('Updating db proxy')
+        db_proxy_manager.update(wait_updated=True)
+        _wait_db_proxy_connections(credentials, db_prefix)
+    return results
+
+
+def _get_or_create_migration_db_config_bulk(migration_name, db_name, datastore_name):
+    """Returns a tuple of (migration db secret values, created keys), the created values are stored in one write"""
+    config = crds_manager.config_get(CRD_SINGULAR, migration_name, is_secret=True, required=False) or {}
+    config = dict(config)
+    created = {}
+    if db_name and not config.get('database-password'):
+        created['database-password'] = _generate_password()
+    if datastore_name:
+        for key in ('datastore-password', 'datastore-readonly-password'):
+            if not config.get(key):
+                created[key] = _generate_password()
+        if not config.get('datastore-readonly-user-name'):
+            created['datastore-readonly-user-name'] = f'{datastore_name}-ro'
+    if created:
+        crds_manager.config_set(CRD_SINGULAR, migration_name, values=created, is_secret=True)
+        config.update(created)
+    return config, sorted(created)
 
 
 def _create_base_dbs_and_roles(migration_name, db_name, datastore_name, recreate_dbs, datastore_ro_name, db_prefix=None):
     logs.info('Creating base DBS')
     admin_connection_string = db_manager.get_external_admin_connection_string(db_prefix=db_prefix)
-    with postgres_driver.connect(admin_connection_string) as admin_conn:
+    with postgres_driver.connect(admin_connection_string, pooled=True) as admin_conn:
         if recreate_dbs:
             _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name)
         if not datastore_name:
@@ -452,22 +678,38 @@ def _delete_dbs(admin_conn, db_name, datastore_name, datastore_ro_name):
 
 def _import_data(old_site_id, db_name, datastore_name, skip_datastore_import=False,
                  db_import_url=None, datastore_import_url=None,
-                 import_user=None, db_prefix=None):
+                 import_user=None, db_prefix=None, skip_db=False, skip_datastore=False):
     if db_import_url or datastore_import_url:
         assert db_import_url and datastore_import_url
         db_url, datastore_url = db_import_url, datastore_import_url
     else:
         db_url, datastore_url = get_db_import_urls(old_site_id)
     assert db_url and (datastore_url or skip_datastore_import), f'failed to find db import urls for old site id {old_site_id}'
-    _gcloudsql().import_db(db_url, db_name, import_user=import_user or db_name, db_prefix=db_prefix)
-    yield {'step': 'import-db-data', 'msg': f'Imported DB: {db_name}'}
-    if skip_datastore_import:
+    if not skip_db:
+        with _import_slot():
+            _gcloudsql().import_db(db_url, db_name, import_user=import_user or db_name, db_prefix=db_prefix)
+        yield {'step': 'import-db-data', 'msg': f'Imported DB: {db_name}'}
+    if skip_datastore:
+        pass
+    elif skip_datastore_import:
         yield {'step': 'import-datastore-data', 'msg': 'skipped'}
     else:
-        _gcloudsql().import_db(datastore_url, datastore_name, import_user=import_user or datastore_name, db_prefix=db_prefix)
+        with _import_slot():
+            _gcloudsql().import_db(datastore_url, datastore_name, import_user=import_user or datastore_name, db_prefix=db_prefix)
         yield {'step': 'import-datastore-data', 'msg': f'Imported Datastore: {datastore_name}'}
 
 
+@contextlib.contextmanager
+def _import_slot():
+    # limits the concurrent Cloud SQL import operations of bulk migrations
+    semaphore = _import_semaphore
+    if semaphore:
+        with semaphore:
+            yield
+    else:
+        yield
+
+
 def _gcloud():
     return providers_manager.get_provider(cluster_provider_submodule)
 
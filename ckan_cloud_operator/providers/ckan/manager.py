@@ -183,16 +183,50 @@ def instance_kind():
     return f'{crd_prefix}{INSTANCE_CRD_KIND_SUFFIX}'
 
 
-def get_all_dbs_users():
+def list_instance_items():
+    """Returns the full instance list items, which can be shared by the get_all_* functions"""
     from ckan_cloud_operator.deis_ckan.instance import DeisCkanInstance
+    return DeisCkanInstance.list(full=True, quick=True, return_list=True)
+
+
+def get_all_dbs_pool_settings(instance_items=None):
+    """Returns the pgbouncer pool settings from the instances db and datastore specs, keyed by db name"""
+    db_pool_settings = {}
+    for item in (list_instance_items() if instance_items is None else instance_items):
+        spec = item['item'].get('spec', {})
+        for db_spec in [spec.get('db'), spec.get('datastore')]:
+            if db_spec and db_spec.get('name') and db_spec.get('pgbouncer'):
+                db_pool_settings[db_spec['name']] = db_spec['pgbouncer']
+    return db_pool_settings
+
+
+def get_all_db_instance_ids(instance_items=None):
+    """Returns the instance id which uses each db, keyed by db name"""
+    db_instance_ids = {}
+    for item in (list_instance_items() if instance_items is None else instance_items):
+        spec = item['item'].get('spec', {})
+        for db_spec in [spec.get('db'), spec.get('datastore')]:
+            if db_spec and db_spec.get('name'):
+                db_instance_ids[db_spec['name']] = item['id']
+    return db_instance_ids
+
+
+def get_all_dbs_users(instance_items=None):
+    from ckan_cloud_operator.deis_ckan.instance import DeisCkanInstance
+    from ckan_cloud_operator.deis_ckan import annotations as deis_ckan_annotations
     from ckan_cloud_operator.providers.db import manager as db_manager
     dbs, users = [], []
     db_host, db_port = db_manager.get_internal_unproxied_db_host_port()
     instance_db_names = []
     instance_user_names = []
-    for item in DeisCkanInstance.list(quick=True, return_list=True):
+    # the listed instance values are reused and the annotations secrets of all instances are fetched in one request,
+    # secrets which are not labeled yet are fetched one by one and labeled
+    annotations_secrets = deis_ckan_annotations.prefetch_secrets()
+    for item in (list_instance_items() if instance_items is None else instance_items):
         instance_id = item['id']
-        instance = DeisCkanInstance(instance_id)
+        instance = DeisCkanInstance(instance_id, values=item['item'])
+        if instance_id in annotations_secrets:
+            instance.annotations.set_prefetched_secret(annotations_secrets[instance_id])
         spec = instance.spec
         db_name = spec.db['name']
         db_password = instance.annotations.get_secret('databasePassword')
@@ -200,6 +234,8 @@ def get_all_dbs_users():
         datastore_password = instance.annotations.get_secret('datastorePassword')
         datastore_ro_user = instance.annotations.get_secret('datastoreReadonlyUser')
         datastore_ro_password = instance.annotations.get_secret('datatastoreReadonlyPassword')
+        if instance_id not in annotations_secrets and db_password:
+            instance.annotations.label_secret()
         if all([db_name, db_password, datastore_name, datastore_password, datastore_ro_user, datastore_ro_password]):
             dbs.append((db_name, db_host, db_port))
             dbs.append((datastore_name, db_host, db_port))
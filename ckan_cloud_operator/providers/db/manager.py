@@ -36,14 +36,19 @@ def update():
 def get_all_db_names(db_prefix=None):
     return get_provider().get_all_db_namees(db_prefix=db_prefix)
 
-def get_all_dbs_users():
+def list_instance_items():
+    """List the instances once, to share the list between the get_all_* functions"""
+    return ckan_manager.list_instance_items()
+
+
+def get_all_dbs_users(instance_items=None):
     """Get a list of all databases and users, this is used by PgBouncer"""
     all_db_names, all_user_names, duplicate_db_names, duplicate_user_names = {}, {}, set(), set()
     all_dbs = []
     all_users = []
     for dbs_users in [
         _get_admin_dbs_users(),
-        ckan_manager.get_all_dbs_users()
+        ckan_manager.get_all_dbs_users(instance_items=instance_items)
     ]:
         dbs, users = dbs_users
         for db in dbs:
@@ -68,6 +73,16 @@ def get_all_dbs_users():
     return all_dbs, all_users
 
 
+def get_all_dbs_pool_settings(instance_items=None):
+    """Get the per-db pool settings which are set in the instance specs, this is used by PgBouncer"""
+    return ckan_manager.get_all_dbs_pool_settings(instance_items=instance_items)
+
+
+def get_all_db_instance_ids(instance_items=None):
+    """Get the instance id which uses each db, this is used by the PgBouncer metrics"""
+    return ckan_manager.get_all_db_instance_ids(instance_items=instance_items)
+
+
 def get_admin_db_credentials(db_prefix=None):
     db_provider_manager = get_provider()
     admin_user, admin_password, db_name = db_provider_manager.get_postgres_admin_credentials(db_prefix=db_prefix)
@@ -208,12 +223,13 @@ def get_provider():
 
 def check_db_exists(db_name, db_prefix=None):
     admin_connection_string = get_external_admin_connection_string(db_prefix=db_prefix)
-    with postgres_driver.connect(admin_connection_string) as admin_conn:
+    with postgres_driver.connect(admin_connection_string, pooled=True) as admin_conn:
         return len(list(postgres_driver.list_roles(admin_conn, role_name=db_name))) > 0
 
 
 def check_connection_string(connection_string):
-    with postgres_driver.connect(connection_string) as conn:
+    # not pooled, so that the check always logs in
+    with postgres_driver.connect(connection_string, pooled=False) as conn:
         with conn.cursor() as cur:
             cur.execute('select 1')
 
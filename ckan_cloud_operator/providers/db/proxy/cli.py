@@ -8,6 +8,8 @@ from ckan_cloud_operator import logs
 from . import manager
 
 from .gcloudsql import cli as gcloudsql_proxy_cli
+from .pgbouncer import cli as pgbouncer_proxy_cli
+from .pgbouncer import metrics as pgbouncer_metrics
 from ckan_cloud_operator.config import manager as config_manager
 
 
@@ -18,14 +20,16 @@ def proxy():
 
 
 proxy.add_command(gcloudsql_proxy_cli.gcloudsql)
+proxy.add_command(pgbouncer_proxy_cli.pgbouncer)
 
 
 @proxy.command()
 @click.option('--db-prefix')
 @click.option('--all-daemon')
-def port_forward(db_prefix, all_daemon):
+@click.option('--pod-name', help='port-forward to a specific proxy pod, instead of any pod of the deployment')
+def port_forward(db_prefix, all_daemon, pod_name):
     if all_daemon:
-        assert not db_prefix and all_daemon == 'I know the risks'
+        assert not db_prefix and not pod_name and all_daemon == 'I know the risks'
         subprocess.Popen(['ckan-cloud-operator', 'db', 'proxy', 'port-forward'], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
         for db_prefix in manager.get_provider().get_all_db_prefixes():
             subprocess.Popen(['ckan-cloud-operator', 'db', 'proxy', 'port-forward', '--db-prefix', db_prefix],
@@ -34,7 +38,7 @@ def port_forward(db_prefix, all_daemon):
         while True:
             start_time = datetime.datetime.now()
             try:
-                manager.start_port_forward(db_prefix=db_prefix)
+                manager.start_port_forward(db_prefix=db_prefix, pod_name=pod_name)
             except Exception:
                 traceback.print_exc()
             end_time = datetime.datetime.now()
@@ -64,6 +68,35 @@ def proxy_update(verify_instance_id, set_pool_mode, reload):
     logs.exit_great_success()
 
 
+@proxy.command()
+@click.option('--db-prefix')
+@click.option('--from-config-path', help='collect from a pgbouncer pod using the mounted pgbouncer config directory')
+@click.option('--no-server-metrics', is_flag=True, help='do not collect the pg_stat_database metrics')
+@click.option('--serve', is_flag=True, help='serve the metrics for prometheus on /metrics')
+@click.option('--port', type=int, default=pgbouncer_metrics.DEFAULT_EXPORTER_PORT)
+def metrics(db_prefix, from_config_path, no_server_metrics, serve, port):
+    """Get the pgbouncer pools and backing postgres databases metrics in the Prometheus text format
+
+    without --from-config-path the metrics are collected via the proxy port-forward
+    """
+    def get_text():
+        return pgbouncer_metrics.get_text(db_prefix=db_prefix, from_config_path=from_config_path,
+                                          with_server_metrics=not no_server_metrics)
+
+    if serve:
+        pgbouncer_metrics.serve(get_text, port=port)
+    else:
+        print(get_text(), end='')
+
+
+@proxy.command()
+@click.option('--force', is_flag=True, help='reload all the proxy pods, even those which loaded the current config')
+def reload(force):
+    """Reload the proxy pods which did not load the current config"""
+    manager.reload(force=force)
+    logs.exit_great_success()
+
+
 @proxy.command()
 def initialize():
     manager.initialize()
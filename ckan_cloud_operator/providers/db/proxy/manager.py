@@ -7,16 +7,20 @@ def initialize():
     get_provider(default=gcloudsql_provider_id).initialize()
 
 
-def start_port_forward(db_prefix=None):
-    get_provider().start_port_forward(db_prefix=db_prefix)
+def start_port_forward(db_prefix=None, pod_name=None):
+    if pod_name:
+        # only supported by proxy providers which run multiple pods
+        get_provider().start_port_forward(db_prefix=db_prefix, pod_name=pod_name)
+    else:
+        get_provider().start_port_forward(db_prefix=db_prefix)
 
 
 def update(wait_updated=False, set_pool_mode=None):
     get_provider().update(wait_updated=wait_updated, set_pool_mode=set_pool_mode)
 
 
-def reload():
-    get_provider().reload()
+def reload(force=False):
+    get_provider().reload(force=force)
 
 
 def get_provider(default=None, required=True):
@@ -0,0 +1,71 @@
+import click
+import yaml
+
+from ckan_cloud_operator import logs
+
+from . import manager
+
+
+@click.group()
+def pgbouncer():
+    """Manage the pgbouncer centralized db proxy"""
+    pass
+
+
+@pgbouncer.command()
+@click.option('--db-prefix', help='deploy a pgbouncer for the dbs hosted on the prefix db instance')
+@click.option('--replicas', type=int, help='number of pgbouncer pods, the pods are spread across nodes')
+@click.option('--metrics-exporter', type=click.Choice(['y', 'n']),
+              help='add a prometheus metrics exporter sidecar to each pgbouncer pod')
+def initialize(db_prefix, replicas, metrics_exporter):
+    manager.initialize(db_prefix=db_prefix, replicas=replicas, metrics_exporter=metrics_exporter)
+    logs.exit_great_success()
+
+
+@pgbouncer.command()
+@click.option('--db-prefix')
+def pods(db_prefix):
+    """List the pgbouncer pods with the config version each pod loaded"""
+    print(yaml.dump({
+        'config-version': manager.get_config_version(db_prefix),
+        'pods': manager.get_pods_config_versions(db_prefix)
+    }, default_flow_style=False))
+
+
+@pgbouncer.command()
+@click.argument('DB_NAME')
+@click.option('--pool-size', type=int)
+@click.option('--reserve-pool', type=int)
+@click.option('--max-db-connections', type=int)
+def set_db_pool(db_name, pool_size, reserve_pool, max_db_connections):
+    """Set the pool settings of a db, without any settings the db uses the instance spec or the default pool"""
+    manager.set_db_pool_settings(db_name, {'pool_size': pool_size, 'reserve_pool': reserve_pool,
+                                           'max_db_connections': max_db_connections})
+    logs.info('Run db proxy proxy-update --reload to apply the updated pool settings')
+    logs.exit_great_success()
+
+
+@pgbouncer.command()
+def get_db_pools():
+    """Get the per-db pool settings from the instance specs and the tuning configmap"""
+    print(yaml.dump(manager.get_db_pool_settings(), default_flow_style=False))
+
+
+@pgbouncer.command()
+@click.option('--db-prefix')
+@click.option('--samples', type=int, default=1, help='number of SHOW POOLS samples, the busiest sample is used')
+@click.option('--interval-seconds', type=int, default=5)
+@click.option('--apply', is_flag=True, help='set the suggested pool settings in the tuning configmap')
+def suggest_db_pools(db_prefix, samples, interval_seconds, apply):
+    """Suggest per-db pool settings from the admin console SHOW POOLS and SHOW STATS
+
+    requires a port-forward to the pgbouncer, the settings apply to each pgbouncer pod
+    """
+    pools_samples, stats = manager.get_pools_samples(db_prefix, samples=samples, interval_seconds=interval_seconds)
+    db_pool_settings = manager.suggest_db_pool_settings(pools_samples, stats)
+    print(yaml.dump(db_pool_settings, default_flow_style=False))
+    if apply:
+        for db_name, pool_settings in db_pool_settings.items():
+            manager.set_db_pool_settings(db_name, pool_settings)
+        logs.info('Run db proxy proxy-update --reload to apply the updated pool settings')
+        logs.exit_great_success()
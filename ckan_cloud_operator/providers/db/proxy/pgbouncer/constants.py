@@ -1 +1,4 @@
 PROVIDER_ID='pgbouncer'
+
+# per-database pool settings which can be set in the [databases] section, see https://pgbouncer.github.io/config.html
+DB_POOL_SETTINGS = ['pool_size', 'reserve_pool', 'max_db_connections']
@@ -1,13 +1,13 @@
 #### standard provider code ####
 
 # import the correct PROVIDER_SUBMODULE and PROVIDER_ID constants for your provider
-from ckan_cloud_operator.providers.db.proxy.pgbouncer.constants import PROVIDER_ID
+from ckan_cloud_operator.providers.db.proxy.pgbouncer.constants import PROVIDER_ID, DB_POOL_SETTINGS
 from ckan_cloud_operator.providers.db.proxy.constants import PROVIDER_SUBMODULE
 
 # define common provider functions based on the constants
 from ckan_cloud_operator.providers import manager as providers_manager
 def _get_resource_name(suffix=None): return providers_manager.get_resource_name(PROVIDER_SUBMODULE, PROVIDER_ID, suffix=suffix)
-def _get_resource_labels(for_deployment=False): return providers_manager.get_resource_labels(PROVIDER_SUBMODULE, PROVIDER_ID, for_deployment=for_deployment)
+def _get_resource_labels(for_deployment=False, suffix=None): return providers_manager.get_resource_labels(PROVIDER_SUBMODULE, PROVIDER_ID, for_deployment=for_deployment, suffix=suffix)
 def _get_resource_annotations(suffix=None): return providers_manager.get_resource_annotations(PROVIDER_SUBMODULE, PROVIDER_ID, suffix=suffix)
 def _set_provider(): providers_manager.set_provider(PROVIDER_SUBMODULE, PROVIDER_ID)
 def _config_set(key=None, value=None, values=None, namespace=None, is_secret=False, suffix=None): providers_manager.config_set(PROVIDER_SUBMODULE, PROVIDER_ID, key=key, value=value, values=values, namespace=namespace, is_secret=is_secret, suffix=suffix)
@@ -21,93 +21,358 @@ def _config_get_volume_spec(volume_name, is_secret=False, suffix=None): return p
 
 import time
 import os
+import math
+import hashlib
 import subprocess
 import traceback
+import yaml
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from distutils.util import strtobool
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
 
+from ckan_cloud_operator.drivers.postgres import driver as postgres_driver
 from ckan_cloud_operator.providers.db import manager as db_manager
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
 
 
-def initialize():
-    _apply_config_secret(force=True)
-    _apply_service()
-    _apply_deployment()
-    _set_provider()
+def initialize(db_prefix=None, replicas=None, metrics_exporter=None):
+    """Deploys the pgbouncer, a prefixed pgbouncer serves the dbs which are hosted on the prefix db instance
+
+    metrics_exporter - 'y' to add a prometheus metrics exporter sidecar to each pod, 'n' to remove it
+    """
+    assert db_prefix != TUNING_CONFIG_SUFFIX, f'invalid db prefix: {db_prefix}'
+    if replicas:
+        _config_set('replicas', str(replicas), suffix=db_prefix)
+    if metrics_exporter:
+        _config_set('metrics-exporter', metrics_exporter, suffix=db_prefix)
+    if db_prefix:
+        _config_interactive_set({
+            'port-forwarded-port': '5433'
+        }, suffix=db_prefix)
+    _apply_config_secret(force=True, db_prefix=db_prefix)
+    _apply_service(db_prefix)
+    _apply_deployment(db_prefix)
+    _apply_pod_disruption_budget(db_prefix)
+    if not db_prefix:
+        _set_provider()
+    else:
+        db_prefixes = get_all_db_prefixes()
+        if db_prefix not in db_prefixes:
+            db_prefixes.append(db_prefix)
+            _config_set('all-db-prefixes', ','.join(db_prefixes))
+
+
+def get_all_db_prefixes():
+    prefixes = _config_get('all-db-prefixes')
+    if prefixes:
+        return prefixes.split(',')
+    else:
+        return []
+
+
+# the config secret is mounted to the pods, kubelet syncs updated secrets to the volume within a minute or two
+CONFIG_PATH = '/var/local/pgbouncer'
+
+# each pod records the config version it reloaded, so the operator knows when all pods use the updated config
+LOADED_CONFIG_VERSION_PATH = '/var/run/pgbouncer/loaded-config-version'
+
+WAIT_UPDATED_TIMEOUT_SECONDS = 300
+WAIT_UPDATED_INTERVAL_SECONDS = 2
+
+# max number of pods which are reloaded concurrently
+RELOAD_MAX_WORKERS = 10
+
+# the pods are spread across nodes, the replicas can be set per db prefix using initialize
+DEFAULT_REPLICAS = 1
+
+# configmap with per-db pool settings, keys are db names, values are pgbouncer settings
+# e.g. "pool_size=20 reserve_pool=5", these settings override the pool settings in the instance specs
+TUNING_CONFIG_SUFFIX = 'tuning'
+
+# config secret key with the details used by the metrics exporter sidecar, see metrics.py
+CONFIG_METRICS_KEY = 'metrics.yaml'
+
+METRICS_EXPORTER_PORT = 9127
+
+# the pgbouncer admin console is a virtual db, the operator db admin user is configured in admin_users
+ADMIN_CONSOLE_DB_NAME = 'pgbouncer'
+
+# the suggested pool size covers the busiest observed concurrency with some headroom
+SUGGEST_POOL_HEADROOM = 1.5
+SUGGEST_MIN_POOL_SIZE = 2
+SUGGEST_MAX_POOL_SIZE = 50
 
 
 def update(wait_updated=False, set_pool_mode=None):
     if set_pool_mode:
         _config_set('pool-mode', set_pool_mode)
-    _apply_config_secret()
-    if wait_updated:
-        logs.info('Waiting 1 minute for pgbouncer secret to be updated...')
-        time.sleep(60)
-        reload()
+    for db_prefix in [None, *get_all_db_prefixes()]:
+        config_version, _ = _apply_config_secret(db_prefix=db_prefix)
+        if wait_updated:
+            # pods which already loaded this config version are not reloaded
+            wait_config_version(config_version, db_prefix=db_prefix)
+
+
+def reload(force=False):
+    """Reloads the pods which did not load the current config version, or all the pods if force is set"""
+    for db_prefix in [None, *get_all_db_prefixes()]:
+        if not force:
+            wait_config_version(db_prefix=db_prefix)
+        else:
+            logs.info('Reloading pgbouncers...', db_prefix=db_prefix)
+            pod_names = get_pod_names(db_prefix)
+            with ThreadPoolExecutor(max_workers=RELOAD_MAX_WORKERS) as executor:
+                for pod_name, _ in zip(pod_names, executor.map(_reload_pod, pod_names)):
+                    logs.info(f'{pod_name}: PgBouncer Reloaded')
+
+
+def get_config_version(db_prefix=None):
+    return _config_get('config-version', is_secret=True, suffix=db_prefix)
+
+
+def get_pods_config_versions(db_prefix=None):
+    """Returns the config version which each pod reloaded, None if it was not reloaded since it started"""
+    return {
+        pod_name: kubectl.check_output(
+            f'exec {pod_name} -- sh -c "cat {LOADED_CONFIG_VERSION_PATH} 2>/dev/null || true"'
+        ).decode().strip() or None
+        for pod_name in get_pod_names(db_prefix)
+    }
+
+
+def wait_config_version(config_version=None, timeout=WAIT_UPDATED_TIMEOUT_SECONDS, db_prefix=None):
+    """Reloads each pod as soon as the config version is synced to its volume, returns when all pods reloaded it
+
+    pods are checked and reloaded in parallel, pods which already loaded the config version are not reloaded
+    """
+    if not config_version:
+        config_version = get_config_version(db_prefix)
+    start_time = time.time()
+    pending_pod_names = set(get_pod_names(db_prefix))
+    logs.info('Waiting for pgbouncers to load the config', config_version=config_version, pods=len(pending_pod_names))
+    with ThreadPoolExecutor(max_workers=RELOAD_MAX_WORKERS) as executor:
+        while pending_pod_names:
+            pod_names = sorted(pending_pod_names)
+            for pod_name, loaded in zip(pod_names, executor.map(
+                lambda pod_name: _reload_pod_config_version(pod_name, config_version), pod_names
+            )):
+                if loaded:
+                    logs.info(f'{pod_name}: PgBouncer loaded config version {config_version}')
+                    pending_pod_names.remove(pod_name)
+            if pending_pod_names:
+                assert time.time() - start_time < timeout, \
+                    f'timed out waiting for pgbouncers to load config version {config_version}: {pending_pod_names}'
+                time.sleep(WAIT_UPDATED_INTERVAL_SECONDS)
+    logs.info('All pgbouncers loaded the config', config_version=config_version,
+              seconds=round(time.time() - start_time, 1))
+
+
+def get_config_metrics(db_prefix=None):
+    return yaml.safe_load(_config_get(CONFIG_METRICS_KEY, is_secret=True, suffix=db_prefix) or '') or {}
+
+
+def get_db_pool_settings(instance_items=None):
+    """Returns the per-db pool settings from the instance specs, overridden by the tuning configmap"""
+    db_pool_settings = {
+        db_name: dict(pool_settings)
+        for db_name, pool_settings in db_manager.get_all_dbs_pool_settings(instance_items=instance_items).items()
+    }
+    for db_name, value in (_config_get(suffix=TUNING_CONFIG_SUFFIX) or {}).items():
+        if value:
+            db_pool_settings.setdefault(db_name, {}).update(_parse_db_pool_settings(value))
+    return {
+        db_name: {setting: int(value) for setting, value in pool_settings.items()}
+        for db_name, pool_settings in db_pool_settings.items()
+        if pool_settings
+    }
+
 
+def set_db_pool_settings(db_name, pool_settings):
+    """Sets the db pool settings in the tuning configmap, empty settings remove the db tuning"""
+    value = ' '.join(
+        f'{setting}={int(pool_settings[setting])}'
+        for setting in DB_POOL_SETTINGS if pool_settings.get(setting) is not None
+    )
+    _config_set(values={db_name: value}, suffix=TUNING_CONFIG_SUFFIX)
 
-def reload():
-    deployment_app = _get_resource_labels(for_deployment=True)['app']
-    logs.info('Reloading pgbouncers...')
-    for pod_name in kubectl.check_output(
-            f'get pods -l app={deployment_app} --output=custom-columns=name:.metadata.name --no-headers'
-    ).decode().splitlines():
-        kubectl.check_call(f'exec {pod_name} -- pgbouncer -q -u pgbouncer -d -R /var/local/pgbouncer/pgbouncer.ini')
-        logs.info(f'{pod_name}: PgBouncer Reloaded')
 
+@contextmanager
+def connect_admin_console(db_prefix=None):
+    connection_string = db_manager.get_external_admin_connection_string(db_name=ADMIN_CONSOLE_DB_NAME,
+                                                                        db_prefix=db_prefix)
+    # the admin console does not support transactions or the pool health checks
+    with postgres_driver.connect(connection_string, pooled=False) as admin_conn:
+        admin_conn.autocommit = True
+        yield admin_conn
 
-def get_internal_proxy_host_port():
+
+def show(admin_conn, command):
+    """Returns the rows of an admin console SHOW command as dicts, e.g. show(admin_conn, 'POOLS')"""
+    with admin_conn.cursor() as cur:
+        cur.execute(f'SHOW {command}')
+        field_names = [column[0] for column in cur.description]
+        return [dict(zip(field_names, row)) for row in cur]
+
+
+def get_pools_samples(db_prefix=None, samples=1, interval_seconds=5):
+    """Returns (pools_samples, stats), a list of SHOW POOLS results and the SHOW STATS result at the end"""
+    pools_samples = []
+    with connect_admin_console(db_prefix) as admin_conn:
+        for sample_num in range(samples):
+            if sample_num > 0:
+                time.sleep(interval_seconds)
+            pools_samples.append(show(admin_conn, 'POOLS'))
+        stats = show(admin_conn, 'STATS')
+    return pools_samples, stats
+
+
+def suggest_db_pool_settings(pools_samples, stats, headroom=SUGGEST_POOL_HEADROOM,
+                             min_pool_size=SUGGEST_MIN_POOL_SIZE, max_pool_size=SUGGEST_MAX_POOL_SIZE):
+    """Suggests per-db pool settings from SHOW POOLS samples and SHOW STATS of a single pgbouncer pod
+
+    the required server connections are the busier of the most active and waiting clients in a sample,
+    and the average concurrent transactions (transactions per second * average transaction time)
+    """
+    required_connections = {}
+    for pools in pools_samples:
+        sample_connections = {}
+        for pool in pools:
+            db_name = pool['database']
+            connections = int(pool['sv_active']) + int(pool['cl_waiting'])
+            sample_connections[db_name] = sample_connections.get(db_name, 0) + connections
+        for db_name, connections in sample_connections.items():
+            required_connections[db_name] = max(required_connections.get(db_name, 0), connections)
+    for db_stats in stats:
+        db_name = db_stats['database']
+        # avg_xact_time is in microseconds
+        concurrent_transactions = int(db_stats['avg_xact_count']) * int(db_stats['avg_xact_time']) / 1000000
+        required_connections[db_name] = max(required_connections.get(db_name, 0), concurrent_transactions)
+    db_pool_settings = {}
+    for db_name, connections in sorted(required_connections.items()):
+        if db_name == ADMIN_CONSOLE_DB_NAME:
+            continue
+        pool_size = min(max_pool_size, max(min_pool_size, math.ceil(connections * headroom)))
+        reserve_pool = math.ceil(pool_size / 4)
+        db_pool_settings[db_name] = {
+            'pool_size': pool_size,
+            'reserve_pool': reserve_pool,
+            'max_db_connections': pool_size + reserve_pool,
+        }
+    return db_pool_settings
+
+
+def _parse_db_pool_settings(value):
+    pool_settings = {}
+    for setting_value in value.split():
+        setting, setting_value = setting_value.split('=')
+        assert setting in DB_POOL_SETTINGS, f'invalid pool setting: {setting}, valid settings: {DB_POOL_SETTINGS}'
+        pool_settings[setting] = int(setting_value)
+    return pool_settings
+
+
+def _reload_pod_config_version(pod_name, config_version):
+    # succeeds if the pod already loaded the version, or the version was synced to the volume and the pod was reloaded
+    script = ' && '.join([
+        f'if [ "$(cat {LOADED_CONFIG_VERSION_PATH} 2>/dev/null)" = "{config_version}" ]; then exit 0; fi',
+        f'[ "$(cat {CONFIG_PATH}/config-version 2>/dev/null)" = "{config_version}" ]',
+        f'pgbouncer -q -u pgbouncer -d -R {CONFIG_PATH}/pgbouncer.ini',
+        f'echo {config_version} > {LOADED_CONFIG_VERSION_PATH}',
+    ])
+    return kubectl.call(f"exec {pod_name} -- sh -c '{script}'") == 0
+
+
+def _reload_pod(pod_name):
+    # reloads whichever config version is currently synced to the pod volume
+    script = ' && '.join([
+        f'pgbouncer -q -u pgbouncer -d -R {CONFIG_PATH}/pgbouncer.ini',
+        f'(cat {CONFIG_PATH}/config-version > {LOADED_CONFIG_VERSION_PATH} 2>/dev/null || true)',
+    ])
+    kubectl.check_call(f"exec {pod_name} -- sh -c '{script}'")
+
+
+def get_pod_names(db_prefix=None):
+    deployment_app = _get_resource_labels(for_deployment=True, suffix=db_prefix)['app']
+    return kubectl.check_output(
+        f'get pods -l app={deployment_app} --output=custom-columns=name:.metadata.name --no-headers'
+    ).decode().splitlines()
+
+
+def get_internal_proxy_host_port(db_prefix=None):
     namespace = cluster_manager.get_operator_namespace_name()
-    service_name = _get_resource_name()
+    service_name = _get_resource_name(suffix=db_prefix)
     return f'{service_name}.{namespace}', 5432
 
 
-def get_external_proxy_host_port():
+def get_external_proxy_host_port(db_prefix=None):
     if strtobool(os.environ.get('CKAN_CLOUD_OPERATOR_USE_PROXY', 'y')):
-        host, port = get_external_proxy_forwarded_host_port()
+        host, port = get_external_proxy_forwarded_host_port(db_prefix)
     else:
         host, port = None, None
     return host, port
 
 
-def get_external_proxy_forwarded_host_port():
-    return '127.0.0.1', 5432
+def get_external_proxy_forwarded_host_port(db_prefix=None):
+    return '127.0.0.1', get_port_forwarded_port(db_prefix)
 
 
-def start_port_forward():
-    """Starts a local proxy to the cloud SQL instance"""
+def get_port_forwarded_port(db_prefix=None):
+    if db_prefix:
+        return _config_get(key='port-forwarded-port', suffix=db_prefix)
+    else:
+        return 5432
+
+
+def start_port_forward(db_prefix=None, pod_name=None):
+    """Starts a local proxy to the pgbouncer deployment, or to a specific pgbouncer pod"""
     print("\nKeep this running in the background\n")
     namespace = cluster_manager.get_operator_namespace_name()
-    deployment_name = _get_resource_name()
-    subprocess.check_call(f'kubectl -n {namespace} port-forward deployment/{deployment_name} 5432',
+    target = f'pod/{pod_name}' if pod_name else f'deployment/{_get_resource_name(suffix=db_prefix)}'
+    port = get_port_forwarded_port(db_prefix)
+    subprocess.check_call(f'kubectl -n {namespace} port-forward {target} {port}:5432',
                           shell=True)
 
 
-def _apply_config_secret(force=False):
+def _apply_config_secret(force=False, db_prefix=None):
+    """Renders the config and saves it to the config secret if it changed, returns (config_version, changed)"""
     update_dbs = {}
     update_users = {}
+    db_admin_user, db_admin_password, db_admin_db_name = db_manager.get_admin_db_credentials(db_prefix=db_prefix)
     try:
-        dbs, users = db_manager.get_all_dbs_users()
+        # the instances are listed once for all the config sections
+        instance_items = db_manager.list_instance_items()
+        dbs, users = db_manager.get_all_dbs_users(instance_items=instance_items)
+        if db_prefix:
+            db_host, db_port = db_manager.get_internal_unproxied_db_host_port(db_prefix=db_prefix)
+            dbs = [db for db in dbs if (db[1], str(db[2])) == (db_host, str(db_port))]
+            # the dbs users include only the admin of the default db instance
+            dbs = [db for db in dbs if db[0] != db_admin_db_name] + [(db_admin_db_name, db_host, db_port)]
+            users = [user for user in users if user[0] != db_admin_user] + [(db_admin_user, db_admin_password)]
+        db_pool_settings = get_db_pool_settings(instance_items)
+        db_instance_ids = db_manager.get_all_db_instance_ids(instance_items=instance_items)
     except Exception:
         if force:
             traceback.print_exc()
-            dbs, users = [], []
+            dbs, users, db_pool_settings, db_instance_ids = [], [], {}, {}
         else:
             raise
     for db_name, db_host, db_port in dbs:
         assert db_name not in update_dbs
-        update_dbs[db_name] = f'{db_name} = host={db_host} port={db_port} dbname={db_name}'
+        pool_settings = db_pool_settings.get(db_name, {})
+        update_dbs[db_name] = ' '.join([
+            f'{db_name} = host={db_host} port={db_port} dbname={db_name}',
+            *(f'{setting}={pool_settings[setting]}' for setting in DB_POOL_SETTINGS if setting in pool_settings)
+        ])
     for name, password in users:
         assert name not in users
         update_users[name] = password
     pg_bouncer_ini = ["[databases]"]
     for db_name, line in update_dbs.items():
         pg_bouncer_ini.append(line)
-    db_admin_user, _, _ = db_manager.get_admin_db_credentials()
     # see https://pgbouncer.github.io/config.html
     pool_mode = _config_get('pool-mode', 'transaction')
     pg_bouncer_ini += [
@@ -142,27 +407,76 @@ def _apply_config_secret(force=False):
     users_txt = []
     for name, password in update_users.items():
         users_txt.append(f'"{name}" "{password}"')
+    server_host, server_port = db_manager.get_internal_unproxied_db_host_port(db_prefix=db_prefix)
     updated_secret = {
         'pgbouncer.ini': "\n".join(pg_bouncer_ini),
-        'users.txt': "\n".join(users_txt)
+        'users.txt': "\n".join(users_txt),
+        CONFIG_METRICS_KEY: yaml.safe_dump({
+            'server-host': server_host,
+            'server-port': int(server_port),
+            'server-db-name': db_admin_db_name,
+            'db-instance-ids': {
+                db_name: instance_id
+                for db_name, instance_id in db_instance_ids.items()
+                if db_name in update_dbs
+            },
+        }, default_flow_style=False),
     }
-    _config_set(values=updated_secret, is_secret=True)
+    config_version = updated_secret['config-version'] = _get_config_version(updated_secret)
+    if not force and config_version == get_config_version(db_prefix):
+        logs.info('PgBouncer config is unchanged', config_version=config_version, db_prefix=db_prefix)
+        return config_version, False
+    _config_set(values=updated_secret, is_secret=True, suffix=db_prefix)
+    logs.info('PgBouncer config updated', config_version=config_version, db_prefix=db_prefix,
+              dbs=len(update_dbs), users=len(update_users))
+    return config_version, True
+
+
+def _get_config_version(config):
+    config_hash = hashlib.sha256()
+    for key in sorted(config):
+        config_hash.update(f'{key}\n{config[key]}\n'.encode())
+    return config_hash.hexdigest()[:16]
 
 
-def _apply_deployment():
+def _apply_deployment(db_prefix=None):
+    labels = _get_resource_labels(for_deployment=True, suffix=db_prefix)
+    with_metrics_exporter = _config_get('metrics-exporter', suffix=db_prefix) == 'y'
     kubectl.apply(kubectl.get_deployment(
-        _get_resource_name(),
-        _get_resource_labels(for_deployment=True),
+        _get_resource_name(suffix=db_prefix),
+        labels,
         {
-            'replicas': 1,
+            'replicas': int(_config_get('replicas', DEFAULT_REPLICAS, suffix=db_prefix)),
             'revisionHistoryLimit': 10,
             'strategy': {'type': 'RollingUpdate', },
             'template': {
                 'metadata': {
-                    'labels': _get_resource_labels(for_deployment=True),
-                    'annotations': _get_resource_annotations()
+                    'labels': labels,
+                    'annotations': {
+                        **_get_resource_annotations(suffix=db_prefix),
+                        **({
+                            'prometheus.io/scrape': 'true',
+                            'prometheus.io/port': str(METRICS_EXPORTER_PORT),
+                        } if with_metrics_exporter else {}),
+                    }
                 },
                 'spec': {
+                    # preferred, so that the replicas can still be scheduled when there are less nodes than replicas
+                    'affinity': {
+                        'podAntiAffinity': {
+                            'preferredDuringSchedulingIgnoredDuringExecution': [
+                                {
+                                    'weight': 100,
+                                    'podAffinityTerm': {
+                                        'labelSelector': {'matchExpressions': [
+                                            {'key': 'app', 'operator': 'In', 'values': [labels['app']]}
+                                        ]},
+                                        'topologyKey': 'kubernetes.io/hostname'
+                                    }
+                                }
+                            ]
+                        }
+                    },
                     'containers': [
                         {
                             'name': 'pgbouncer',
@@ -194,10 +508,11 @@ def _apply_deployment():
                                     'memory': '0.2Gi',
                                 }
                             }
-                        }
+                        },
+                        *([_get_metrics_exporter_container()] if with_metrics_exporter else []),
                     ],
                     'volumes': [
-                        _config_get_volume_spec('config', is_secret=True),
+                        _config_get_volume_spec('config', is_secret=True, suffix=db_prefix),
                     ]
                 }
             }
@@ -205,11 +520,51 @@ def _apply_deployment():
     ))
 
 
-def _apply_service():
-    deployment_app = _get_resource_labels(for_deployment=True)['app']
+def _get_metrics_exporter_container():
+    from ckan_cloud_operator.config import manager as config_manager
+    return {
+        'name': 'metrics-exporter',
+        'image': config_manager.get('ckan-cloud-operator-image') or 'viderum/ckan-cloud-operator:latest',
+        'args': ['db', 'proxy', 'metrics', '--serve', '--port', str(METRICS_EXPORTER_PORT),
+                 '--from-config-path', CONFIG_PATH],
+        'ports': [{'containerPort': METRICS_EXPORTER_PORT}],
+        'volumeMounts': [
+            {
+                'name': 'config',
+                'mountPath': CONFIG_PATH,
+                'readOnly': True
+            },
+        ],
+        'resources': {
+            'limits': {
+                'memory': '0.5Gi',
+            },
+            'requests': {
+                'cpu': '0.05',
+                'memory': '0.1Gi',
+            }
+        }
+    }
+
+
+def _apply_service(db_prefix=None):
+    deployment_app = _get_resource_labels(for_deployment=True, suffix=db_prefix)['app']
     kubectl.apply(kubectl.get_service(
-        _get_resource_name(),
-        _get_resource_labels(),
+        _get_resource_name(suffix=db_prefix),
+        _get_resource_labels(suffix=db_prefix),
         [5432],
         {'app': deployment_app}
     ))
+
+
+def _apply_pod_disruption_budget(db_prefix=None):
+    # voluntary disruptions (e.g. node drains) evict one pgbouncer pod at a time
+    deployment_app = _get_resource_labels(for_deployment=True, suffix=db_prefix)['app']
+    pod_disruption_budget = kubectl.get_resource('policy/v1beta1', 'PodDisruptionBudget',
+                                                 _get_resource_name(suffix=db_prefix),
+                                                 _get_resource_labels(suffix=db_prefix))
+    pod_disruption_budget['spec'] = {
+        'maxUnavailable': 1,
+        'selector': {'matchLabels': {'app': deployment_app}}
+    }
+    kubectl.apply(pod_disruption_budget)
@@ -0,0 +1,206 @@
+"""Prometheus metrics of the pgbouncer admin console and the backing postgres server databases
+
+the metrics are collected either by the operator (via the proxy port-forward) or by the optional metrics exporter
+sidecar of each pgbouncer pod, which reads the connection details from the mounted pgbouncer config
+"""
+import http.server
+import re
+import traceback
+
+import yaml
+
+from ckan_cloud_operator import logs
+from ckan_cloud_operator.drivers.postgres import driver as postgres_driver
+
+from . import manager
+
+
+METRICS_PREFIX = 'ckan_cloud'
+
+DEFAULT_EXPORTER_PORT = 9127
+
+# the metrics exporter sidecar connects to the admin console of the pgbouncer in the same pod
+SIDECAR_ADMIN_CONSOLE_HOST_PORT = ('127.0.0.1', 5432)
+
+# SHOW POOLS field: (metric name, description)
+POOLS_METRICS = {
+    'cl_active': ('pgbouncer_pools_client_active_connections', 'Client connections linked to a server connection'),
+    'cl_waiting': ('pgbouncer_pools_client_waiting_connections', 'Client connections waiting for a server connection'),
+    'sv_active': ('pgbouncer_pools_server_active_connections', 'Server connections linked to a client'),
+    'sv_idle': ('pgbouncer_pools_server_idle_connections', 'Server connections unused and immediately usable'),
+    'sv_used': ('pgbouncer_pools_server_used_connections', 'Server connections idle more than server_check_delay'),
+    'sv_login': ('pgbouncer_pools_server_login_connections', 'Server connections in the process of logging in'),
+}
+
+# SHOW STATS field: (metric name, type, description, scale), times are in microseconds
+STATS_METRICS = {
+    'total_xact_count': ('pgbouncer_stats_transactions_total', 'counter', 'SQL transactions pooled', 1),
+    'total_query_count': ('pgbouncer_stats_queries_total', 'counter', 'SQL queries pooled', 1),
+    'total_received': ('pgbouncer_stats_received_bytes_total', 'counter', 'Bytes received from clients', 1),
+    'total_sent': ('pgbouncer_stats_sent_bytes_total', 'counter', 'Bytes sent to clients', 1),
+    'total_xact_time': ('pgbouncer_stats_transaction_seconds_total', 'counter',
+                        'Time spent in transactions', 1000000),
+    'total_query_time': ('pgbouncer_stats_query_seconds_total', 'counter', 'Time spent in queries', 1000000),
+    'total_wait_time': ('pgbouncer_stats_wait_seconds_total', 'counter',
+                        'Time clients spent waiting for a server connection', 1000000),
+    'avg_xact_count': ('pgbouncer_stats_transactions_per_second', 'gauge',
+                       'Average transactions per second in the last stats period', 1),
+    'avg_xact_time': ('pgbouncer_stats_average_transaction_seconds', 'gauge',
+                      'Average transaction duration in the last stats period', 1000000),
+    'avg_wait_time': ('pgbouncer_stats_average_wait_seconds', 'gauge',
+                      'Average time clients waited for a server connection in the last stats period', 1000000),
+}
+
+# pg_stat_database field: (metric name, type, description)
+SERVER_METRICS = {
+    'numbackends': ('postgres_database_backends', 'gauge', 'Backends connected to the database'),
+    'xact_commit': ('postgres_database_commits_total', 'counter', 'Committed transactions'),
+    'xact_rollback': ('postgres_database_rollbacks_total', 'counter', 'Rolled back transactions'),
+    'blks_read': ('postgres_database_blocks_read_total', 'counter', 'Disk blocks read'),
+    'blks_hit': ('postgres_database_blocks_hit_total', 'counter', 'Disk blocks found in the buffer cache'),
+    'tup_returned': ('postgres_database_rows_returned_total', 'counter', 'Rows returned by queries'),
+    'tup_fetched': ('postgres_database_rows_fetched_total', 'counter', 'Rows fetched by queries'),
+    'tup_inserted': ('postgres_database_rows_inserted_total', 'counter', 'Rows inserted'),
+    'tup_updated': ('postgres_database_rows_updated_total', 'counter', 'Rows updated'),
+    'tup_deleted': ('postgres_database_rows_deleted_total', 'counter', 'Rows deleted'),
+    'deadlocks': ('postgres_database_deadlocks_total', 'counter', 'Deadlocks detected'),
+    'temp_bytes': ('postgres_database_temp_bytes_total', 'counter', 'Bytes written to temporary files'),
+}
+
+
+def get_metrics(admin_conn, server_conn=None, db_instance_ids=None):
+    """Returns a list of (name, type, description, labels, value) metrics
+
+    the database metrics are labeled with the database name and the instance id which uses it (empty if unknown)
+    """
+    db_instance_ids = db_instance_ids or {}
+
+    def _get_labels(db_name, **labels):
+        return {'database': db_name, 'instance_id': db_instance_ids.get(db_name, ''), **labels}
+
+    metrics = []
+    for pool in manager.show(admin_conn, 'POOLS'):
+        if pool['database'] == manager.ADMIN_CONSOLE_DB_NAME:
+            continue
+        labels = _get_labels(pool['database'], user=pool['user'])
+        for field, (name, description) in POOLS_METRICS.items():
+            if field in pool:
+                metrics.append((name, 'gauge', description, labels, pool[field]))
+        metrics.append(('pgbouncer_pools_max_wait_seconds', 'gauge', 'Age of the oldest waiting client', labels,
+                        int(pool['maxwait']) + int(pool.get('maxwait_us') or 0) / 1000000))
+    for db_stats in manager.show(admin_conn, 'STATS'):
+        if db_stats['database'] == manager.ADMIN_CONSOLE_DB_NAME:
+            continue
+        labels = _get_labels(db_stats['database'])
+        for field, (name, metric_type, description, scale) in STATS_METRICS.items():
+            if field in db_stats:
+                metrics.append((name, metric_type, description, labels, int(db_stats[field]) / scale))
+    num_clients = {}
+    for client in manager.show(admin_conn, 'CLIENTS'):
+        client_key = (client['database'], client['state'])
+        num_clients[client_key] = num_clients.get(client_key, 0) + 1
+    for (db_name, state), value in sorted(num_clients.items()):
+        metrics.append(('pgbouncer_clients', 'gauge', 'Client connections by state', _get_labels(db_name, state=state),
+                        value))
+    if server_conn:
+        with server_conn.cursor() as cur:
+            cur.execute(f"select datname, {', '.join(SERVER_METRICS)} from pg_stat_database "
+                        f"where datname is not null and datname not in ('template0', 'template1')")
+            for row in cur:
+                labels = _get_labels(row[0])
+                for (name, metric_type, description), value in zip(SERVER_METRICS.values(), row[1:]):
+                    metrics.append((name, metric_type, description, labels, value))
+    return metrics
+
+
+def render(metrics):
+    """Renders the metrics in the Prometheus text exposition format"""
+    metric_lines = {}
+    for name, metric_type, description, labels, value in metrics:
+        name = f'{METRICS_PREFIX}_{name}'
+        lines = metric_lines.setdefault(name, [f'# HELP {name} {description}', f'# TYPE {name} {metric_type}'])
+        labels = ','.join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items())
+        lines.append(f'{name}{{{labels}}} {float(value or 0)}')
+    return ''.join(f'{line}\n' for lines in metric_lines.values() for line in lines)
+
+
+def get_text(db_prefix=None, from_config_path=None, with_server_metrics=True):
+    """Collects the metrics and returns them in the Prometheus text format
+
+    from_config_path - collect from a pgbouncer pod using the mounted config (used by the metrics exporter sidecar),
+                       otherwise the metrics are collected using the operator admin credentials via the proxy
+    """
+    if from_config_path:
+        admin_console_url, server_url = get_config_connection_strings(from_config_path)
+        db_instance_ids = get_config_metrics(from_config_path).get('db-instance-ids', {})
+    else:
+        from ckan_cloud_operator.providers.db import manager as db_manager
+        admin_console_url = db_manager.get_external_admin_connection_string(
+            db_name=manager.ADMIN_CONSOLE_DB_NAME, db_prefix=db_prefix
+        )
+        server_url = db_manager.get_external_admin_connection_string(db_prefix=db_prefix)
+        db_instance_ids = manager.get_config_metrics(db_prefix).get('db-instance-ids', {})
+    # the admin console does not support transactions or the pool health checks
+    with postgres_driver.connect(admin_console_url, pooled=False) as admin_conn:
+        admin_conn.autocommit = True
+        if with_server_metrics:
+            # the server admin connection is reused between scrapes
+            with postgres_driver.connect(server_url, pooled=True) as server_conn:
+                metrics = get_metrics(admin_conn, server_conn, db_instance_ids)
+        else:
+            metrics = get_metrics(admin_conn, db_instance_ids=db_instance_ids)
+    return render(metrics)
+
+
+def get_config_metrics(config_path=manager.CONFIG_PATH):
+    with open(f'{config_path}/{manager.CONFIG_METRICS_KEY}') as f:
+        return yaml.safe_load(f) or {}
+
+
+def get_config_connection_strings(config_path=manager.CONFIG_PATH):
+    """Returns the admin console and the server connection strings from the mounted pgbouncer config"""
+    with open(f'{config_path}/pgbouncer.ini') as f:
+        admin_user = re.search(r'^admin_users = (.*)$', f.read(), re.MULTILINE).group(1).strip()
+    with open(f'{config_path}/users.txt') as f:
+        passwords = dict(re.findall(r'^"(.*)" "(.*)"$', f.read(), re.MULTILINE))
+    admin_password = passwords[admin_user]
+    config_metrics = get_config_metrics(config_path)
+    admin_console_host, admin_console_port = SIDECAR_ADMIN_CONSOLE_HOST_PORT
+    return (
+        f'postgresql://{admin_user}:{admin_password}@{admin_console_host}:{admin_console_port}/'
+        f'{manager.ADMIN_CONSOLE_DB_NAME}',
+        f'postgresql://{admin_user}:{admin_password}@{config_metrics["server-host"]}:{config_metrics["server-port"]}/'
+        f'{config_metrics["server-db-name"]}'
+    )
+
+
+def serve(get_text_func, port=DEFAULT_EXPORTER_PORT, host='0.0.0.0'):
+    """Serves the metrics text on /metrics, the metrics are collected on each scrape"""
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = get_text_func().encode()
+            except Exception:
+                traceback.print_exc()
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logs.debug(format % args)
+
+    logs.info('Serving metrics', host=host, port=port)
+    http.server.ThreadingHTTPServer((host, port), _Handler).serve_forever()
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -30,7 +30,7 @@ class CkanRoutersAnnotations(kubectl.BaseAnnotations):
     @property
     def JSON_ANNOTATION_PREFIXES(self):
         """flexible annotations encoded to json and permitted using key prefixes"""
-        return ['default-root-domain']
+        return ['default-root-domain', 'update-requested-at', 'update-completed-at', 'routes-version']
 
     @property
     def RESOURCE_KIND(self):
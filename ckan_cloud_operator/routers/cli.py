@@ -3,11 +3,38 @@ import yaml
 
 from ckan_cloud_operator.routers import manager as routers_manager
 from ckan_cloud_operator.routers.routes import manager as routes_manager
+from ckan_cloud_operator.routers import controller as routers_controller
+from ckan_cloud_operator.routers import rate_limits
 from ckan_cloud_operator import logs
 
 
 def add_cli_commands(click, command_group, great_success):
 
+    def route_options(f):
+        """Adds the optional route spec attributes to a create route command, as a route_options kwarg"""
+        for option in reversed([
+            click.option('--backend-endpoints', is_flag=True,
+                         help='load balance over the pods of the backend service, with health checks'),
+            click.option('--health-check-path', help='backend-endpoints health check path (default: /)'),
+            click.option('--sticky-sessions', is_flag=True, help='backend-endpoints connection affinity'),
+            click.option('--static-assets-max-age', type=int,
+                         help='set a public Cache-Control max-age on static assets responses to anonymous requests'),
+            click.option('--static-assets-path', multiple=True,
+                         help='path prefix of static assets, can be used multiple times'),
+        ]):
+            f = option(f)
+        return f
+
+    def get_route_options(backend_endpoints, health_check_path, sticky_sessions, static_assets_max_age,
+                          static_assets_path):
+        return {
+            **({'backend-endpoints': True} if backend_endpoints else {}),
+            **({'health-check-path': health_check_path} if health_check_path else {}),
+            **({'sticky-sessions': True} if sticky_sessions else {}),
+            **({'static-assets-max-age': static_assets_max_age} if static_assets_max_age else {}),
+            **({'static-assets-paths': list(static_assets_path)} if static_assets_path else {}),
+        }
+
     @command_group.command('initialize')
     @click.option('--interactive', is_flag=True)
     def initialize(interactive):
@@ -21,13 +48,16 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('CLOUDFLARE_EMAIL', required=False, default='default')
     @click.argument('CLOUDFLARE_API_KEY', required=False, default='default')
     @click.option('--external-domains', is_flag=True)
-    def routers_create(traefik_router_name, default_root_domain, cloudflare_email, cloudflare_api_key, external_domains):
+    @click.option('--shards', type=int, help='spread the routes over multiple Traefik deployments by hostname')
+    @click.option('--hot-reload', is_flag=True, help='apply route changes without restarting the Traefik pods')
+    def routers_create(traefik_router_name, default_root_domain, cloudflare_email, cloudflare_api_key, external_domains,
+                       shards, hot_reload):
         """Create a Traefik router, with domain registration and let's encrypt based on Cloudflare"""
         routers_manager.create(
             traefik_router_name,
             routers_manager.get_traefik_router_spec(
                 default_root_domain, cloudflare_email, cloudflare_api_key,
-                external_domains=external_domains
+                external_domains=external_domains, shards=shards, hot_reload=hot_reload
             )
         )
         routers_manager.update(traefik_router_name)
@@ -36,11 +66,20 @@ def add_cli_commands(click, command_group, great_success):
     @command_group.command('update')
     @click.argument('ROUTER_NAME')
     @click.option('--wait-ready', is_flag=True)
-    def routers_update(router_name, wait_ready):
+    @click.option('--enqueue', is_flag=True, help='let the routers controller run the update')
+    def routers_update(router_name, wait_ready, enqueue):
         """Update a router to latest resource spec"""
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, enqueue=enqueue or None)
         great_success()
 
+    @command_group.command('controller')
+    @click.option('--quiet-period', type=int, default=routers_controller.DEFAULT_QUIET_PERIOD_SECONDS,
+                  help='seconds without route changes before a dirty router is updated')
+    @click.option('--poll-interval', type=int, default=routers_controller.DEFAULT_POLL_INTERVAL_SECONDS)
+    def routers_controller_start(quiet_period, poll_interval):
+        """Watch routes and run a single coalesced update for each changed router"""
+        routers_controller.start(quiet_period, poll_interval)
+
     @command_group.command('list')
     @click.option('-f', '--full', is_flag=True)
     @click.option('-v', '--values-only', is_flag=True)
@@ -60,16 +99,19 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('SUB_DOMAIN', required=False, default='default')
     @click.argument('ROOT_DOMAIN', required=False, default='default')
     @click.option('--wait-ready', is_flag=True)
+    @click.option('--enqueue', is_flag=True, help='let the routers controller run the router update')
+    @route_options
     def routers_create_deis_instance_subdomain_route(router_name, deis_instance_id,
                                                      sub_domain, root_domain,
-                                                     wait_ready):
+                                                     wait_ready, enqueue, **route_options):
         routers_manager.create_subdomain_route(router_name, {
             'target-type': 'deis-instance',
             'deis-instance-id': deis_instance_id,
             'root-domain': root_domain,
-            'sub-domain': sub_domain
+            'sub-domain': sub_domain,
+            **get_route_options(**route_options),
         })
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, enqueue=enqueue or None)
         great_success()
 
     @command_group.command('create-ckan-instance-subdomain-route')
@@ -78,16 +120,19 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('SUB_DOMAIN', required=False, default='default')
     @click.argument('ROOT_DOMAIN', required=False, default='default')
     @click.option('--wait-ready', is_flag=True)
+    @click.option('--enqueue', is_flag=True, help='let the routers controller run the router update')
+    @route_options
     def routers_create_ckan_instance_subdomain_route(router_name, ckan_instance_id,
                                                      sub_domain, root_domain,
-                                                     wait_ready):
+                                                     wait_ready, enqueue, **route_options):
         routers_manager.create_subdomain_route(router_name, {
             'target-type': 'ckan-instance',
             'ckan-instance-id': ckan_instance_id,
             'root-domain': root_domain,
-            'sub-domain': sub_domain
+            'sub-domain': sub_domain,
+            **get_route_options(**route_options),
         })
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, enqueue=enqueue or None)
         great_success()
 
     @command_group.command('create-app-instance-subdomain-route')
@@ -96,16 +141,19 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('SUB_DOMAIN', required=False, default='default')
     @click.argument('ROOT_DOMAIN', required=False, default='default')
     @click.option('--wait-ready', is_flag=True)
+    @click.option('--enqueue', is_flag=True, help='let the routers controller run the router update')
+    @route_options
     def routers_create_app_instance_subdomain_route(router_name, app_instance_id,
                                                     sub_domain, root_domain,
-                                                    wait_ready):
+                                                    wait_ready, enqueue, **route_options):
         routers_manager.create_subdomain_route(router_name, {
             'target-type': 'app-instance',
             'app-instance-id': app_instance_id,
             'root-domain': root_domain,
-            'sub-domain': sub_domain
+            'sub-domain': sub_domain,
+            **get_route_options(**route_options),
         })
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, enqueue=enqueue or None)
         great_success()
 
     @command_group.command('create-datapusher-subdomain-route')
@@ -114,16 +162,19 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('SUB_DOMAIN', required=False, default='default')
     @click.argument('ROOT_DOMAIN', required=False, default='default')
     @click.option('--wait-ready', is_flag=True)
+    @click.option('--enqueue', is_flag=True, help='let the routers controller run the router update')
+    @route_options
     def routers_create_datapusher_subdomain_route(router_name, datapusher_name,
                                                   sub_domain, root_domain,
-                                                  wait_ready):
+                                                  wait_ready, enqueue, **route_options):
         routers_manager.create_subdomain_route(router_name, {
             'target-type': 'datapusher',
             'datapusher-name': datapusher_name,
             'root-domain': root_domain,
-            'sub-domain': sub_domain
+            'sub-domain': sub_domain,
+            **get_route_options(**route_options),
         })
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, enqueue=enqueue or None)
         great_success()
 
     @command_group.command('create-backend-url-subdomain-route')
@@ -133,10 +184,12 @@ def add_cli_commands(click, command_group, great_success):
     @click.argument('SUB_DOMAIN', required=False, default='default')
     @click.argument('ROOT_DOMAIN', required=False, default='default')
     @click.option('--wait-ready', is_flag=True)
+    @click.option('--enqueue', is_flag=True, help='let the routers controller run the router update')
     @click.option('--httpauth-secret')
+    @route_options
     def routers_create_backend_url_subdomain_route(router_name, target_resource_id, backend_url,
-                                                   sub_domain, root_domain, wait_ready,
-                                                   httpauth_secret):
+                                                   sub_domain, root_domain, wait_ready, enqueue,
+                                                   httpauth_secret, **route_options):
         routers_manager.create_subdomain_route(router_name, {
             'target-type': 'backend-url',
             'target-resource-id': target_resource_id,
@@ -144,8 +197,9 @@ def add_cli_commands(click, command_group, great_success):
             'sub-domain': sub_domain,
             'root-domain': root_domain,
             **({'httpauth-secret': httpauth_secret} if httpauth_secret else {}),
+            **get_route_options(**route_options),
         })
-        routers_manager.update(router_name, wait_ready)
+        routers_manager.update(router_name, wait_ready, enqueue=enqueue or None)
         great_success()
 
     @command_group.command('get-routes')
@@ -196,6 +250,34 @@ def add_cli_commands(click, command_group, great_success):
                     else:
                         print(yaml.dump([data], default_flow_style=False))
 
+    @command_group.command('routes-index')
+    @click.option('--rebuild', is_flag=True, help='rebuild the index snapshot from all the routes')
+    @click.option('--hostname', help='get the route details of a hostname')
+    def routes_index(rebuild, hostname):
+        """Get routes index statistics and conflicting hostnames, or lookup a hostname"""
+        from ckan_cloud_operator.routers.routes import index as routes_index
+        index = routes_index.update() if rebuild else routes_index.get_index()
+        if hostname:
+            logs.print_yaml_dump(index['hostnames'].get(hostname))
+        else:
+            logs.print_yaml_dump({
+                'hostnames': len(index['hostnames']),
+                'targets': len(index['targets']),
+                'routers': {router_name: len(route_names) for router_name, route_names in index['routers'].items()},
+                'conflicts': index['conflicts'],
+            })
+
+    @command_group.command('traefik-benchmark')
+    @click.option('--num-routes', type=int, multiple=True, help='number of synthetic routes, can be used multiple times')
+    @click.option('--serializer', multiple=True, help='config serializer to benchmark: toml / fast')
+    def traefik_benchmark(num_routes, serializer):
+        """Benchmark Traefik config generation and serialization using synthetic routes
+
+        The toml serializer is slow for large configs, use --serializer fast to benchmark only the fast serializer
+        """
+        from ckan_cloud_operator.routers.traefik import benchmark as traefik_benchmark
+        logs.print_yaml_dump(traefik_benchmark.start(num_routes or None, serializer or None))
+
     @command_group.command('delete-routes')
     @click.option('-p', '--datapusher-name', required=False)
     @click.option('-d', '--deis-instance-id', required=False)
@@ -223,7 +305,46 @@ def add_cli_commands(click, command_group, great_success):
     def get(router_name, dns):
         print(yaml.dump(routers_manager.get(router_name, only_dns=dns), default_flow_style=False))
 
+    @command_group.command('acme-plan')
+    @click.argument('ROUTER_NAME')
+    @click.option('--full', is_flag=True, help='include the names of each certificate')
+    def acme_plan(router_name, full):
+        """Get the planned Let's Encrypt certificates of a router"""
+        plan = routers_manager.get_acme_plan(router_name)
+        if not full:
+            for resource_plan in plan.values():
+                for certificate in resource_plan['certificates']:
+                    del certificate['sans']
+        logs.print_yaml_dump(plan)
+
     @command_group.command('cloudflare-rate-limits')
     @click.argument('ROOT_DOMAIN')
     def cloudflare_rate_limits(root_domain):
         logs.print_yaml_dump(routers_manager.get_cloudflare_rate_limits(root_domain))
+
+    @command_group.command('cloudflare-rate-limits-sync')
+    @click.argument('ROOT_DOMAIN')
+    @click.option('--state-path', default=rate_limits.access_logs_checkpoints.DEFAULT_STATE_PATH,
+                  help='state path of the incrementally processed access logs (logs process)')
+    @click.option('--from-hour', help='first hour of traffic to consider (YYYY-MM-DDTHH)')
+    @click.option('--to-hour', help='last hour of traffic to consider (YYYY-MM-DDTHH)')
+    @click.option('--period', type=int, default=rate_limits.DEFAULT_PERIOD_SECONDS)
+    @click.option('--headroom', type=float, default=rate_limits.DEFAULT_HEADROOM,
+                  help='multiplier of the host peak rate for the per-client threshold')
+    @click.option('--min-threshold', type=int, default=rate_limits.DEFAULT_MIN_THRESHOLD)
+    @click.option('--mode', type=click.Choice(['simulate', 'ban', 'challenge', 'js_challenge']),
+                  default=rate_limits.DEFAULT_ACTION_MODE)
+    @click.option('--timeout', type=int, default=rate_limits.DEFAULT_ACTION_TIMEOUT_SECONDS)
+    @click.option('--keep-stale', is_flag=True, help="don't delete managed rules of hosts without traffic")
+    @click.option('--max-rules', type=int, default=rate_limits.DEFAULT_ZONE_MAX_RULES,
+                  help='rate limiting rules quota of the zone plan')
+    @click.option('--dry-run', is_flag=True)
+    def cloudflare_rate_limits_sync(root_domain, state_path, from_hour, to_hour, period, headroom, min_threshold,
+                                    mode, timeout, keep_stale, max_rules, dry_run):
+        """Sync the rate limits of the CKAN API paths (including the datastore) from the observed per-host traffic"""
+        host_rates = rate_limits.get_peak_host_rates(from_hour, to_hour, state_path)
+        diff = routers_manager.sync_cloudflare_rate_limits(
+            root_domain, host_rates, dry_run=dry_run, delete_stale=not keep_stale, max_rules=max_rules,
+            period=period, headroom=headroom, min_threshold=min_threshold, mode=mode, timeout=timeout
+        )
+        logs.print_yaml_dump(diff)
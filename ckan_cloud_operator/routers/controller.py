@@ -0,0 +1,162 @@
+import time
+import hashlib
+import traceback
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator import logs
+from ckan_cloud_operator.routers.annotations import CkanRoutersAnnotations
+from ckan_cloud_operator.routers.routes import index as routes_index
+from ckan_cloud_operator.routers.routes import endpoints as route_endpoints
+
+
+DEFAULT_QUIET_PERIOD_SECONDS = 30
+DEFAULT_POLL_INTERVAL_SECONDS = 5
+
+
+def enqueue_update(router_name, annotations, wait_ready=False, timeout_seconds=1800):
+    """Requests a router update from the routers controller instead of updating inline
+
+    Multiple requests for the same router are coalesced to a single update by the controller
+    """
+    requested_at = time.time()
+    logs.info('enqueuing router update', router_name=router_name, requested_at=requested_at)
+    annotations.json_annotate('update-requested-at', requested_at)
+    if wait_ready:
+        print('Waiting for the routers controller to update the router...')
+        while True:
+            time.sleep(5)
+            router = kubectl.get(f'CkanCloudRouter {router_name}')
+            completed_at = CkanRoutersAnnotations(router_name, router).get_json_annotation('update-completed-at')
+            if completed_at and completed_at >= requested_at:
+                break
+            if time.time() - requested_at > timeout_seconds:
+                raise Exception(f'Timed out waiting for the routers controller to update router {router_name}')
+            print('.')
+
+
+def get_routes_versions(routes, endpoints_index=None, endpoints_router_names=None):
+    """Returns a dict of router name -> hash of the router's routes names and resource versions
+
+    If endpoints_index is given, the pods of backend-endpoints routes are included as well,
+    only for the routers in endpoints_router_names (if given)
+    """
+    router_routes = {}
+    for route in routes:
+        router_name = route['spec'].get('router_name')
+        if router_name:
+            route_version = (route['metadata']['name'], route['metadata'].get('resourceVersion'))
+            if (
+                endpoints_index is not None and route_endpoints.is_endpoints_route(route)
+                and (endpoints_router_names is None or router_name in endpoints_router_names)
+            ):
+                route_version += tuple(route_endpoints.get_route_backend_servers(route, endpoints_index))
+            router_routes.setdefault(router_name, []).append(route_version)
+    return {
+        router_name: _get_routes_version(routes)
+        for router_name, routes in router_routes.items()
+    }
+
+
+def _get_endpoints_index(routers, routes):
+    """Returns a tuple of (endpoints index, hot reload router names) for the routes versions of the routers
+
+    backend pods of endpoints routes are part of the version of hot reload routers, so these routers are updated
+    on pod changes, other routers would restart their pods on each pod change
+    """
+    from ckan_cloud_operator.routers.traefik import deployment as traefik_deployment
+    hot_reload_router_names = {
+        router['metadata']['name'] for router in routers if traefik_deployment.is_hot_reload(router['spec'])
+    }
+    endpoints_routes = [
+        route for route in routes
+        if route['spec'].get('router_name') in hot_reload_router_names and route_endpoints.is_endpoints_route(route)
+    ]
+    endpoints_index = route_endpoints.get_index(endpoints_routes) if endpoints_routes else None
+    return endpoints_index, hot_reload_router_names
+
+
+def get_router_routes_version(router, routes):
+    """Returns the routes version of a router with the given routes, as compared by the routers controller"""
+    endpoints_index, hot_reload_router_names = _get_endpoints_index([router], routes)
+    routes_versions = get_routes_versions(routes, endpoints_index, hot_reload_router_names)
+    return routes_versions.get(router['metadata']['name'], _get_routes_version([]))
+
+
+# version of all the routes when the routes index was last updated by the controller
+_INDEX_ROUTES_VERSION = None
+
+
+def _update_routes_index(routes):
+    """Updates the routes index, only if any route changed since the last update"""
+    global _INDEX_ROUTES_VERSION
+    routes_version = _get_routes_version([
+        (route['metadata']['name'], route['metadata'].get('resourceVersion')) for route in routes
+    ])
+    if routes_version != _INDEX_ROUTES_VERSION:
+        routes_index.update(routes)
+        _INDEX_ROUTES_VERSION = routes_version
+
+
+def get_dirty_state(annotations, routes_version):
+    """Returns a value which identifies the pending changes of the router, or None if the router is up to date"""
+    if routes_version == annotations.get_json_annotation('routes-version'):
+        routes_version = None
+    requested_at = annotations.get_json_annotation('update-requested-at')
+    completed_at = annotations.get_json_annotation('update-completed-at')
+    if not requested_at or (completed_at and completed_at >= requested_at):
+        requested_at = None
+    if routes_version or requested_at:
+        return routes_version, requested_at
+    else:
+        return None
+
+
+def process_dirty_routers(dirty_routers, quiet_period_seconds=DEFAULT_QUIET_PERIOD_SECONDS, now=None):
+    """Runs a single iteration of the controller
+
+    dirty_routers is a dict of router name -> (dirty state, last change time) which is kept between iterations,
+    a router is updated once its dirty state did not change for quiet_period_seconds
+    """
+    from ckan_cloud_operator.routers import manager as routers_manager
+    if now is None:
+        now = time.time()
+    routes = kubectl.get('CkanCloudRoute')['items']
+    _update_routes_index(routes)
+    routers = kubectl.get('CkanCloudRouter')['items']
+    endpoints_index, hot_reload_router_names = _get_endpoints_index(routers, routes)
+    routes_versions = get_routes_versions(routes, endpoints_index, hot_reload_router_names)
+    for router in routers:
+        router_name = router['metadata']['name']
+        annotations = CkanRoutersAnnotations(router_name, router)
+        routes_version = routes_versions.get(router_name, _get_routes_version([]))
+        dirty_state = get_dirty_state(annotations, routes_version)
+        if not dirty_state:
+            dirty_routers.pop(router_name, None)
+        elif router_name not in dirty_routers or dirty_routers[router_name][0] != dirty_state:
+            logs.info('router marked dirty', router_name=router_name, quiet_period_seconds=quiet_period_seconds)
+            dirty_routers[router_name] = dirty_state, now
+        elif now - dirty_routers[router_name][1] >= quiet_period_seconds:
+            logs.info('updating dirty router', router_name=router_name)
+            try:
+                # the update records the routes version of the updated routes
+                routers_manager.update(router_name, enqueue=False)
+            except Exception:
+                logs.error(traceback.format_exc())
+                logs.error('router update failed, will retry after the quiet period', router_name=router_name)
+                dirty_routers[router_name] = dirty_state, now
+            else:
+                annotations.json_annotate('update-completed-at', now)
+                del dirty_routers[router_name]
+
+
+def start(quiet_period_seconds=DEFAULT_QUIET_PERIOD_SECONDS, poll_interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS):
+    logs.info('Starting routers controller', quiet_period_seconds=quiet_period_seconds,
+              poll_interval_seconds=poll_interval_seconds)
+    dirty_routers = {}
+    while True:
+        process_dirty_routers(dirty_routers, quiet_period_seconds)
+        time.sleep(poll_interval_seconds)
+
+
+def _get_routes_version(router_routes):
+    return hashlib.sha256(str(sorted(router_routes)).encode()).hexdigest()[:16]
@@ -1,11 +1,13 @@
 import yaml
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
 from ckan_cloud_operator.routers.annotations import CkanRoutersAnnotations
 from ckan_cloud_operator.routers.traefik import manager as traefik_manager
 from ckan_cloud_operator.routers.routes import manager as routes_manager
+from ckan_cloud_operator.routers.routes import index as routes_index
 from ckan_cloud_operator.providers.routers.manager import get_env_id, get_default_root_domain
 
 
@@ -39,7 +41,8 @@ def create(router_name, router_spec):
 
 
 def get_traefik_router_spec(default_root_domain=None, cloudflare_email=None, cloudflare_api_key=None,
-                            wildcard_ssl_domain=None, external_domains=False, dns_provider=None):
+                            wildcard_ssl_domain=None, external_domains=False, dns_provider=None, shards=None,
+                            hot_reload=False):
     if not default_root_domain: default_root_domain = 'default'
     if not cloudflare_email: cloudflare_email = 'default'
     if not cloudflare_api_key: cloudflare_api_key = 'default'
@@ -54,38 +57,62 @@ def get_traefik_router_spec(default_root_domain=None, cloudflare_email=None, clo
         },
         'wildcard-ssl-domain': wildcard_ssl_domain,
         'external-domains': bool(external_domains),
-        'dns-provider': dns_provider
+        'dns-provider': dns_provider,
+        **({'shards': int(shards)} if shards and int(shards) > 1 else {}),
+        **({'hot-reload': True} if hot_reload else {}),
     }
 
 
-def update(router_name, wait_ready=False, dry_run=False):
+def update(router_name, wait_ready=False, dry_run=False, enqueue=None):
     router, spec, router_type, annotations, labels, router_type_config = _init_router(router_name)
+    if enqueue is None:
+        enqueue = bool(spec.get('enqueue-updates'))
+    if enqueue and not dry_run:
+        from ckan_cloud_operator.routers import controller as routers_controller
+        routers_controller.enqueue_update(router_name, annotations, wait_ready=wait_ready)
+        return
     print(f'Updating CkanCloudRouter {router_name} (type={router_type}) (labels={labels})')
     routes = routes_manager.list(labels)
     router_type_config['manager'].update(router_name, wait_ready, spec, annotations, routes, dry_run=dry_run)
+    if not dry_run:
+        # the routers controller doesn't update the router again for these routes
+        from ckan_cloud_operator.routers import controller as routers_controller
+        annotations.json_annotate('routes-version', routers_controller.get_router_routes_version(router, routes))
+
+
+# routers statuses are computed concurrently, mostly waiting for the pod logs
+LIST_MAX_WORKERS = 8
 
 
 def list(full=False, values_only=False, async_print=True):
     res = None if async_print else []
-    for router in kubectl.get('CkanCloudRouter')['items']:
-        if values_only:
-            data = {'name': router['metadata']['name'],
-                    'type': router['spec']['type']}
-        else:
-            data = get(router)
-            if not full:
+    routers = kubectl.get('CkanCloudRouter')['items']
+    if values_only:
+        routers_data = ({'name': router['metadata']['name'], 'type': router['spec']['type']} for router in routers)
+        executor = None
+    else:
+        snapshot = _get_snapshot()
+        executor = ThreadPoolExecutor(max_workers=LIST_MAX_WORKERS)
+        routers_data = executor.map(lambda router: get(router, snapshot=snapshot), routers)
+    try:
+        for data in routers_data:
+            if not values_only and not full:
                 data = {'name': data['name'],
                         'type': data['type'],
                         'ready': data['ready']}
-        if res is None:
-            print(yaml.dump([data], default_flow_style=False))
-        else:
-            res.append(data)
+            if res is None:
+                print(yaml.dump([data], default_flow_style=False))
+            else:
+                res.append(data)
+    finally:
+        if executor:
+            executor.shutdown()
     if res is not None:
         return res
 
 
-def get(router_name_or_values, required=False, only_dns=False, failfast=False):
+def get(router_name_or_values, required=False, only_dns=False, failfast=False, snapshot=None):
+    """snapshot - optional pre-fetched resources of all routers, see _get_snapshot"""
     if type(router_name_or_values) == str:
         router_name = router_name_or_values
         router_values = kubectl.get(f'CkanCloudRouter {router_name}', required=required)
@@ -94,10 +121,13 @@ def get(router_name_or_values, required=False, only_dns=False, failfast=False):
         router_values = router_name_or_values
     router, spec, router_type, annotations, labels, router_type_config = _init_router(router_name, router_values, required=required)
     if router:
-        dns_data = router_type_config['manager'].get(router_name, 'dns', router, failfast=True)
+        router_snapshot = snapshot['router-types'].get(router_type) if snapshot else None
+        dns_data = router_type_config['manager'].get(router_name, 'dns', router, failfast=True, snapshot=router_snapshot)
         if not only_dns:
-            deployment_data = router_type_config['manager'].get(router_name, 'deployment')
-            routes = routes_manager.list(_get_labels(router_name, router_type))
+            deployment_data = router_type_config['manager'].get(router_name, 'deployment', router,
+                                                                 snapshot=router_snapshot)
+            routes = routes_manager.list(_get_labels(router_name, router_type),
+                                         routes=snapshot['routes'].get(router_name, []) if snapshot else None)
         else:
             deployment_data = None
             routes = None
@@ -117,6 +147,16 @@ def get(router_name_or_values, required=False, only_dns=False, failfast=False):
         return None
 
 
+def get_acme_plan(router_name):
+    router, spec, router_type, annotations, labels, router_type_config = _init_router(router_name)
+    return router_type_config['manager'].get_acme_plan(router_name, spec, routes_manager.list(labels))
+
+
+# optional route spec attributes which are copied as-is to the CkanCloudRoute spec
+ROUTE_SPEC_OPTIONS = ['httpauth-secret', 'backend-endpoints', 'health-check-path', 'sticky-sessions',
+                      'static-assets-max-age', 'static-assets-paths']
+
+
 def create_subdomain_route(router_name, route_spec, dry_run=False):
     target_type = route_spec['target-type']
     sub_domain = route_spec.get('sub-domain')
@@ -165,8 +205,14 @@ def create_subdomain_route(router_name, route_spec, dry_run=False):
         labels['ckan-cloud/route-ckan-instance-id'] = spec['ckan-instance-id'] = route_spec['ckan-instance-id']
     elif target_type == 'app-instance':
         labels['ckan-cloud/route-app-instance-id'] = spec['app-instance-id'] = route_spec['app-instance-id']
+    for key in ROUTE_SPEC_OPTIONS:
+        if route_spec.get(key):
+            spec[key] = route_spec[key]
+    _check_hostname_conflict(route_name, sub_domain, root_domain)
     route = kubectl.get_resource('stable.viderum.com/v1', 'CkanCloudRoute', route_name, labels, spec=spec)
     kubectl.apply(route, dry_run=dry_run)
+    if not dry_run:
+        routes_index.add_route(route)
 
 
 def install_crds():
@@ -184,33 +230,51 @@ def delete(router_name, router_type=None):
 
 
 def get_datapusher_routes(datapusher_name, edit=False):
-    labels = {'ckan-cloud/route-datapusher-name': datapusher_name}
-    if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    return _get_target_routes('datapusher-name', datapusher_name, edit)
 
 
 def get_backend_url_routes(target_resorce_id, edit=False):
-    labels = {'ckan-cloud/route-target-resource-id': target_resorce_id}
-    if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    return _get_target_routes('target-resource-id', target_resorce_id, edit, spec_key='route-target-resource-id')
 
 
 def get_deis_instance_routes(deis_instance_id, edit=False):
-    labels = {'ckan-cloud/route-deis-instance-id': deis_instance_id}
-    if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    return _get_target_routes('deis-instance-id', deis_instance_id, edit)
 
 
 def get_ckan_instance_routes(ckan_instance_id, edit=False):
-    labels = {'ckan-cloud/route-ckan-instance-id': ckan_instance_id}
-    if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    return _get_target_routes('ckan-instance-id', ckan_instance_id, edit)
 
 
 def get_app_instance_routes(app_instance_id, edit=False):
-    labels = {'ckan-cloud/route-app-instance-id': app_instance_id}
-    if edit: kubectl.edit_items_by_labels('CkanCloudRoute', labels)
-    else: return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+    return _get_target_routes('app-instance-id', app_instance_id, edit)
+
+
+def _get_target_routes(key, target_resource_id, edit=False, spec_key=None):
+    """Returns the routes of a target resource, from the routes index snapshot if it exists
+
+    the routes are matched by the ckan-cloud/route-{key} label or the spec_key (defaults to key) spec attribute
+    """
+    labels = {f'ckan-cloud/route-{key}': target_resource_id}
+    if edit:
+        kubectl.edit_items_by_labels('CkanCloudRoute', labels)
+    elif routes_index.load() is not None:
+        return _get_indexed_routes(routes_index.get_target_route_names(target_resource_id),
+                                   {spec_key or key: target_resource_id})
+    else:
+        return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
+
+
+def _get_indexed_routes(route_names, spec_values):
+    """Fetches the routes of the given index route names which have the given spec values
+
+    the index snapshot might include deleted routes, which are skipped
+    """
+    routes = []
+    for route_name in sorted(set(route_names)):
+        route = kubectl.get(f'CkanCloudRoute {route_name}', required=False)
+        if route and all(route['spec'].get(k) == v for k, v in spec_values.items()):
+            routes.append(route)
+    return routes
 
 
 def get_all_routes():
@@ -218,12 +282,28 @@ def get_all_routes():
 
 
 def get_domain_routes(root_domain=None, sub_domain=None):
-    if not root_domain or root_domain == get_default_root_domain():
+    default_root_domain = get_default_root_domain()
+    if not root_domain or root_domain == default_root_domain:
         root_domain = 'default'
     assert sub_domain or root_domain != 'default', 'cannot delete all routes from default root domain'
-    labels = {'ckan-cloud/route-root-domain': root_domain}
-    if sub_domain:
-        labels['ckan-cloud/route-sub-domain']: sub_domain
+    spec_values = {'root-domain': root_domain, **({'sub-domain': sub_domain} if sub_domain else {})}
+    if routes_index.load() is not None:
+        index = routes_index.get_index()
+        hostname_root_domain = default_root_domain if root_domain == 'default' else root_domain
+        if sub_domain:
+            hostnames = [f'{sub_domain}.{hostname_root_domain}']
+        else:
+            hostnames = [hostname for hostname in index['hostnames'] if hostname.endswith(f'.{hostname_root_domain}')]
+        route_names = [
+            route_name
+            for hostname in hostnames
+            for route_name in [
+                *([index['hostnames'][hostname]['route']] if hostname in index['hostnames'] else []),
+                *index['conflicts'].get(hostname, []),
+            ]
+        ]
+        return _get_indexed_routes(route_names, spec_values)
+    labels = {f'ckan-cloud/route-{k}': v for k, v in spec_values.items()}
     return kubectl.get_items_by_labels('CkanCloudRoute', labels, required=False)
 
 
@@ -274,6 +354,73 @@ def get_cloudflare_rate_limits(root_domain):
     return cloudflare.get_zone_rate_limits(*routers_manager.get_cloudflare_credentials(), root_domain)
 
 
+def sync_cloudflare_rate_limits(root_domain, host_rates, dry_run=False, delete_stale=True, max_rules=None,
+                                **rules_kwargs):
+    """Creates / updates the zone rate limits of the root domain hosts from their observed request rates
+
+    Only the changed rules are sent to Cloudflare, fails before sending any rule if the zone rules quota would be
+    exceeded, returns the diff
+    Cloudflare rate limits apply only to proxied traffic, hosts without a proxied dns record are skipped and
+    returned in the diff unproxied-hosts list
+    """
+    from ckan_cloud_operator.providers.routers import manager as routers_manager
+    from ckan_cloud_operator.routers import rate_limits
+    from ckan_cloud_operator import cloudflare
+    cloudflare_credentials = routers_manager.get_cloudflare_credentials()
+    zone_id = cloudflare.get_zone_id(*cloudflare_credentials, root_domain)
+    assert zone_id, f'Invalid zone name: {root_domain}'
+    existing_rules = cloudflare.get_zone_rate_limits(*cloudflare_credentials, root_domain, zone_id=zone_id)['result']
+    unproxied_hosts = set(rate_limits.get_unproxied_hosts(
+        host_rates, root_domain, cloudflare.get_zone_dns_records(*cloudflare_credentials, zone_id)
+    ))
+    if unproxied_hosts:
+        logs.warning('Skipping the rate limits of hosts which are not proxied by Cloudflare',
+                     unproxied_hosts=len(unproxied_hosts))
+    host_rates = {host: rate for host, rate in host_rates.items() if host not in unproxied_hosts}
+    rules = rate_limits.get_rules(host_rates, root_domain, **rules_kwargs)
+    diff = rate_limits.get_diff(rules, existing_rules, delete_stale=delete_stale)
+    logs.info('Cloudflare rate limits diff', root_domain=root_domain, rules=len(rules),
+              **{k: len(v) for k, v in diff.items()})
+    diff['unproxied-hosts'] = sorted(unproxied_hosts)
+    rate_limits.check_zone_quota(diff, existing_rules, max_rules or rate_limits.DEFAULT_ZONE_MAX_RULES)
+    if not dry_run:
+        cloudflare.apply_rate_limits_diff(*cloudflare_credentials, zone_id, diff)
+    return diff
+
+
+def _check_hostname_conflict(route_name, sub_domain, root_domain):
+    if routes_index.load() is not None:
+        hostname = routes_index.get_route_hostnames({'spec': {'sub-domain': sub_domain, 'root-domain': root_domain}})[0]
+        existing_route = routes_index.get_hostname_route(hostname)
+        existing_route_names = [existing_route['route']] if existing_route else []
+    else:
+        existing_routes = kubectl.get_items_by_labels('CkanCloudRoute', {
+            'ckan-cloud/route-root-domain': root_domain,
+            'ckan-cloud/route-sub-domain': sub_domain
+        }, required=False)
+        existing_route_names = [route['metadata']['name'] for route in existing_routes or []]
+    for existing_route_name in existing_route_names:
+        # the index snapshot might include deleted routes
+        if existing_route_name != route_name and kubectl.get(f'CkanCloudRoute {existing_route_name}', required=False):
+            raise Exception(f'Sub domain {sub_domain} of root domain {root_domain} is already routed by {existing_route_name}')
+
+
+def _get_snapshot():
+    """Fetches the routes and the router type resources of all routers once, routes are grouped by router name"""
+    routes = {}
+    for route in (kubectl.get('CkanCloudRoute', required=False) or {}).get('items', []):
+        router_name = route['metadata'].get('labels', {}).get('ckan-cloud/router-name')
+        if router_name:
+            routes.setdefault(router_name, []).append(route)
+    return {
+        'routes': routes,
+        'router-types': {
+            router_type: router_type_config['manager'].get_snapshot()
+            for router_type, router_type_config in ROUTER_TYPES.items()
+        }
+    }
+
+
 def _get_labels(router_name, router_type):
     return {'ckan-cloud/router-name': router_name, 'ckan-cloud/router-type': router_type}
 
@@ -0,0 +1,122 @@
+import math
+
+from ckan_cloud_operator.monitoring.access_logs import checkpoints as access_logs_checkpoints
+
+
+# Cloudflare rate limits which protect the CKAN backends, computed from the observed per-host traffic
+# The rules limit the requests of a single client, the threshold is derived from the peak per-minute rate of the host,
+# a single client should not make more requests than all clients of the host together make at peak
+
+# managed rules are identified by this description prefix, other rules of the zone are never modified
+DESCRIPTION_PREFIX = 'ckan-cloud-operator: '
+
+# path patterns of the CKAN backend endpoints which are protected, including the datastore search
+PROTECTED_PATHS = ['/api/*']
+
+DEFAULT_PERIOD_SECONDS = 60
+DEFAULT_HEADROOM = 2
+DEFAULT_MIN_THRESHOLD = 60
+DEFAULT_ACTION_MODE = 'simulate'
+DEFAULT_ACTION_TIMEOUT_SECONDS = 600
+
+# rate limiting rules quota of the zone, depends on the Cloudflare plan
+DEFAULT_ZONE_MAX_RULES = 100
+
+
+def get_peak_host_rates(from_hour=None, to_hour=None, state_path=access_logs_checkpoints.DEFAULT_STATE_PATH):
+    """Returns the peak requests per second of each request host, from the per-minute requests of the stored
+    access logs aggregates (the hourly average for hours which were stored without per-minute requests)
+    """
+    host_rates = {}
+    for hour in access_logs_checkpoints.get_hours(state_path):
+        if (not from_hour or hour >= from_hour) and (not to_hour or hour <= to_hour):
+            for request_host, aggregate in access_logs_checkpoints.load_hour(hour, state_path).items():
+                if aggregate['minute-requests']:
+                    rate = max(aggregate['minute-requests'].values()) / 60
+                else:
+                    rate = aggregate['stats']['total-requests'] / 3600
+                if rate > host_rates.get(request_host, 0):
+                    host_rates[request_host] = rate
+    return host_rates
+
+
+def get_unproxied_hosts(host_rates, root_domain, dns_records):
+    """Returns the sorted hosts of the root domain which are not proxied by Cloudflare
+
+    rate limits are not applied to the traffic of these hosts
+    """
+    proxied_hosts = {record['name'] for record in dns_records if record.get('proxied')}
+    return sorted(
+        request_host for request_host in host_rates
+        if _is_root_domain_host(request_host, root_domain) and request_host not in proxied_hosts
+    )
+
+
+def get_rules(host_rates, root_domain, period=DEFAULT_PERIOD_SECONDS, headroom=DEFAULT_HEADROOM,
+              min_threshold=DEFAULT_MIN_THRESHOLD, mode=DEFAULT_ACTION_MODE, timeout=DEFAULT_ACTION_TIMEOUT_SECONDS):
+    """Returns the rate limit rules of the hosts of the root domain, keyed by the rule description"""
+    rules = {}
+    for request_host, rate in sorted(host_rates.items()):
+        if not _is_root_domain_host(request_host, root_domain):
+            continue
+        threshold = max(min_threshold, math.ceil(rate * period * headroom))
+        for path in PROTECTED_PATHS:
+            description = f'{DESCRIPTION_PREFIX}{request_host}{path}'
+            rules[description] = {
+                'description': description,
+                'disabled': False,
+                'match': {'request': {'methods': ['_ALL_'], 'schemes': ['_ALL_'], 'url': f'{request_host}{path}'}},
+                'threshold': threshold,
+                'period': period,
+                'action': {'mode': mode, 'timeout': timeout},
+            }
+    return rules
+
+
+def get_rule_key(rule):
+    """Returns the attributes of a rule which are compared to detect changes"""
+    return (
+        rule.get('disabled', False),
+        rule['match']['request'].get('url'),
+        rule['threshold'],
+        rule['period'],
+        rule['action']['mode'],
+        rule['action'].get('timeout'),
+    )
+
+
+def get_diff(rules, existing_rules, delete_stale=True):
+    """Compares the rules to the existing zone rules, returns a dict of create / update / delete lists
+
+    update and delete items include the id of the existing rule
+    """
+    existing_rules = {
+        rule['description']: rule for rule in existing_rules
+        if rule.get('description', '').startswith(DESCRIPTION_PREFIX)
+    }
+    diff = {'create': [], 'update': [], 'delete': []}
+    for description, rule in rules.items():
+        existing_rule = existing_rules.get(description)
+        if not existing_rule:
+            diff['create'].append(rule)
+        elif get_rule_key(existing_rule) != get_rule_key(rule):
+            diff['update'].append(dict(rule, id=existing_rule['id']))
+    if delete_stale:
+        diff['delete'] = [
+            existing_rule for description, existing_rule in existing_rules.items()
+            if description not in rules
+        ]
+    return diff
+
+
+def _is_root_domain_host(request_host, root_domain):
+    return request_host == root_domain or request_host.endswith(f'.{root_domain}')
+
+
+def check_zone_quota(diff, existing_rules, max_rules=DEFAULT_ZONE_MAX_RULES):
+    """Raises an exception if applying the diff would exceed the rules quota of the zone"""
+    num_rules = len(existing_rules) + len(diff['create']) - len(diff['delete'])
+    if num_rules > max_rules:
+        raise Exception(f'Rate limits sync would exceed the zone rules quota: {num_rules} rules > {max_rules} '
+                        f'(existing: {len(existing_rules)}, create: {len(diff["create"])}, '
+                        f'delete: {len(diff["delete"])}), narrow the hosts or increase max rules')
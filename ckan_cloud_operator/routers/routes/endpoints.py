@@ -0,0 +1,91 @@
+from urllib.parse import urlparse
+
+from ckan_cloud_operator import kubectl
+
+
+def is_endpoints_route(route):
+    """Routes with backend-endpoints are load balanced by the router over the pods of the backend service"""
+    return bool(route['spec'].get('backend-endpoints'))
+
+
+# kind of the listed items -> index key
+_INDEX_KINDS = {'Service': 'services', 'Endpoints': 'endpoints'}
+
+
+def get_index(routes):
+    """Returns the services and endpoints of the backend namespaces of the endpoints routes, keyed by (namespace, name)
+
+    Only the namespaces which the routes point to are listed, with a single request per namespace
+    """
+    namespaces = set()
+    for route in routes:
+        if is_endpoints_route(route):
+            backend_service = get_backend_service(_get_backend_url(route))
+            if backend_service:
+                namespaces.add(backend_service[0])
+    index = {key: {} for key in _INDEX_KINDS.values()}
+    for namespace in sorted(namespaces):
+        items = kubectl.get('services,endpoints', namespace=namespace, required=False)
+        for item in (items or {}).get('items', []):
+            key = _INDEX_KINDS.get(item.get('kind'))
+            if key:
+                index[key][(item['metadata']['namespace'], item['metadata']['name'])] = item
+    return index
+
+
+def get_backend_service(backend_url):
+    """Returns a tuple of (namespace, service name, port) for a cluster service backend url, or None"""
+    url = urlparse(backend_url)
+    if not url.hostname:
+        return None
+    parts = url.hostname.split('.')
+    if len(parts) > 2 and '.'.join(parts[2:]) not in ('svc', 'svc.cluster.local'):
+        return None
+    namespace = parts[1] if len(parts) > 1 else 'ckan-cloud'
+    return namespace, parts[0], url.port or (443 if url.scheme == 'https' else 80)
+
+
+def get_backend_servers(backend_url, index):
+    """Returns the sorted urls of the ready pods of the backend url service, or an empty list if not resolved"""
+    backend_service = get_backend_service(backend_url)
+    if not backend_service:
+        return []
+    namespace, service_name, port = backend_service
+    service = index['services'].get((namespace, service_name))
+    endpoints = index['endpoints'].get((namespace, service_name))
+    if not service or not endpoints:
+        return []
+    port_name = None
+    for service_port in service['spec'].get('ports', []):
+        if service_port['port'] == port:
+            port_name = service_port.get('name')
+            break
+    scheme = urlparse(backend_url).scheme or 'http'
+    servers = set()
+    for subset in endpoints.get('subsets') or []:
+        ports = subset.get('ports', [])
+        target_ports = [p['port'] for p in ports if len(ports) == 1 or p.get('name') == port_name]
+        if not target_ports:
+            continue
+        for address in subset.get('addresses') or []:
+            servers.add(f'{scheme}://{address["ip"]}:{target_ports[0]}')
+    return sorted(servers)
+
+
+def get_route_backend_servers(route, index):
+    """Returns the pod urls of an endpoints route, using the index from get_index"""
+    return get_backend_servers(_get_backend_url(route), index)
+
+
+# route name -> (resource version, backend url)
+_BACKEND_URLS = {}
+
+
+def _get_backend_url(route):
+    # cached by route version, to prevent the per route lookups of the instance routes in the routers controller
+    from ckan_cloud_operator.routers.routes import manager as routes_manager
+    route_name, resource_version = route['metadata']['name'], route['metadata'].get('resourceVersion')
+    cached = _BACKEND_URLS.get(route_name)
+    if not resource_version or not cached or cached[0] != resource_version:
+        cached = _BACKEND_URLS[route_name] = resource_version, routes_manager.get_backend_url(route)
+    return cached[1]
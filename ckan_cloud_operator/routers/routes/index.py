@@ -0,0 +1,192 @@
+import base64
+import copy
+import gzip
+import json
+
+from ckan_cloud_operator import kubectl
+from ckan_cloud_operator import logs
+from ckan_cloud_operator.labels import manager as labels_manager
+
+
+INDEX_CONFIGMAP_NAME = 'routers-routes-index'
+
+# the loaded index snapshot, kept for the lifetime of the process
+_INDEX = None
+
+# writes are retried when another process saved the index since it was read
+SAVE_MAX_ATTEMPTS = 5
+
+
+def get_route_hostnames(route, default_root_domain=None):
+    """Returns all the hostnames which are routed by the route, the frontend hostname is first"""
+    spec = route['spec']
+    root_domain = spec['root-domain']
+    if root_domain == 'default':
+        root_domain = default_root_domain or _get_default_root_domain()
+    return [
+        f'{sub_domain}.{root_domain}'
+        for sub_domain in [spec['sub-domain'], *spec.get('extra-no-dns-subdomains', [])]
+    ]
+
+
+def get_hostname_conflicts(routes):
+    """Returns a dict of hostname -> sorted names of the routes which route the same hostname"""
+    hostname_routes = {}
+    for route in routes:
+        for hostname in get_route_hostnames(route):
+            hostname_routes.setdefault(hostname, set()).add(route['metadata']['name'])
+    return {
+        hostname: sorted(route_names)
+        for hostname, route_names in hostname_routes.items()
+        if len(route_names) > 1
+    }
+
+
+def build(routes):
+    """Builds the routes index from a list of CkanCloudRoute objects
+
+    hostnames: hostname -> {route, router, target-type, target-id}
+    targets: target resource id -> route names
+    routers: router name -> route names
+    conflicts: hostname -> route names, for hostnames which are routed by more than one route
+    """
+    index = {'hostnames': {}, 'targets': {}, 'routers': {}, 'conflicts': {}}
+    default_root_domain = None
+    for route in sorted(routes, key=lambda r: r['metadata']['name']):
+        if route['spec'].get('root-domain') == 'default' and not default_root_domain:
+            default_root_domain = _get_default_root_domain()
+        _add_route(index, route, default_root_domain)
+    return index
+
+
+def get_index():
+    """Returns the routes index, builds and saves it from all the routes if there is no saved snapshot"""
+    index = load()
+    if index is None:
+        index = update()
+    return index
+
+
+def load(force=False):
+    """Loads the saved routes index snapshot, returns None if it doesn't exist"""
+    global _INDEX
+    if _INDEX is None or force:
+        _INDEX, _ = _fetch()
+    return _INDEX
+
+
+def update(routes=None):
+    """Rebuilds the routes index and saves it if changed, uses the given routes or fetches all routes"""
+    if routes is None:
+        routes = kubectl.get('CkanCloudRoute')['items']
+    index = build(routes)
+    _modify(lambda saved_index: index, create=True)
+    return index
+
+
+def add_route(route):
+    """Adds a created or updated route to the saved routes index snapshot, if it exists"""
+    return _modify(lambda index: _add_route(index, route) or index)
+
+
+def remove_router_routes(router_name):
+    """Removes the routes of a deleted router from the saved routes index snapshot, if it exists"""
+    return _modify(lambda index: _remove_routes(index, set(index['routers'].get(router_name, []))) or index)
+
+
+def get_hostname_route(hostname):
+    """Returns the route details for the given hostname: {route, router, target-type, target-id}"""
+    return get_index()['hostnames'].get(hostname)
+
+
+def get_target_route_names(target_resource_id):
+    return get_index()['targets'].get(target_resource_id, [])
+
+
+def get_router_route_names(router_name):
+    return get_index()['routers'].get(router_name, [])
+
+
+def _add_route(index, route, default_root_domain=None):
+    route_name = route['metadata']['name']
+    spec = route['spec']
+    for hostname in get_route_hostnames(route, default_root_domain):
+        existing = index['hostnames'].get(hostname)
+        if existing and existing['route'] != route_name:
+            conflicts = index['conflicts'].setdefault(hostname, [existing['route']])
+            if route_name not in conflicts:
+                conflicts.append(route_name)
+        else:
+            index['hostnames'][hostname] = {
+                'route': route_name,
+                'router': spec.get('router_name'),
+                'target-type': spec.get('route-target-type'),
+                'target-id': spec.get('route-target-resource-id'),
+            }
+    for key, value in (('targets', spec.get('route-target-resource-id')), ('routers', spec.get('router_name'))):
+        if value:
+            route_names = index[key].setdefault(value, [])
+            if route_name not in route_names:
+                route_names.append(route_name)
+
+
+def _remove_routes(index, route_names):
+    # a hostname which was also routed by a remaining conflicting route is left out until the next rebuild
+    for hostname, hostname_route in list(index['hostnames'].items()):
+        if hostname_route['route'] in route_names:
+            del index['hostnames'][hostname]
+    for key in ('conflicts', 'targets', 'routers'):
+        for value, value_route_names in list(index[key].items()):
+            value_route_names = [route_name for route_name in value_route_names if route_name not in route_names]
+            if len(value_route_names) > (1 if key == 'conflicts' else 0):
+                index[key][value] = value_route_names
+            else:
+                del index[key][value]
+
+
+def _modify(modify_func, create=False):
+    """Read-modify-write of the saved index, checks the configmap resourceVersion and retries on conflicts
+
+    modify_func gets the saved index and returns the updated index, it's not called if there is no saved index,
+    unless create is set
+    """
+    global _INDEX
+    for attempt in range(SAVE_MAX_ATTEMPTS):
+        saved_index, resource_version = _fetch()
+        if saved_index is None and not create:
+            _INDEX = None
+            return None
+        index = modify_func(copy.deepcopy(saved_index))
+        if index == saved_index or _save(index, resource_version):
+            _INDEX = index
+            return index
+        logs.warning('routes index was saved by another process, retrying', attempt=attempt + 1)
+    raise Exception(f'Failed to save the routes index after {SAVE_MAX_ATTEMPTS} attempts')
+
+
+def _fetch():
+    configmap = kubectl.get(f'configmap {INDEX_CONFIGMAP_NAME}', required=False)
+    if not configmap:
+        return None, None
+    data = configmap.get('binaryData', {}).get('index.json.gz')
+    index = json.loads(gzip.decompress(base64.b64decode(data)).decode()) if data else None
+    return index, configmap['metadata']['resourceVersion']
+
+
+def _save(index, resource_version=None):
+    logs.info('saving routes index', configmap_name=INDEX_CONFIGMAP_NAME, hostnames=len(index['hostnames']),
+              conflicts=len(index['conflicts']))
+    configmap = kubectl.get_resource('v1', 'ConfigMap', INDEX_CONFIGMAP_NAME,
+                                     labels_manager.get_resource_labels({'routes-index': 'true'}))
+    if resource_version:
+        configmap['metadata']['resourceVersion'] = resource_version
+    # compressed, to fit large clusters in the configmap size limit
+    configmap['binaryData'] = {
+        'index.json.gz': base64.b64encode(gzip.compress(json.dumps(index, sort_keys=True).encode())).decode()
+    }
+    return kubectl.create_or_replace(configmap)
+
+
+def _get_default_root_domain():
+    from ckan_cloud_operator.providers.routers import manager as routers_manager
+    return routers_manager.get_default_root_domain()
@@ -24,8 +24,15 @@ def get_module(route):
     return module
 
 
-def list(router_labels):
-    routes = kubectl.get_items_by_labels('CkanCloudRoute', router_labels, required=False)
+def list(router_labels, routes=None):
+    """Returns the routes matching the router labels, filters the given routes list or fetches the routes"""
+    if routes is None:
+        routes = kubectl.get_items_by_labels('CkanCloudRoute', router_labels, required=False)
+    else:
+        routes = [
+            route for route in routes
+            if all(route['metadata'].get('labels', {}).get(k) == v for k, v in router_labels.items())
+        ]
     logs.debug_verbose(router_labels=router_labels, routes=routes)
     _routes = []
     if routes:
@@ -0,0 +1,109 @@
+import time
+import tracemalloc
+
+from ckan_cloud_operator import logs
+from ckan_cloud_operator.routers.traefik import config as traefik_router_config
+from ckan_cloud_operator.routers.traefik import serializer as traefik_serializer
+
+
+# Kubernetes limits the total size of a ConfigMap to 1MiB
+CONFIGMAP_MAX_SIZE_BYTES = 1024 * 1024
+
+DEFAULT_NUM_ROUTES = [1000, 10000, 50000]
+
+ROUTE_TYPES = [
+    'deis-instance-subdomain',
+    'ckan-instance-subdomain',
+    'app-instance-subdomain',
+    'datapusher-subdomain',
+    'backend-url-subdomain',
+]
+
+
+def get_routes(num_routes, root_domains=('example.com', 'example.org')):
+    """Generates synthetic routes of all route types, some with httpauth and extra no-dns sub-domains
+
+    Returns a tuple of (routes, backend_urls), the backend urls replace the cluster lookups of the instance routes
+    """
+    routes = []
+    backend_urls = {}
+    for i in range(num_routes):
+        route_type = ROUTE_TYPES[i % len(ROUTE_TYPES)]
+        spec = {
+            'type': route_type,
+            'root-domain': root_domains[i % len(root_domains)],
+            'sub-domain': f'site{i}',
+            'router_name': 'benchmark',
+        }
+        name = f'cc-benchmark-{i}'
+        if route_type == 'deis-instance-subdomain':
+            spec['deis-instance-id'] = f'instance{i}'
+            backend_urls[name] = f'http://{name}.instance{i}:5000'
+        elif route_type == 'ckan-instance-subdomain':
+            spec['ckan-instance-id'] = f'instance{i}'
+            backend_urls[name] = f'http://nginx.instance{i}:8080'
+        elif route_type == 'app-instance-subdomain':
+            spec['app-instance-id'] = f'app{i}'
+            backend_urls[name] = f'http://app.app{i}:5000'
+        elif route_type == 'datapusher-subdomain':
+            spec['datapusher-name'] = f'datapusher{i}'
+            backend_urls[name] = f'http://datapusher{i}.ckan-cloud:8000'
+        else:
+            spec['backend-url'] = backend_urls[name] = f'http://backend{i}.ckan-cloud:5000'
+        if i % 7 == 0:
+            spec['httpauth-secret'] = f'httpauth-{i}'
+        if i % 11 == 0:
+            spec['extra-no-dns-subdomains'] = [f'www.site{i}', f'old-site{i}']
+        routes.append({'metadata': {'name': name, 'resourceVersion': '1'}, 'spec': spec})
+    return routes, backend_urls
+
+
+def run(num_routes, letsencrypt_cloudflare_email='admin@example.com', serializers=None):
+    """Runs the benchmark for the given number of synthetic routes, without accessing the cluster
+
+    Returns a dict with the config generation time, the time and output size of each serializer and
+    the peak memory allocated while generating and serializing the config.
+    """
+    routes, backend_urls = get_routes(num_routes)
+    result = {'routes': num_routes}
+    config, seconds, peak_memory_mb = _measure(lambda: traefik_router_config.get(
+        routes, letsencrypt_cloudflare_email, backend_urls=backend_urls
+    ))
+    result['generate-seconds'] = seconds
+    result['generate-peak-memory-mb'] = peak_memory_mb
+    for serializer in (serializers or traefik_serializer.SERIALIZERS):
+        data, seconds, peak_memory_mb = _measure(lambda: traefik_serializer.dumps(config, serializer))
+        size = len(data.encode())
+        result[serializer] = {
+            'seconds': seconds,
+            'size-bytes': size,
+            'configmap-limit-percent': round(size / CONFIGMAP_MAX_SIZE_BYTES * 100, 1),
+            'peak-memory-mb': peak_memory_mb,
+        }
+    return result
+
+
+def start(num_routes=None, serializers=None):
+    results = []
+    for n in (num_routes or DEFAULT_NUM_ROUTES):
+        logs.info('Running Traefik config benchmark', num_routes=n)
+        results.append(run(n, serializers=serializers))
+    return results
+
+
+def _measure(func):
+    """Returns a tuple of (return value, seconds, peak memory allocated in MB) of calling the function
+
+    the function is called twice: the timed run is done without tracing memory, which slows down allocations,
+    and memory is traced in a separate run, so that the peaks don't include the previous measurements
+    """
+    start_time = time.time()
+    value = func()
+    seconds = round(time.time() - start_time, 3)
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory_mb = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+    finally:
+        tracemalloc.stop()
+    return value, seconds, peak_memory_mb
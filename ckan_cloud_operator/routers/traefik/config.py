@@ -1,8 +1,12 @@
 import traceback
+import hashlib
+import json
 
 from ckan_cloud_operator import logs
 
 import ckan_cloud_operator.routers.routes.manager as routes_manager
+from ckan_cloud_operator.routers.routes import index as routes_index
+from ckan_cloud_operator.routers.routes import endpoints as route_endpoints
 
 
 def _get_base_config(**kwargs):
@@ -24,26 +28,77 @@ def _get_base_config(**kwargs):
     }, **kwargs)
 
 
-def _get_acme_domains(domains, wildcard_ssl_domain=None, external_domains=False):
+# Let's Encrypt allows up to 100 names per certificate
+ACME_MAX_CERTIFICATE_NAMES = 100
+
+# names per certificate, smaller groups mean less names are re-validated when a hostname is added
+ACME_DEFAULT_GROUP_SIZE = 25
+
+
+def get_acme_domains(domains, wildcard_ssl_domain=None, external_domains=False, group_size=None):
+    """Plans the certificates to request for the given dict of root domain -> sub domains
+
+    Sub domains of a wildcard ssl domain (comma-separated for multiple domains) are covered by a wildcard certificate.
+    Other hostnames are packed into certificates of up to group_size names, using stable hash-based groups,
+    so adding a hostname changes only the certificate of its group.
+    """
+    group_size = int(group_size or ACME_DEFAULT_GROUP_SIZE)
+    assert 1 < group_size <= ACME_MAX_CERTIFICATE_NAMES, f'invalid acme group size: {group_size}'
+    wildcard_ssl_domains = [d.strip() for d in wildcard_ssl_domain.split(',')] if wildcard_ssl_domain else []
     for root_domain, sub_domains in domains.items():
         if external_domains:
             for sub_domain in sub_domains:
                 yield {'main': f'{sub_domain}.{root_domain}'}
-        elif root_domain == wildcard_ssl_domain:
+            continue
+        if root_domain in wildcard_ssl_domains:
             yield {
                 'main': f'*.{root_domain}',
             }
-        else:
+            # the wildcard covers a single level of sub domains
+            sub_domains = [sub_domain for sub_domain in sub_domains if '.' in sub_domain]
+            if not sub_domains:
+                continue
+        hostnames = sorted({f'{sub_domain}.{root_domain}' for sub_domain in sub_domains})
+        if len(hostnames) < group_size:
             yield {
                 'main': root_domain,
-                'sans': [f'{sub_domain}.{root_domain}' for sub_domain in sub_domains]
+                'sans': hostnames
             }
+        else:
+            for _, group_hostnames in _get_acme_hostname_groups(hostnames, group_size):
+                yield {
+                    'main': group_hostnames[0],
+                    **({'sans': group_hostnames[1:]} if len(group_hostnames) > 1 else {})
+                }
+
+
+def _get_acme_hostname_groups(hostnames, group_size, prefix=''):
+    """Splits the hostnames to groups by prefixes of the hostname hash bits
+
+    A group which is larger than group_size is split by the next bit, the group of a hostname
+    depends only on its hash and the size of its group, so adding hostnames doesn't move hostnames between groups
+    """
+    if len(hostnames) <= group_size or len(prefix) >= 64:
+        return [(prefix, hostnames)]
+    groups = {'0': [], '1': []}
+    for hostname in hostnames:
+        groups[_get_hostname_hash_bits(hostname)[len(prefix)]].append(hostname)
+    return [
+        group
+        for bit, bit_hostnames in groups.items() if bit_hostnames
+        for group in _get_acme_hostname_groups(bit_hostnames, group_size, prefix + bit)
+    ]
+
+
+def _get_hostname_hash_bits(hostname):
+    return format(int(hashlib.sha256(hostname.encode()).hexdigest()[:16], 16), '064b')
 
 
 def _add_letsencrypt(dns_provider, config, letsencrypt_cloudflare_email, domains,
-                     wildcard_ssl_domain=None, external_domains=False):
+                     wildcard_ssl_domain=None, external_domains=False, acme_group_size=None):
     logs.info('Adding Letsencrypt acme Traefik configuration', dns_provider=dns_provider,
-              letsencrypt_cloudflare_email=letsencrypt_cloudflare_email, domains=domains,
+              letsencrypt_cloudflare_email=letsencrypt_cloudflare_email,
+              domains={root_domain: len(sub_domains) for root_domain, sub_domains in domains.items()},
               wildcard_ssl_domain=wildcard_ssl_domain, external_domains=external_domains)
     assert dns_provider in ['route53', 'cloudflare']
     config['defaultEntryPoints'].append('https')
@@ -64,18 +119,104 @@ def _add_letsencrypt(dns_provider, config, letsencrypt_cloudflare_email, domains
                 }
             }
         ),
-        'domains': list(_get_acme_domains(domains, wildcard_ssl_domain=wildcard_ssl_domain,
-                                          external_domains=external_domains))
+        'domains': list(get_acme_domains(domains, wildcard_ssl_domain=wildcard_ssl_domain,
+                                         external_domains=external_domains, group_size=acme_group_size))
+    }
+
+
+ENDPOINTS_HEALTH_CHECK_INTERVAL = '10s'
+
+
+def _get_backend(route, backend_url, endpoints_index=None):
+    spec = route['spec']
+    servers = []
+    if endpoints_index is not None and route_endpoints.is_endpoints_route(route):
+        servers = route_endpoints.get_backend_servers(backend_url, endpoints_index)
+        if not servers:
+            logs.warning('no ready endpoints for route, using the service url', route_name=route['metadata']['name'],
+                         backend_url=backend_url)
+    if not servers:
+        return {'servers': {'server1': {'url': backend_url}}}
+    backend = {
+        'servers': {
+            f'server{i}': {'url': url, 'weight': 1}
+            for i, url in enumerate(servers, start=1)
+        },
+        'healthCheck': {
+            'path': spec.get('health-check-path', '/'),
+            'interval': ENDPOINTS_HEALTH_CHECK_INTERVAL,
+        },
     }
+    if spec.get('sticky-sessions'):
+        backend['loadBalancer'] = {'method': 'wrr', 'stickiness': {}}
+    return backend
+
+
+# CKAN static assets, these responses don't depend on cookies or authorization
+DEFAULT_STATIC_ASSETS_PATHS = ['/webassets/', '/base/', '/fanstatic/']
+
+# higher than the default priority of the route frontends, so that static assets paths are matched first
+STATIC_ASSETS_FRONTEND_PRIORITY = 10
+
+# requests with any of these headers are not anonymous, their responses are not marked as public
+NON_ANONYMOUS_REQUEST_HEADERS = ['Cookie', 'Authorization']
 
 
-def _add_route(config, domains, route, enable_ssl_redirect):
+def _get_frontend(route, route_name, hostnames_rule, enable_ssl_redirect):
+    return {
+        'backend': route_name,
+        'passHostHeader': True,
+        'headers': {
+            'SSLRedirect': bool(enable_ssl_redirect)
+        },
+        'routes': {
+            'route1': {
+                'rule': hostnames_rule
+            }
+        },
+        **({
+            'auth': {
+                'basic': {
+                    'usersFile': '/httpauth-' + route['spec']['httpauth-secret'] + '/.htpasswd'
+                }
+            }
+        } if route['spec'].get('httpauth-secret') else {}),
+    }
+
+
+def _get_static_assets_frontends(route, route_name, hostnames_rule, enable_ssl_redirect):
+    """Returns the frontends of the static assets paths of the route, keyed by frontend name suffix
+
+    The public frontend sets a public Cache-Control max-age header on responses to anonymous requests.
+    Requests with cookies or authorization are matched by a higher priority frontend without the header.
+    """
+    max_age = int(route['spec']['static-assets-max-age'])
+    paths = route['spec'].get('static-assets-paths') or DEFAULT_STATIC_ASSETS_PATHS
+    paths_rule = f'{hostnames_rule};PathPrefix:{",".join(paths)}'
+    public_frontend = _get_frontend(route, route_name, paths_rule, enable_ssl_redirect)
+    public_frontend['priority'] = STATIC_ASSETS_FRONTEND_PRIORITY
+    public_frontend['headers']['customResponseHeaders'] = {
+        'Cache-Control': f'public, max-age={max_age}, s-maxage={max_age}'
+    }
+    private_frontend = _get_frontend(route, route_name, paths_rule, enable_ssl_redirect)
+    private_frontend['priority'] = STATIC_ASSETS_FRONTEND_PRIORITY + 1
+    private_frontend['routes'] = {
+        f'route{i}': {'rule': f'{paths_rule};HeadersRegexp:{header},.+'}
+        for i, header in enumerate(NON_ANONYMOUS_REQUEST_HEADERS, start=1)
+    }
+    return {'static-public': public_frontend, 'static-private': private_frontend}
+
+
+def _add_route(config, domains, route, enable_ssl_redirect, endpoints_index=None, backend_urls=None):
     route_name = routes_manager.get_name(route)
-    logs.info(f'adding route to traefik config: {route_name}')
-    logs.debug_verbose(config=config, domains=domains, route=route, enable_ssl_redirect=enable_ssl_redirect)
-    backend_url = routes_manager.get_backend_url(route)
+    logs.debug(f'adding route to traefik config: {route_name}')
+    logs.debug_verbose(route=route, enable_ssl_redirect=enable_ssl_redirect)
+    if backend_urls is not None:
+        backend_url = backend_urls.get(route_name)
+    else:
+        backend_url = routes_manager.get_backend_url(route)
     frontend_hostname = routes_manager.get_frontend_hostname(route)
-    print(f'F/B = {frontend_hostname} {backend_url}')
+    logs.debug(f'F/B = {frontend_hostname} {backend_url}')
     root_domain, sub_domain = routes_manager.get_domain_parts(route)
     domains.setdefault(root_domain, []).append(sub_domain)
     if route['spec'].get('extra-no-dns-subdomains'):
@@ -83,38 +224,85 @@ def _add_route(config, domains, route, enable_ssl_redirect):
     else:
         extra_hostnames = ''
     logs.debug_verbose(route_name=route_name, backend_url=backend_url, frontend_hostname=frontend_hostname, root_domain=root_domain,
-                       sub_domain=sub_domain, domains=domains, extra_hostnames=extra_hostnames)
+                       sub_domain=sub_domain, extra_hostnames=extra_hostnames)
     if backend_url:
-        config['backends'][route_name] = {
-            'servers': {
-                'server1': {
-                    'url': backend_url
-                }
-            }
-        }
-        config['frontends'][route_name] = {
-            'backend': route_name,
-            'passHostHeader': True,
-            'headers': {
-                'SSLRedirect': bool(enable_ssl_redirect)
-            },
-            'routes': {
-                'route1': {
-                    'rule': f'Host:{frontend_hostname}{extra_hostnames}'
-                }
-            },
-            **({
-                'auth': {
-                    'basic': {
-                        'usersFile': '/httpauth-' + route['spec']['httpauth-secret'] + '/.htpasswd'
-                    }
-                }
-            } if route['spec'].get('httpauth-secret') else {}),
-        }
+        config['backends'][route_name] = _get_backend(route, backend_url, endpoints_index)
+        hostnames_rule = f'Host:{frontend_hostname}{extra_hostnames}'
+        config['frontends'][route_name] = _get_frontend(route, route_name, hostnames_rule, enable_ssl_redirect)
+        if route['spec'].get('static-assets-max-age'):
+            if route['spec'].get('httpauth-secret'):
+                logs.warning('static assets max age is not supported for routes with httpauth', route_name=route_name)
+            else:
+                for suffix, frontend in _get_static_assets_frontends(route, route_name, hostnames_rule,
+                                                                     enable_ssl_redirect).items():
+                    config['frontends'][f'{route_name}-{suffix}'] = frontend
+
+
+HOT_RELOAD_RULES_PATH = '/etc-traefik-rules/rules.toml'
+HOT_RELOAD_API_PORT = 8080
+
+
+def get_config_hash_backend_name(config_hash):
+    return f'config-hash-{config_hash}'
+
+
+def get_hot_reload_configs(config):
+    """Splits a full Traefik config to a static config and a rules config which is watched by Traefik
+
+    Returns a tuple of (static_config, rules_config, config_hash)
+    The rules config contains a placeholder backend named after the config hash, so that the loaded
+    rules version can be checked using the Traefik API.
+    """
+    rules_config = {
+        'frontends': config['frontends'],
+        'backends': dict(config['backends']),
+    }
+    config_hash = hashlib.sha256(json.dumps(rules_config, sort_keys=True).encode()).hexdigest()[:16]
+    rules_config['backends'][get_config_hash_backend_name(config_hash)] = {
+        'servers': {'server1': {'url': 'http://127.0.0.1:1'}}
+    }
+    static_config = {k: v for k, v in config.items() if k not in ['frontends', 'backends']}
+    static_config['file'] = {'filename': HOT_RELOAD_RULES_PATH, 'watch': True}
+    static_config['entryPoints'] = dict(static_config['entryPoints'], traefik={'address': f':{HOT_RELOAD_API_PORT}'})
+    static_config['api'] = {'entryPoint': 'traefik', 'dashboard': False}
+    if 'acme' in static_config:
+        # hostnames get a certificate on first use, so the static config (and the pods) don't change with the routes,
+        # only wildcard certificates are requested upfront
+        static_config['acme'] = dict(
+            static_config['acme'], onHostRule=True,
+            domains=[domain for domain in static_config['acme']['domains'] if domain['main'].startswith('*.')]
+        )
+        if not static_config['acme']['domains']:
+            del static_config['acme']['domains']
+    return static_config, rules_config, config_hash
+
+
+def _get_conflicting_route_names(routes, skip_conflicting_routes):
+    """Checks for hostnames which are routed by more than one route
+
+    Raises an exception, or if skip_conflicting_routes - returns the names of the routes which should be skipped,
+    the route with the lowest name keeps the hostname
+    """
+    conflicts = routes_index.get_hostname_conflicts(routes)
+    if not conflicts:
+        return set()
+    for hostname, route_names in conflicts.items():
+        logs.error(f'Conflicting routes for hostname {hostname}: {route_names}')
+    if not skip_conflicting_routes:
+        raise Exception(f'Conflicting route hostnames: {sorted(conflicts)}')
+    return {route_name for route_names in conflicts.values() for route_name in route_names[1:]}
 
 
 def get(routes, letsencrypt_cloudflare_email, enable_access_log=False, wildcard_ssl_domain=None, external_domains=False,
-        dns_provider=None, force=False):
+        dns_provider=None, force=False, acme_group_size=None, compress=False, backend_urls=None,
+        resolve_endpoints=False, skip_conflicting_routes=False):
+    """Returns the Traefik config of the routes
+
+    backend_urls - optional dict of route name -> backend url, used instead of looking up the route backends
+    skip_conflicting_routes - skip the routes which conflict on a hostname instead of failing, even if force
+    resolve_endpoints - route backend-endpoints routes to the pods of the backend service, only hot reload routers
+                        are updated by the routers controller on pod changes, other routers use the service url
+    """
     if not dns_provider:
         dns_provider = 'cloudflare'
     logs.info('Generating traefik configuration', routes_len=len(routes) if routes else 0,
@@ -141,12 +329,25 @@ def get(routes, letsencrypt_cloudflare_email, enable_access_log=False, wildcard_
     else:
         enable_ssl_redirect = False
     logs.info(enable_ssl_redirect=enable_ssl_redirect)
+    conflicting_route_names = _get_conflicting_route_names(routes, skip_conflicting_routes)
+    # services and endpoints of the routes backend namespaces are fetched once, only if used by any route
+    if any(map(route_endpoints.is_endpoints_route, routes)):
+        if resolve_endpoints:
+            endpoints_index = route_endpoints.get_index(routes)
+        else:
+            logs.warning('backend-endpoints routes use the service url, pods are resolved only by hot reload routers')
+            endpoints_index = None
+    else:
+        endpoints_index = None
     logs.info('Adding routes')
     i = 0
     errors = 0
     for route in routes:
+        if routes_manager.get_name(route) in conflicting_route_names:
+            errors += 1
+            continue
         try:
-            _add_route(config, domains, route, enable_ssl_redirect)
+            _add_route(config, domains, route, enable_ssl_redirect, endpoints_index, backend_urls)
             i += 1
         except Exception as e:
             if force:
@@ -163,7 +364,12 @@ def get(routes, letsencrypt_cloudflare_email, enable_access_log=False, wildcard_
         or (dns_provider == 'route53')
     ):
         _add_letsencrypt(dns_provider, config, letsencrypt_cloudflare_email, domains,
-                         wildcard_ssl_domain=wildcard_ssl_domain, external_domains=external_domains)
+                         wildcard_ssl_domain=wildcard_ssl_domain, external_domains=external_domains,
+                         acme_group_size=acme_group_size)
     else:
         logs.info('No valid dns_provider, will not setup SSL', dns_provider=dns_provider)
+    if compress:
+        # Traefik 1.x supports gzip compression only as an entry point option
+        for entry_point in config['entryPoints'].values():
+            entry_point['compress'] = True
     return config
@@ -1,11 +1,13 @@
-import toml
 import time
+import os
 import hashlib
 import json
 
 from ckan_cloud_operator import kubectl
 from ckan_cloud_operator import logs
 from ckan_cloud_operator.routers.traefik import config as traefik_router_config
+from ckan_cloud_operator.routers.traefik import shards as traefik_shards
+from ckan_cloud_operator.routers.traefik import serializer as traefik_serializer
 from ckan_cloud_operator.routers.routes import manager as routes_manager
 from ckan_cloud_operator import cloudflare
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
@@ -13,7 +15,9 @@ from ckan_cloud_operator.labels import manager as labels_manager
 from ckan_cloud_operator.config import manager as config_manager
 
 
-def _get_deployment_spec(router_name, router_type, annotations, image=None, httpauth_secrets=None, dns_provider=None):
+def _get_deployment_spec(router_name, router_type, annotations, image=None, httpauth_secrets=None, dns_provider=None,
+                         shard_index=None, static_config_hash=None):
+    resource_name = _get_resource_name(router_name, shard_index)
     volume_spec = cluster_manager.get_or_create_multi_user_volume_claim(get_label_suffixes(router_name, router_type))
     httpauth_secrets_volume_mounts, httpauth_secrets_volumes = [], []
     if httpauth_secrets:
@@ -38,7 +42,7 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
         'revisionHistoryLimit': 5,
         'template': {
             'metadata': {
-                'labels': get_labels(router_name, router_type, for_deployment=True)
+                'labels': get_labels(router_name, router_type, for_deployment=True, shard_index=shard_index)
             },
             'spec': {
                 'containers': [
@@ -48,7 +52,7 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
                         'ports': [{'containerPort': 80}],
                         'volumeMounts': [
                             {'name': 'etc-traefik', 'mountPath': '/etc-traefik'},
-                            {'name': 'traefik-acme', 'mountPath': '/traefik-acme', 'subPath': f'router-traefik-{router_name}'},
+                            {'name': 'traefik-acme', 'mountPath': '/traefik-acme', 'subPath': resource_name},
                             *httpauth_secrets_volume_mounts,
                         ],
                         'args': ['--configFile=/etc-traefik/traefik.toml'],
@@ -56,13 +60,29 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
                     }
                 ],
                 'volumes': [
-                    {'name': 'etc-traefik', 'configMap': {'name': f'router-traefik-{router_name}'}},
+                    {'name': 'etc-traefik', 'configMap': {'name': resource_name}},
                     dict(volume_spec, name='traefik-acme'),
                     *httpauth_secrets_volumes,
                 ]
             }
         }
     }
+    if static_config_hash:
+        logs.info('Traefik deployment: watching the rules configuration for hot reload')
+        rules_dir = os.path.dirname(traefik_router_config.HOT_RELOAD_RULES_PATH)
+        rules_filename = os.path.basename(traefik_router_config.HOT_RELOAD_RULES_PATH)
+        container = deployment_spec['template']['spec']['containers'][0]
+        container['ports'].append({'containerPort': traefik_router_config.HOT_RELOAD_API_PORT})
+        container['volumeMounts'].append({'name': 'etc-traefik-rules', 'mountPath': rules_dir})
+        volumes = deployment_spec['template']['spec']['volumes']
+        volumes[0]['configMap']['items'] = [{'key': 'traefik.toml', 'path': 'traefik.toml'}]
+        volumes.append({'name': 'etc-traefik-rules', 'configMap': {
+            'name': resource_name, 'items': [{'key': rules_filename, 'path': rules_filename}]
+        }})
+        # the static configuration is not watched, changing it must roll the pods
+        deployment_spec['template']['metadata']['annotations'] = {
+            'ckan-cloud/traefik-static-config-hash': static_config_hash
+        }
     if dns_provider == 'route53':
         logs.info('Traefik deployment: adding SSL support using AWS Route53')
         container = deployment_spec['template']['spec']['containers'][0]
@@ -91,30 +111,44 @@ def _get_deployment_spec(router_name, router_type, annotations, image=None, http
     return deployment_spec
 
 
-def _get_resource_name(router_name):
-    return f'router-traefik-{router_name}'
+def _get_resource_name(router_name, shard_index=None):
+    if shard_index is None:
+        return f'router-traefik-{router_name}'
+    else:
+        return f'router-traefik-{router_name}-shard-{shard_index}'
 
 
-def _update(router_name, spec, annotations, routes):
-    resource_name = _get_resource_name(router_name)
-    router_type = spec['type']
-    cloudflare_email, cloudflare_auth_key = get_cloudflare_credentials()
-    external_domains = spec.get('external-domains')
-    dns_provider = spec.get('dns-provider', 'cloudflare')
-    logs.info('updating traefik deployment', resource_name=resource_name, router_type=router_type,
-              cloudflare_email=cloudflare_email, cloudflare_auth_key_len=len(cloudflare_auth_key) if cloudflare_auth_key else 0,
-              external_domains=external_domains, dns_provider=dns_provider)
-    kubectl.apply(kubectl.get_configmap(
-        resource_name, get_labels(router_name, router_type),
-        {'traefik.toml': toml.dumps(traefik_router_config.get(
-            routes, cloudflare_email,
-            enable_access_log=bool(spec.get('enable-access-log')),
-            wildcard_ssl_domain=spec.get('wildcard-ssl-domain'),
-            external_domains=external_domains,
-            dns_provider=dns_provider,
-            force=True
-        ))}
-    ))
+def is_hot_reload(spec):
+    return bool(spec.get('hot-reload'))
+
+
+def _get_config_data(spec, routes, cloudflare_email):
+    """Returns a tuple of (configmap data, rules config hash), the config hash is None if hot reload is disabled"""
+    config = traefik_router_config.get(
+        routes, cloudflare_email,
+        enable_access_log=bool(spec.get('enable-access-log')),
+        wildcard_ssl_domain=spec.get('wildcard-ssl-domain'),
+        external_domains=spec.get('external-domains'),
+        dns_provider=spec.get('dns-provider', 'cloudflare'),
+        force=True,
+        acme_group_size=spec.get('acme-group-size'),
+        compress=bool(spec.get('compress')),
+        resolve_endpoints=is_hot_reload(spec),
+        skip_conflicting_routes=bool(spec.get('skip-conflicting-routes'))
+    )
+    serializer = spec.get('config-serializer')
+    if is_hot_reload(spec):
+        static_config, rules_config, config_hash = traefik_router_config.get_hot_reload_configs(config)
+        rules_filename = os.path.basename(traefik_router_config.HOT_RELOAD_RULES_PATH)
+        return {
+            'traefik.toml': traefik_serializer.dumps(static_config, serializer),
+            rules_filename: traefik_serializer.dumps(rules_config, serializer)
+        }, config_hash
+    else:
+        return {'traefik.toml': traefik_serializer.dumps(config, serializer)}, None
+
+
+def _run_pre_deployment_hooks(router_name, router_type, routes):
     domains = {}
     httpauth_secrets = []
     for route in routes:
@@ -123,9 +157,14 @@ def _update(router_name, spec, annotations, routes):
         routes_manager.pre_deployment_hook(route, get_labels(router_name, router_type))
         if route['spec'].get('httpauth-secret') and route['spec']['httpauth-secret'] not in httpauth_secrets:
             httpauth_secrets.append(route['spec']['httpauth-secret'])
+    return domains, httpauth_secrets
+
+
+def _apply_load_balancer(router_name, router_type, shard_index=None):
+    resource_name = _get_resource_name(router_name, shard_index)
     load_balancer = kubectl.get_resource(
         'v1', 'Service', f'loadbalancer-{resource_name}',
-        get_labels(router_name, router_type)
+        get_labels(router_name, router_type, shard_index=shard_index)
     )
     load_balancer['spec'] = {
         'ports': [
@@ -133,14 +172,62 @@ def _update(router_name, spec, annotations, routes):
             {'name': '443', 'port': 443},
         ],
         'selector': {
-            'app': get_labels(router_name, router_type, for_deployment=True)['app']
+            'app': get_labels(router_name, router_type, for_deployment=True, shard_index=shard_index)['app']
         },
         'type': 'LoadBalancer'
     }
     kubectl.apply(load_balancer)
-    load_balancer_ip = get_load_balancer_ip(router_name)
+    load_balancer_ip = get_load_balancer_ip(router_name, shard_index=shard_index)
     print(f'load balancer ip: {load_balancer_ip}')
+    return load_balancer_ip
+
+
+def _update_dns_records(domains, dns_provider, load_balancer_ip, cloudflare_email, cloudflare_auth_key):
     from ckan_cloud_operator.providers.routers import manager as routers_manager
+    for root_domain, sub_domains in domains.items():
+        for sub_domain in sub_domains:
+            routers_manager.update_dns_record(
+                dns_provider, sub_domain, root_domain,
+                load_balancer_ip, cloudflare_email, cloudflare_auth_key
+            )
+
+
+def get_static_config_hash(config_data):
+    return hashlib.sha256(config_data['traefik.toml'].encode()).hexdigest()[:16]
+
+
+def _apply_deployment(router_name, router_type, annotations, httpauth_secrets, external_domains, dns_provider,
+                      shard_index=None, config_hash=None, config_data=None):
+    # with hot reload the pods are rolled only when the pod spec or the static configuration changes
+    static_config_hash = get_static_config_hash(config_data) if config_hash else None
+    kubectl.apply(kubectl.get_deployment(
+        _get_resource_name(router_name, shard_index),
+        get_labels(router_name, router_type, for_deployment=True, shard_index=shard_index),
+        _get_deployment_spec(
+            router_name, router_type, annotations,
+            image=('traefik:1.7' if (external_domains or len(httpauth_secrets) > 0) else None),
+            httpauth_secrets=httpauth_secrets,
+            dns_provider=dns_provider,
+            shard_index=shard_index,
+            static_config_hash=static_config_hash
+        ),
+        with_timestamp=not config_hash
+    ))
+
+
+def _update(router_name, spec, annotations, routes):
+    resource_name = _get_resource_name(router_name)
+    router_type = spec['type']
+    cloudflare_email, cloudflare_auth_key = get_cloudflare_credentials()
+    external_domains = spec.get('external-domains')
+    dns_provider = spec.get('dns-provider', 'cloudflare')
+    logs.info('updating traefik deployment', resource_name=resource_name, router_type=router_type,
+              cloudflare_email=cloudflare_email, cloudflare_auth_key_len=len(cloudflare_auth_key) if cloudflare_auth_key else 0,
+              external_domains=external_domains, dns_provider=dns_provider)
+    config_data, config_hash = _get_config_data(spec, routes, cloudflare_email)
+    kubectl.apply(kubectl.get_configmap(resource_name, get_labels(router_name, router_type), config_data))
+    domains, httpauth_secrets = _run_pre_deployment_hooks(router_name, router_type, routes)
+    load_balancer_ip = _apply_load_balancer(router_name, router_type)
     if external_domains:
         from ckan_cloud_operator.providers.routers import manager as routers_manager
         external_domains_router_root_domain = routers_manager.get_default_root_domain()
@@ -152,25 +239,73 @@ def _update(router_name, spec, annotations, routes):
             load_balancer_ip, cloudflare_email, cloudflare_auth_key
         )
     else:
-        for root_domain, sub_domains in domains.items():
-            for sub_domain in sub_domains:
-                routers_manager.update_dns_record(
-                    dns_provider, sub_domain, root_domain,
-                    load_balancer_ip, cloudflare_email, cloudflare_auth_key
-                )
-    kubectl.apply(kubectl.get_deployment(
-        resource_name, get_labels(router_name, router_type, for_deployment=True),
-        _get_deployment_spec(
-            router_name, router_type, annotations,
-            image=('traefik:1.7' if (external_domains or len(httpauth_secrets) > 0) else None),
-            httpauth_secrets=httpauth_secrets,
-            dns_provider=dns_provider
-        )
-    ))
+        _update_dns_records(domains, dns_provider, load_balancer_ip, cloudflare_email, cloudflare_auth_key)
+    _apply_deployment(router_name, router_type, annotations, httpauth_secrets, external_domains, dns_provider,
+                      config_hash=config_hash, config_data=config_data)
+    return config_hash
 
 
-def get_load_balancer_ip(router_name, failfast=False):
-    resource_name = _get_resource_name(router_name)
+def _update_shards(router_name, spec, annotations, routes, num_shards):
+    """Spreads the routes over num_shards Traefik deployments, each with its own configmap and load balancer
+
+    Only shards which have a changed configuration are deployed, DNS records and hooks are updated for all shards.
+    Returns a dict of updated deployment name -> (generation before the update, rules config hash)
+    the generation is None for new deployments, the config hash is None if hot reload is disabled
+    """
+    router_type = spec['type']
+    cloudflare_email, cloudflare_auth_key = get_cloudflare_credentials()
+    dns_provider = spec.get('dns-provider', 'cloudflare')
+    assert not spec.get('external-domains'), 'sharding is not supported for external domains routers'
+    logs.info('updating sharded traefik deployments', router_name=router_name, router_type=router_type,
+              num_shards=num_shards, dns_provider=dns_provider)
+    updated_deployments = {}
+    for shard_index, shard_routes in traefik_shards.group_routes(routes, num_shards).items():
+        resource_name = _get_resource_name(router_name, shard_index)
+        config_data, config_hash = _get_config_data(spec, shard_routes, cloudflare_email)
+        old_configmap = kubectl.get(f'configmap {resource_name}', required=False)
+        old_deployment = kubectl.get(f'deployment {resource_name}', required=False)
+        is_unchanged = old_configmap and old_deployment and old_configmap.get('data', {}) == config_data
+        if is_unchanged:
+            logs.info('shard configuration is unchanged', resource_name=resource_name, routes_len=len(shard_routes))
+        else:
+            logs.info('updating shard', resource_name=resource_name, routes_len=len(shard_routes))
+            kubectl.apply(kubectl.get_configmap(
+                resource_name, get_labels(router_name, router_type, shard_index=shard_index), config_data
+            ))
+        # DNS records and hooks are applied for unchanged shards as well, to repair external changes
+        domains, httpauth_secrets = _run_pre_deployment_hooks(router_name, router_type, shard_routes)
+        load_balancer_ip = _apply_load_balancer(router_name, router_type, shard_index=shard_index)
+        _update_dns_records(domains, dns_provider, load_balancer_ip, cloudflare_email, cloudflare_auth_key)
+        if is_unchanged:
+            continue
+        _apply_deployment(router_name, router_type, annotations, httpauth_secrets, False, dns_provider,
+                          shard_index=shard_index, config_hash=config_hash, config_data=config_data)
+        old_generation = old_deployment.get('metadata', {}).get('generation') if old_deployment else None
+        updated_deployments[resource_name] = old_generation, config_hash
+    _delete_stale_shards(router_name, num_shards)
+    return updated_deployments
+
+
+def _delete_stale_shards(router_name, num_shards):
+    label_prefix = labels_manager.get_label_prefix()
+    deployments = kubectl.get_items_by_labels('deployment', {f'{label_prefix}/router-name': router_name}, required=False)
+    for deployment in deployments or []:
+        shard_index = deployment['metadata'].get('labels', {}).get(f'{label_prefix}/router-shard')
+        if shard_index is not None and int(shard_index) >= num_shards:
+            resource_name = _get_resource_name(router_name, int(shard_index))
+            logs.info('deleting stale router shard', resource_name=resource_name)
+            kubectl.check_call(f'delete --ignore-not-found deployment/{resource_name} configmap/{resource_name} '
+                               f'service/loadbalancer-{resource_name}')
+    if num_shards > 1 and kubectl.get(f'deployment {_get_resource_name(router_name)}', required=False):
+        logs.warning('the unsharded router deployment still exists, it can be deleted once DNS changes propagated',
+                     resource_name=_get_resource_name(router_name))
+
+
+def get_load_balancer_ip(router_name, failfast=False, shard_index=None, snapshot=None):
+    """Waits for the load balancer ip or hostname, if snapshot or failfast - returns None if not available"""
+    resource_name = _get_resource_name(router_name, shard_index)
+    if snapshot is not None:
+        return _get_load_balancer_address(snapshot['services'].get(f'loadbalancer-{resource_name}'))
     while True:
         time.sleep(.2)
         load_balancer = kubectl.get(f'service loadbalancer-{resource_name}', required=False)
@@ -179,17 +314,37 @@ def get_load_balancer_ip(router_name, failfast=False):
                 return None
             else:
                 continue
-        ingresses = load_balancer.get('status', {}).get('loadBalancer', {}).get('ingress', [])
-        if len(ingresses) == 0: continue
-        assert len(ingresses) == 1
-        if cluster_manager.get_provider_id() == 'aws':
-            load_balancer_hostname = ingresses[0].get('hostname')
-            if load_balancer_hostname:
-                return load_balancer_hostname
-        else:
-            load_balancer_ip = ingresses[0].get('ip')
-            if load_balancer_ip:
-                return load_balancer_ip
+        load_balancer_address = _get_load_balancer_address(load_balancer)
+        if load_balancer_address:
+            return load_balancer_address
+
+
+def _get_load_balancer_address(load_balancer):
+    if not load_balancer:
+        return None
+    ingresses = load_balancer.get('status', {}).get('loadBalancer', {}).get('ingress', [])
+    if len(ingresses) == 0:
+        return None
+    assert len(ingresses) == 1
+    if cluster_manager.get_provider_id() == 'aws':
+        return ingresses[0].get('hostname')
+    else:
+        return ingresses[0].get('ip')
+
+
+def get_snapshot():
+    """Fetches the deployments, pods and load balancer services of all the routers, for use by get / get_dns_data"""
+    label_prefix = labels_manager.get_label_prefix()
+    return {
+        'deployments': _get_items_by_name(f'deployment -l {label_prefix}/router-name'),
+        'pods': list(_get_items_by_name('pods -l ckan-cloud/router-name').values()),
+        'services': _get_items_by_name(f'service -l {label_prefix}/router-name'),
+    }
+
+
+def _get_items_by_name(what):
+    items = (kubectl.get(what, required=False) or {}).get('items', [])
+    return {item['metadata']['name']: item for item in items}
 
 
 def get_cloudflare_credentials():
@@ -199,6 +354,9 @@ def get_cloudflare_credentials():
 
 
 def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
+    num_shards = traefik_shards.get_num_shards(spec)
+    if num_shards > 1:
+        return _update_sharded_router(router_name, wait_ready, spec, annotations, routes, num_shards, dry_run=dry_run)
     old_deployment = kubectl.get(f'deployment router-traefik-{router_name}', required=False)
     old_generation = old_deployment.get('metadata', {}).get('generation') if old_deployment else None
     expected_new_generation = old_generation + 1 if old_generation else None
@@ -207,23 +365,18 @@ def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
     else:
         print('Creating new deployment')
     if not dry_run:
+        updated = {}
         annotations.update_status(
             'router', 'created',
-            lambda: _update(router_name, spec, annotations, routes),
+            lambda: updated.update(config_hash=_update(router_name, spec, annotations, routes)),
             force_update=True
         )
-        if expected_new_generation:
-            while True:
-                time.sleep(.2)
-                new_deployment = kubectl.get(f'deployment router-traefik-{router_name}', required=False)
-                if not new_deployment: continue
-                new_generation = new_deployment.get('metadata', {}).get('generation')
-                if not new_generation: continue
-                if new_generation == old_generation: continue
-                if new_generation != expected_new_generation:
-                    raise Exception(f'Invalid generation: {new_generation} (expected: {expected_new_generation})')
-                print(f'new deployment generation: {new_generation}')
-                break
+        if updated.get('config_hash'):
+            _wait_config_hash(_get_resource_name(router_name), updated['config_hash'])
+        elif expected_new_generation:
+            _wait_new_generation(_get_resource_name(router_name), old_generation)
+        # the router was sharded before
+        _delete_stale_shards(router_name, 1)
         if wait_ready:
             print('Waiting for instance to be ready...')
             while time.sleep(2):
@@ -231,21 +384,145 @@ def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
                 print('.')
 
 
-def get(router_name):
-    deployment = kubectl.get(f'deployment/router-traefik-{router_name}', required=False)
-    if deployment:
-        return kubectl.get_deployment_detailed_status(
-            deployment, f'ckan-cloud/router-name={router_name}', 'traefik'
+def _update_sharded_router(router_name, wait_ready, spec, annotations, routes, num_shards, dry_run=False):
+    print(f'Updating sharded router ({num_shards} shards)')
+    if dry_run:
+        for shard_index, shard_routes in traefik_shards.group_routes(routes, num_shards).items():
+            print(f'{_get_resource_name(router_name, shard_index)}: {len(shard_routes)} routes')
+        return
+    updated_deployments = {}
+    annotations.update_status(
+        'router', 'created',
+        lambda: updated_deployments.update(_update_shards(router_name, spec, annotations, routes, num_shards)),
+        force_update=True
+    )
+    for resource_name, (old_generation, config_hash) in updated_deployments.items():
+        if config_hash:
+            _wait_config_hash(resource_name, config_hash)
+        elif old_generation:
+            _wait_new_generation(resource_name, old_generation)
+    if wait_ready:
+        print('Waiting for shards to be ready...')
+        while not get(router_name, num_shards=num_shards)['ready']:
+            time.sleep(2)
+            print('.')
+
+
+def _wait_new_generation(resource_name, old_generation):
+    expected_new_generation = old_generation + 1
+    while True:
+        time.sleep(.2)
+        new_deployment = kubectl.get(f'deployment {resource_name}', required=False)
+        if not new_deployment: continue
+        new_generation = new_deployment.get('metadata', {}).get('generation')
+        if not new_generation: continue
+        if new_generation == old_generation: continue
+        if new_generation != expected_new_generation:
+            raise Exception(f'Invalid generation: {new_generation} (expected: {expected_new_generation})')
+        print(f'new deployment generation: {new_generation}')
+        break
+
+
+def _wait_config_hash(resource_name, config_hash, timeout_seconds=600):
+    """Waits until all the running Traefik pods of the deployment loaded the rules config with the given hash"""
+    print(f'Waiting for pods to load config hash: {config_hash}')
+    start_time = time.time()
+    while True:
+        loaded_config_hashes = get_loaded_config_hashes(resource_name)
+        pending_pod_names = [
+            pod_name for pod_name, loaded_config_hash in loaded_config_hashes.items()
+            if loaded_config_hash != config_hash
+        ]
+        if len(loaded_config_hashes) > 0 and len(pending_pod_names) == 0:
+            print(f'all pods loaded config hash: {config_hash}')
+            break
+        if time.time() - start_time > timeout_seconds:
+            raise Exception(f'Timed out waiting for pods to load config hash {config_hash}: {pending_pod_names}')
+        time.sleep(5)
+
+
+def get_loaded_config_hashes(resource_name):
+    """Returns a dict of pod name -> rules config hash loaded by the pod (or None if unknown)
+
+    Queries the Traefik API of each running pod via the Kubernetes API server pod proxy
+    """
+    deployment = kubectl.get(f'deployment {resource_name}', required=False)
+    if not deployment:
+        return {}
+    pods = kubectl.get_items_by_labels('pod', deployment['spec']['selector']['matchLabels'], required=False)
+    config_hash_backend_prefix = traefik_router_config.get_config_hash_backend_name('')
+    api_port = traefik_router_config.HOT_RELOAD_API_PORT
+    loaded_config_hashes = {}
+    for pod in pods or []:
+        if pod['metadata'].get('deletionTimestamp'): continue
+        pod_name = pod['metadata']['name']
+        namespace = pod['metadata']['namespace']
+        returncode, output = kubectl.getstatusoutput(
+            f'get --raw /api/v1/namespaces/{namespace}/pods/{pod_name}:{api_port}/proxy/api/providers/file/backends'
         )
+        loaded_config_hash = None
+        if returncode == 0:
+            try:
+                backends = json.loads(output)
+            except ValueError:
+                backends = {}
+            for backend_name in backends:
+                if backend_name.startswith(config_hash_backend_prefix):
+                    loaded_config_hash = backend_name.replace(config_hash_backend_prefix, '', 1)
+        loaded_config_hashes[pod_name] = loaded_config_hash
+    return loaded_config_hashes
+
+
+def get(router_name, num_shards=1, snapshot=None):
+    """Returns the deployment status, uses the resources from get_snapshot if provided"""
+    if num_shards > 1:
+        shards = {
+            _get_resource_name(router_name, shard_index): _get_deployment_status(router_name, shard_index, snapshot)
+            for shard_index in range(num_shards)
+        }
+        return {'ready': all(shard['ready'] for shard in shards.values()), 'shards': shards}
+    else:
+        return _get_deployment_status(router_name, snapshot=snapshot)
+
+
+def _get_deployment_status(router_name, shard_index=None, snapshot=None):
+    resource_name = _get_resource_name(router_name, shard_index)
+    if snapshot is None:
+        deployment = kubectl.get(f'deployment/{resource_name}', required=False)
+    else:
+        deployment = snapshot['deployments'].get(resource_name)
+    if deployment:
+        pod_labels = {'ckan-cloud/router-name': router_name}
+        if shard_index is not None:
+            pod_labels[f'{labels_manager.get_label_prefix()}/router-shard'] = str(shard_index)
+        pod_label_selector = ','.join(f'{k}={v}' for k, v in pod_labels.items())
+        pods = None if snapshot is None else [
+            pod for pod in snapshot['pods']
+            if all(pod['metadata'].get('labels', {}).get(k) == v for k, v in pod_labels.items())
+        ]
+        return kubectl.get_deployment_detailed_status(deployment, pod_label_selector, 'traefik', pods=pods)
     else:
         return {'ready': False}
 
 
-def get_dns_data(router_name, router, failfast=False):
+def get_dns_data(router_name, router, failfast=False, snapshot=None):
     external_domains = router['spec'].get('external-domains')
-    data = {
-        'load-balancer-ip': get_load_balancer_ip(router_name, failfast=failfast),
-    }
+    num_shards = traefik_shards.get_num_shards(router['spec'])
+    if num_shards > 1:
+        data = {
+            'shards': {
+                _get_resource_name(router_name, shard_index): {
+                    'load-balancer-ip': get_load_balancer_ip(
+                        router_name, failfast=failfast, shard_index=shard_index, snapshot=snapshot
+                    )
+                }
+                for shard_index in range(num_shards)
+            }
+        }
+    else:
+        data = {
+            'load-balancer-ip': get_load_balancer_ip(router_name, failfast=failfast, snapshot=snapshot),
+        }
     if external_domains:
         from ckan_cloud_operator.providers.routers import manager as routers_manager
         external_domains_router_root_domain = routers_manager.get_default_root_domain()
@@ -263,10 +540,16 @@ def get_label_suffixes(router_name, router_type):
     }
 
 
-def get_labels(router_name, router_type, for_deployment=False):
+def get_labels(router_name, router_type, for_deployment=False, shard_index=None):
     label_prefix = labels_manager.get_label_prefix()
-    extra_labels = {'app': f'{label_prefix}-router-{router_name}'} if for_deployment else {}
+    label_suffixes = get_label_suffixes(router_name, router_type)
+    if shard_index is None:
+        app_name = f'{label_prefix}-router-{router_name}'
+    else:
+        app_name = f'{label_prefix}-router-{router_name}-shard-{shard_index}'
+        label_suffixes['router-shard'] = str(shard_index)
+    extra_labels = {'app': app_name} if for_deployment else {}
     return labels_manager.get_resource_labels(
-        get_label_suffixes(router_name, router_type),
+        label_suffixes,
         extra_labels=extra_labels
     )
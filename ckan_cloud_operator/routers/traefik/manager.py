@@ -3,6 +3,10 @@ from ckan_cloud_operator import logs
 from ckan_cloud_operator.routers.annotations import CkanRoutersAnnotations
 from ckan_cloud_operator.infra import CkanInfra
 from ckan_cloud_operator.routers.traefik import deployment as traefik_deployment
+from ckan_cloud_operator.routers.traefik import shards as traefik_shards
+from ckan_cloud_operator.routers.traefik import config as traefik_router_config
+from ckan_cloud_operator.routers.routes import manager as routes_manager
+from ckan_cloud_operator.routers.routes import index as routes_index
 
 
 def create(router):
@@ -62,17 +66,23 @@ def delete(router_name):
             ) != 0:
                 success = False
         assert success
+        routes_index.remove_router_routes(router_name)
     else:
         raise Exception('Deletion failed')
 
 
-def get_dns_data(router_name, router, failfast=False):
-    return traefik_deployment.get_dns_data(router_name, router, failfast=failfast)
+def get_dns_data(router_name, router, failfast=False, snapshot=None):
+    return traefik_deployment.get_dns_data(router_name, router, failfast=failfast, snapshot=snapshot)
 
 
-def get(router_name, attr='deployment', router=None, failfast=False):
-    deployment_data = lambda: traefik_deployment.get(router_name)
-    dns_data = lambda: get_dns_data(router_name, router, failfast=failfast)
+def get_snapshot():
+    return traefik_deployment.get_snapshot()
+
+
+def get(router_name, attr='deployment', router=None, failfast=False, snapshot=None):
+    num_shards = traefik_shards.get_num_shards(router['spec']) if router else 1
+    deployment_data = lambda: traefik_deployment.get(router_name, num_shards=num_shards, snapshot=snapshot)
+    dns_data = lambda: get_dns_data(router_name, router, failfast=failfast, snapshot=snapshot)
     if attr == 'deployment':
         return deployment_data()
     elif attr == 'dns':
@@ -87,6 +97,31 @@ def update(router_name, wait_ready, spec, annotations, routes, dry_run=False):
     return traefik_deployment.update(router_name, wait_ready, spec, annotations, routes, dry_run=dry_run)
 
 
+def get_acme_plan(router_name, spec, routes):
+    """Returns the planned Let's Encrypt certificates of the router, per shard for sharded routers"""
+    num_shards = traefik_shards.get_num_shards(spec)
+    shards_routes = traefik_shards.group_routes(routes, num_shards) if num_shards > 1 else {None: routes}
+    plan = {}
+    for shard_index, shard_routes in shards_routes.items():
+        domains = {}
+        for route in shard_routes:
+            root_domain, sub_domain = routes_manager.get_domain_parts(route)
+            domains.setdefault(root_domain, []).append(sub_domain)
+        certificates = [
+            {'main': domain['main'], 'names': 1 + len(domain.get('sans', [])), 'sans': domain.get('sans', [])}
+            for domain in traefik_router_config.get_acme_domains(
+                domains, wildcard_ssl_domain=spec.get('wildcard-ssl-domain'),
+                external_domains=spec.get('external-domains'), group_size=spec.get('acme-group-size')
+            )
+        ]
+        plan[router_name if shard_index is None else f'{router_name}-shard-{shard_index}'] = {
+            'certificates': certificates,
+            'total-certificates': len(certificates),
+            'total-names': sum(certificate['names'] for certificate in certificates),
+        }
+    return plan
+
+
 def _init_router(router_name):
     router = kubectl.get(f'CkanCloudRouter {router_name}')
     assert router['spec']['type'] == 'traefik'
@@ -0,0 +1,72 @@
+import io
+import json
+import re
+
+import toml
+
+
+SERIALIZERS = ['toml', 'fast']
+
+_BARE_KEY_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def dumps(config, serializer=None):
+    """Serializes a Traefik config to TOML using the given serializer (default: toml)"""
+    if not serializer or serializer == 'toml':
+        return toml.dumps(config)
+    assert serializer == 'fast', f'invalid config serializer: {serializer} (supported: {SERIALIZERS})'
+    f = io.StringIO()
+    dump(config, f)
+    return f.getvalue()
+
+
+def dump(config, f):
+    """Streams a Traefik config as TOML to the given file object
+
+    Supports the value types used in the Traefik config: dicts, lists of dicts, lists of scalars, strings, bools, numbers.
+    Writes each table once, without building intermediate copies of the config, so it scales to large routers.
+    """
+    _dump_table(f, [], config)
+
+
+def _dump_table(f, path, table, array_item=False):
+    sub_tables = []
+    scalars = []
+    for key, value in table.items():
+        if isinstance(value, dict):
+            sub_tables.append((key, value, False))
+        elif isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            sub_tables.append((key, value, True))
+        else:
+            scalars.append((key, value))
+    if path and (array_item or scalars or not sub_tables):
+        header = '.'.join(path)
+        f.write(f'[[{header}]]\n' if array_item else f'[{header}]\n')
+    for key, value in scalars:
+        f.write(f'{_dump_key(key)} = {_dump_value(value)}\n')
+    if path and (array_item or scalars or not sub_tables):
+        f.write('\n')
+    for key, value, is_array in sub_tables:
+        sub_path = [*path, _dump_key(key)]
+        if is_array:
+            for item in value:
+                _dump_table(f, sub_path, item, array_item=True)
+        else:
+            _dump_table(f, sub_path, value)
+
+
+def _dump_key(key):
+    return key if _BARE_KEY_RE.match(key) else json.dumps(key, ensure_ascii=False)
+
+
+def _dump_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (int, float)):
+        return str(value)
+    elif isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    elif isinstance(value, list):
+        return '[' + ', '.join(_dump_value(item) for item in value) + ']'
+    else:
+        raise Exception(f'Unsupported Traefik config value: {value}')
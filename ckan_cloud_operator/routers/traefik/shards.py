@@ -0,0 +1,51 @@
+import bisect
+import hashlib
+from functools import lru_cache
+
+from ckan_cloud_operator.routers.routes import manager as routes_manager
+
+
+# number of points each shard gets on the hash ring, more points give a more even spread of hostnames
+VIRTUAL_NODES_PER_SHARD = 100
+
+
+def get_num_shards(router_spec):
+    """Returns the number of Traefik shards configured for the router, 1 means sharding is disabled"""
+    num_shards = int((router_spec or {}).get('shards') or 1)
+    assert num_shards > 0, f'invalid number of router shards: {num_shards}'
+    return num_shards
+
+
+def get_shard_index(hostname, num_shards):
+    """Returns the shard which serves the given hostname
+
+    Uses consistent hashing, so changing the number of shards only moves ~1/num_shards of the hostnames
+    """
+    if num_shards < 2:
+        return 0
+    ring_hashes, ring_shards = _get_ring(num_shards)
+    i = bisect.bisect(ring_hashes, _hash(hostname)) % len(ring_hashes)
+    return ring_shards[i]
+
+
+def group_routes(routes, num_shards):
+    """Returns a dict of shard index -> list of routes, including shards without routes"""
+    shards = {shard_index: [] for shard_index in range(num_shards)}
+    for route in routes:
+        hostname = routes_manager.get_frontend_hostname(route)
+        shards[get_shard_index(hostname, num_shards)].append(route)
+    return shards
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+@lru_cache(maxsize=16)
+def _get_ring(num_shards):
+    ring = sorted(
+        (_hash(f'shard-{shard_index}-{node}'), shard_index)
+        for shard_index in range(num_shards)
+        for node in range(VIRTUAL_NODES_PER_SHARD)
+    )
+    return [h for h, _ in ring], [shard_index for _, shard_index in ring]
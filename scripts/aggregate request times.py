@@ -3,48 +3,32 @@ import datetime
 import collections
 import yaml
 
-import tabulator
 from dataflows import Flow, printer, dump_to_path
 
 from ckan_cloud_operator.drivers.jenkins import driver as jenkins_driver
 from ckan_cloud_operator.providers.ckan import manager as ckan_manager
-from ckan_cloud_operator import logs
+from ckan_cloud_operator.monitoring.access_logs import latency
 
 
 # https://jenkins.example.com/job/get%20instance%20request%20time/api/json
 REQUEST_TIMES_API_URL = os.environ.get('REQUEST_TIMES_API_URL')
 
+# processed builds are cached in this path, so only new builds are fetched on each run
+REQUEST_TIMES_CACHE_PATH = os.environ.get('REQUEST_TIMES_CACHE_PATH', 'data/request_times_builds')
 
-def process_build(build, jenkins_user_token):
-    build_url = '{}api/json'.format(build['url'])
-    build = jenkins_driver.curl(*jenkins_user_token, build_url)
-    try:
-        build_timestamp = datetime.datetime.utcfromtimestamp(build["timestamp"]/1000)
-    except Exception:
-        build_timestamp = None
-    if build_timestamp:
-        output_url = '{}artifact/output.csv'.format(build['url'])
-        try:
-            with tabulator.Stream(output_url, headers=1, http_session=jenkins_driver.get_session(*jenkins_user_token)) as stream:
-                for row in stream.iter(keyed=True):
-                    row['timestamp'] = build_timestamp
-                    yield row
-        except tabulator.exceptions.HTTPError:
-            print('failed to get build artifact', build)
-    else:
-        print('failed to get build timestamp', build)
+REQUEST_TIMES_MAX_WORKERS = int(os.environ.get('REQUEST_TIMES_MAX_WORKERS', '8'))
 
 
 def get_builds(request_times_api_url, stats):
     jenkins_user_token = ckan_manager.get_jenkins_token('ckan-cloud-operator-jenkins-creds')
-    builds = jenkins_driver.curl(*jenkins_user_token, request_times_api_url)['builds']
-    for build in builds:
+    session = jenkins_driver.get_session(*jenkins_user_token, pool_maxsize=REQUEST_TIMES_MAX_WORKERS)
+    for build, rows in jenkins_driver.harvest_builds(session, request_times_api_url, 'output.csv',
+                                                     REQUEST_TIMES_CACHE_PATH, max_workers=REQUEST_TIMES_MAX_WORKERS):
         stats['builds'] += 1
-        for row in process_build(build, jenkins_user_token):
+        build_timestamp = datetime.datetime.utcfromtimestamp(build['timestamp'] / 1000) if build['timestamp'] else None
+        for row in rows:
             stats['rows'] += 1
-            yield row
-        # if stats['builds'] > 2:
-        #     break
+            yield dict(row, timestamp=build_timestamp)
 
 
 def aggregate_instance_stats(instance_stats, metadata):
@@ -72,6 +56,8 @@ def aggregate_instance_stats(instance_stats, metadata):
             instance_stats[f'{instance_id}-first-30-requests-seconds'] += minutes * 60 + seconds
         if instance_stats[f'{instance_id}-total-requests'] <= 90:
             instance_stats[f'{instance_id}-first-90-requests-seconds'] += minutes * 60 + seconds
+        latency.add(metadata.setdefault('latency-sketches', {}).setdefault(instance_id, latency.new()),
+                    minutes * 60 + seconds)
         if minutes > 0 or seconds > 10:
             instance_stats[f'{instance_id}-requests-exceed-10-seconds'] += 1
         elif seconds > 5:
@@ -107,6 +93,7 @@ def get_instance_stats_data(instance_stats, metadata):
             'avg_response_seconds': avg_total,
             'avg_first_30_requests': avg_first_30_requests,
             'avg_first_90_requests': avg_first_90_requests,
+            **latency.get_summary(metadata['latency-sketches'][instance_id], prefix='response_seconds_', suffix=''),
             **invalid_status_codes,
             **invalid_request_times
         }
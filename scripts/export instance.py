@@ -12,6 +12,8 @@ from ckan_cloud_operator.gitlab import CkanGitlab
 from ckan_cloud_operator.config import manager as config_manager
 from ckan_cloud_operator.drivers.gcloud import driver as gcloud_driver
 from ckan_cloud_operator.providers.cluster import manager as cluster_manager
+from ckan_cloud_operator.providers.routers import manager as routers_manager
+from ckan_cloud_operator.routers.routes import index as routes_index
 
 
 INSTANCE_NAME = os.environ.get('INSTANCE_NAME')
@@ -39,15 +41,11 @@ def get_instance_image(instance_id):
 def get_instance_id(instance_name, allowed_instance_names):
     if allowed_instance_names:
         assert instance_name in allowed_instance_names.splitlines(), f'invalid instance name: {instance_name}'
-    instance_id = {
-      route['spec']['sub-domain'].replace('cc-p-', ''): route['spec']['deis-instance-id']
-      for route  in kubectl.get('ckancloudroute')['items']
-      if (
-        route['spec']['route-target-type'] == 'deis-instance'
-        and route['spec']['root-domain'] == 'default'
-        and route['spec']['sub-domain'].startswith('cc-p-')
-      )
-    }.get(instance_name)
+    route = routes_index.get_hostname_route(f'cc-p-{instance_name}.{routers_manager.get_default_root_domain()}')
+    # the index snapshot might include deleted routes
+    if route and not kubectl.get(f'CkanCloudRoute {route["route"]}', required=False):
+        route = None
+    instance_id = route['target-id'] if route and route['target-type'] == 'deis-instance' else None
     assert instance_id, f'Failed to find matching instance_id for name {instance_name}'
     return instance_id
 
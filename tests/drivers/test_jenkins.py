@@ -0,0 +1,93 @@
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from ckan_cloud_operator.drivers.jenkins import driver
+
+
+JOB_URL = 'https://jenkins.example.com/job/request-times/'
+
+
+def _get_response(json_data=None, text='', status_code=200):
+    res = MagicMock(status_code=status_code, text=text)
+    res.json.return_value = json_data
+    return res
+
+
+def _get_session(builds, artifacts):
+    session = MagicMock()
+
+    def _get(url, params=None):
+        if url == f'{JOB_URL}api/json':
+            return _get_response({'builds': builds})
+        for build in builds:
+            if url == '{}api/json'.format(build['url']):
+                return _get_response(dict(build, timestamp=1559383200000))
+            if url == '{}artifact/output.csv'.format(build['url']):
+                if build['number'] in artifacts:
+                    return _get_response(text=artifacts[build['number']])
+                return _get_response(status_code=404)
+        raise Exception(f'unexpected url: {url}')
+
+    session.get.side_effect = _get
+    return session
+
+
+class JenkinsHarvestBuildsTestCase(unittest.TestCase):
+
+    def _harvest(self, session, cache_path):
+        return list(driver.harvest_builds(session, f'{JOB_URL}api/json', 'output.csv', cache_path, max_workers=2))
+
+    def test_harvest_builds_fetches_only_new_builds(self):
+        builds = [
+            {'number': 3, 'url': f'{JOB_URL}3/', 'building': True},
+            {'number': 2, 'url': f'{JOB_URL}2/', 'timestamp': 1559386800000, 'result': 'SUCCESS'},
+            {'number': 1, 'url': f'{JOB_URL}1/', 'result': 'SUCCESS'},
+        ]
+        artifacts = {1: 'instance_id,seconds\nsite1,1.5\nsite2,2\n', 2: 'instance_id,seconds\nsite1,3\n'}
+        with tempfile.TemporaryDirectory() as cache_path:
+            results = self._harvest(_get_session(builds, artifacts), cache_path)
+            self.assertEqual([build['number'] for build, _ in results], [2, 1])
+            self.assertEqual(results[1][0]['timestamp'], 1559383200000)
+            self.assertEqual(results[1][1], [{'instance_id': 'site1', 'seconds': '1.5'},
+                                             {'instance_id': 'site2', 'seconds': '2'}])
+            session = _get_session(builds, artifacts)
+            self.assertEqual(self._harvest(session, cache_path), results)
+            session.get.assert_called_once()
+
+    def test_harvest_builds_retries_missing_artifacts(self):
+        builds = [{'number': 1, 'url': f'{JOB_URL}1/', 'timestamp': 1559383200000, 'result': 'FAILURE'}]
+        with tempfile.TemporaryDirectory() as cache_path:
+            self.assertEqual(self._harvest(_get_session(builds, {}), cache_path)[0][1], [])
+            session = _get_session(builds, {1: 'instance_id,seconds\nsite1,1.5\n'})
+            self.assertEqual(self._harvest(session, cache_path)[0][1], [{'instance_id': 'site1', 'seconds': '1.5'}])
+            self.assertEqual(session.get.call_count, 2)
+
+    def test_harvest_builds_retries_failed_fetches(self):
+        builds = [{'number': 1, 'url': f'{JOB_URL}1/', 'timestamp': 1559383200000, 'result': 'SUCCESS'}]
+        artifacts = {1: 'instance_id,seconds\nsite1,1.5\n'}
+        with tempfile.TemporaryDirectory() as cache_path:
+            session = _get_session(builds, artifacts)
+            get = session.get.side_effect
+
+            def _get(url, params=None):
+                if url != f'{JOB_URL}api/json':
+                    raise Exception('connection error')
+                return get(url, params)
+
+            session.get.side_effect = _get
+            self.assertEqual(self._harvest(session, cache_path), [({'number': 1, 'url': f'{JOB_URL}1/',
+                                                                   'timestamp': 1559383200000}, [])])
+            results = self._harvest(_get_session(builds, artifacts), cache_path)
+            self.assertEqual(results[0][1], [{'instance_id': 'site1', 'seconds': '1.5'}])
+            session = _get_session(builds, artifacts)
+            self.assertEqual(self._harvest(session, cache_path), results)
+            session.get.assert_called_once()
+
+    def test_harvest_builds_retries_running_builds(self):
+        builds = [{'number': 1, 'url': f'{JOB_URL}1/', 'timestamp': 1559383200000, 'result': None}]
+        with tempfile.TemporaryDirectory() as cache_path:
+            self.assertEqual(self._harvest(_get_session(builds, {1: 'instance_id\n'}), cache_path)[0][1], [])
+            builds[0]['result'] = 'SUCCESS'
+            session = _get_session(builds, {1: 'instance_id,seconds\nsite1,1.5\n'})
+            self.assertEqual(self._harvest(session, cache_path)[0][1], [{'instance_id': 'site1', 'seconds': '1.5'}])
@@ -0,0 +1,166 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+import psycopg2
+
+from ckan_cloud_operator.drivers.postgres import driver
+
+
+# other tests replace the driver connect function with a mock
+_connect = driver.connect
+
+
+def _get_connection():
+    conn = MagicMock(closed=0, autocommit=False)
+
+    def _close():
+        conn.closed = 1
+
+    conn.close.side_effect = _close
+    return conn
+
+
+@patch('ckan_cloud_operator.drivers.postgres.driver.psycopg2.connect')
+class PostgresDriverPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        driver.close_pool()
+
+    def tearDown(self):
+        driver.close_pool()
+
+    def test_connections_are_reused(self, connect):
+        connect.side_effect = lambda *args, **kwargs: _get_connection()
+        with _connect('postgresql://admin@db1/postgres', pooled=True) as conn1:
+            pass
+        with _connect('postgresql://admin@db1/postgres', pooled=True) as conn2:
+            self.assertIs(conn2, conn1)
+            with _connect('postgresql://admin@db1/postgres', pooled=True) as conn3:
+                self.assertIsNot(conn3, conn1)
+        with _connect('postgresql://admin@db2/postgres', pooled=True) as conn4:
+            self.assertIsNot(conn4, conn1)
+        self.assertEqual(connect.call_count, 3)
+        self.assertEqual(driver.get_pool_stats(), {'keys': 2, 'idle-connections': 3})
+
+    def test_max_size(self, connect):
+        connect.side_effect = lambda *args, **kwargs: _get_connection()
+        connections = [_connect('postgresql://admin@db1/postgres', pooled=True) for _ in range(driver.POOL_MAX_SIZE + 2)]
+        conns = [c.__enter__() for c in connections]
+        for c in connections:
+            c.__exit__(None, None, None)
+        self.assertEqual(driver.get_pool_stats()['idle-connections'], driver.POOL_MAX_SIZE)
+        self.assertEqual(len([conn for conn in conns if conn.closed]), 2)
+
+    def test_session_is_reset(self, connect):
+        connect.side_effect = lambda *args, **kwargs: _get_connection()
+        with _connect('postgresql://admin@db1/postgres', pooled=True) as conn:
+            conn.autocommit = True
+        self.assertFalse(conn.autocommit)
+        conn.cursor.return_value.__enter__.return_value.execute.assert_called_once_with('DISCARD ALL')
+
+    def test_broken_and_idle_connections_are_evicted(self, connect):
+        connect.side_effect = lambda *args, **kwargs: _get_connection()
+        with _connect('postgresql://admin@db1/postgres', pooled=True) as conn1:
+            pass
+        conn1.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError()
+        with patch('ckan_cloud_operator.drivers.postgres.driver.time.time',
+                   return_value=driver.time.time() + driver.POOL_HEALTH_CHECK_IDLE_SECONDS + 1):
+            with _connect('postgresql://admin@db1/postgres', pooled=True) as conn2:
+                self.assertIsNot(conn2, conn1)
+            self.assertTrue(conn1.closed)
+        with patch('ckan_cloud_operator.drivers.postgres.driver.time.time',
+                   return_value=driver.time.time() + driver.POOL_HEALTH_CHECK_IDLE_SECONDS + driver.POOL_MAX_IDLE_SECONDS + 2):
+            with _connect('postgresql://admin@db2/postgres', pooled=True):
+                pass
+        self.assertTrue(conn2.closed)
+        self.assertEqual(driver.get_pool_stats()['idle-connections'], 1)
+
+    def test_not_pooled(self, connect):
+        connect.side_effect = lambda *args, **kwargs: _get_connection()
+        with _connect('postgresql://admin@db1/postgres') as conn:
+            pass
+        self.assertTrue(conn.closed)
+        self.assertEqual(driver.get_pool_stats()['idle-connections'], 0)
+
+
+class PostgresDriverCatalogTestCase(unittest.TestCase):
+
+    def _get_connection(self, rows):
+        conn = MagicMock(autocommit=False)
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.__iter__.side_effect = lambda: iter(rows)
+        return conn, cur
+
+    def _get_row(self, role_name, db_name):
+        return (
+            (role_name, *[None] * (len(driver.ROLE_FIELDS) - 1)),
+            (db_name, *[None] * (len(driver.DB_FIELDS) - 1)),
+        )
+
+    def test_list_db_names_full_single_query(self):
+        rows = [sum(self._get_row(name, name), ()) for name in ('site1', 'site2')]
+        rows.append(sum(self._get_row(None, 'postgres-db'), ()))
+        conn, cur = self._get_connection(rows)
+        with self.assertRaisesRegex(Exception, r"Failed to get role for following dbs: \['postgres-db'\]"):
+            results = []
+            for data in driver.list_db_names(conn, validate=True):
+                results.append(data)
+        self.assertEqual(cur.execute.call_count, 1)
+        self.assertIn('from pg_database d left join pg_roles r', cur.execute.call_args[0][0])
+        self.assertEqual([(r['role'] or {}).get('rolname') for r in results], ['site1', 'site2', None])
+        self.assertEqual([r['db']['datname'] for r in results], ['site1', 'site2', 'postgres-db'])
+        self.assertTrue(conn.cursor.call_args[1]['name'])
+
+    def test_get_db_role_info(self):
+        conn, cur = self._get_connection([sum(self._get_row('site1', None), ())])
+        data = driver.get_db_role_info(conn, 'site1')
+        self.assertEqual(data['role']['rolname'], 'site1')
+        self.assertIsNone(data['db'])
+        self.assertEqual(cur.execute.call_args[0][1], ('site1',))
+        conn, cur = self._get_connection([])
+        self.assertEqual(driver.get_db_role_info(conn, 'site2'), {'role': None, 'db': None})
+
+
+class PostgresDriverBulkTestCase(unittest.TestCase):
+
+    def test_create_base_dbs_bulk(self):
+        conn = MagicMock(autocommit=False)
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.__iter__.side_effect = lambda: iter([('db', 'site1'), ('role', 'site1')])
+        created_dbs, created_roles = driver.create_base_dbs_bulk(
+            conn, ['site1', 'site2', 'site3'], [('site1', 'pass1'), ('site2', 'pass2')], grant_to_user='admin'
+        )
+        self.assertEqual((created_dbs, created_roles), (['site2', 'site3'], ['site2']))
+        statements = [c[0][0] for c in cur.execute.call_args_list]
+        self.assertIn('any(%s)', statements[0])
+        self.assertEqual(statements[1:], [
+            'CREATE ROLE "site2" WITH LOGIN PASSWORD %s NOSUPERUSER NOCREATEDB NOCREATEROLE;',
+            'GRANT "site2" TO postgres;',
+            'GRANT "site1" to "admin";',
+            'GRANT "site2" to "admin";',
+            'CREATE DATABASE "site2" OWNER "site2";',
+            'CREATE DATABASE "site3";',
+        ])
+        conn.set_session.assert_any_call(autocommit=True)
+        self.assertEqual(conn.set_session.call_count, 2)
+
+    @patch('ckan_cloud_operator.drivers.postgres.driver.get_db_role_info')
+    def test_create_base_db_same_ownership_as_bulk(self, get_db_role_info):
+        get_db_role_info.return_value = {'role': None, 'db': None}
+        conn = MagicMock(autocommit=False)
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.__iter__.side_effect = lambda: iter([])
+        self.assertEqual(driver.create_base_db(conn, 'site2', 'pass2', grant_to_user='admin'), [])
+        statements = [c[0][0] for c in cur.execute.call_args_list if not c[0][0].startswith('select ')]
+        self.assertEqual(statements, [
+            'CREATE ROLE "site2" WITH LOGIN PASSWORD %s NOSUPERUSER NOCREATEDB NOCREATEROLE;',
+            'GRANT "site2" TO postgres;',
+            'GRANT "site2" to "admin";',
+            'CREATE DATABASE "site2" OWNER "site2";',
+        ])
+        # the bulk creation emits the same statements for the db
+        bulk_conn = MagicMock(autocommit=False)
+        bulk_cur = bulk_conn.cursor.return_value.__enter__.return_value
+        bulk_cur.__iter__.side_effect = lambda: iter([])
+        driver.create_base_dbs_bulk(bulk_conn, ['site2'], [('site2', 'pass2')], grant_to_user='admin')
+        self.assertEqual([c[0][0] for c in bulk_cur.execute.call_args_list][1:], statements)
@@ -0,0 +1,233 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.monitoring.access_logs import aggregate
+from ckan_cloud_operator.monitoring.access_logs import checkpoints
+from ckan_cloud_operator.monitoring.access_logs import latency
+
+
+def _get_line(host, status=200, duration_seconds=0.1, start_time='2019-06-01T10:00:00Z', referer='',
+              user_agent='Mozilla/5.0 (X11; Linux x86_64; rv:66.0) Gecko/20100101 Firefox/66.0'):
+    return json.dumps({
+        'RequestHost': host,
+        'DownstreamStatus': status,
+        'Duration': int(duration_seconds * 1000000000),
+        'StartUTC': start_time,
+        'request_Referer': referer,
+        'request_User-Agent': user_agent,
+    }) + '\n'
+
+
+def _get_lines():
+    return [
+        _get_line('www.example.com', duration_seconds=4, start_time='2019-06-01T10:00:00Z',
+                  referer='https://www.example.com/dataset'),
+        _get_line('www.example.com', status=404, duration_seconds=11, start_time='2019-06-01T09:00:00Z',
+                  referer='https://google.com/'),
+        _get_line('api.example.com', user_agent='curl/7.58.0', start_time='2019-06-01T11:00:00Z'),
+        '\n',
+        *[_get_line(f'site{i}.example.com') for i in range(20)],
+    ]
+
+
+class AccessLogsAggregateTestCase(unittest.TestCase):
+
+    def test_aggregate_lines(self):
+        aggregates = aggregate.aggregate_lines(_get_lines())
+        self.assertEqual(len(aggregates), 22)
+        self.assertEqual(aggregates['www.example.com']['latency']['']['count'], 2)
+        www = aggregates['www.example.com']
+        self.assertEqual(dict(www['stats']), {
+            'total-requests': 2, 'status-200': 1, 'status-404': 1,
+            'duration-more_then_3s': 1, 'duration-more_then_10s': 1,
+            'referer-self': 1, 'referer-external': 1,
+            'ua-os-Linux': 2, 'ua-browser-Firefox': 2,
+        })
+        self.assertEqual(www['metadata'], {'first-start-time': '2019-06-01T09:00:00Z',
+                                           'last-start-time': '2019-06-01T10:00:00Z'})
+
+    def test_parallel_aggregate_lines(self):
+        progress = {}
+        aggregates = aggregate.aggregate_lines(_get_lines(), workers=3, batch_size=2, progress=progress)
+        self.assertEqual(progress['lines'], 23)
+        self.assertEqual(aggregates, aggregate.aggregate_lines(_get_lines()))
+
+    def test_lines_without_request_host_are_skipped(self):
+        lines = [*_get_lines(), json.dumps({'DownstreamStatus': 200}) + '\n', _get_line('')]
+        for workers in (1, 2):
+            progress = {}
+            aggregates = aggregate.aggregate_lines(lines, workers=workers, batch_size=2, progress=progress)
+            self.assertEqual((progress['lines'], progress['skipped']), (23, 2))
+            self.assertEqual(aggregates, aggregate.aggregate_lines(_get_lines()))
+
+    def test_parallel_worker_error_is_raised(self):
+        lines = [*_get_lines(), '{"RequestHost": "www.example.com", invalid\n']
+        with self.assertRaises(ValueError):
+            aggregate.aggregate_lines(lines, workers=2, batch_size=2)
+
+    def test_merge(self):
+        lines = _get_lines()
+        merged = aggregate.merge(aggregate.aggregate_lines(lines[:2]), aggregate.aggregate_lines(lines[2:]))
+        merged = aggregate.merge(merged, aggregate.aggregate_lines(lines[:1]))
+        expected = aggregate.aggregate_lines(lines + lines[:1])
+        self.assertEqual(merged, expected)
+
+    def test_get_stats_rows(self):
+        rows = list(aggregate.get_stats_rows(aggregate.aggregate_lines(_get_lines())))
+        self.assertEqual(len(rows), 22)
+        self.assertEqual(len({tuple(sorted(row)) for row in rows}), 1)
+        api = [row for row in rows if row['request_host'] == 'api.example.com'][0]
+        self.assertEqual(api['total-requests'], 1)
+        self.assertEqual(api['status-404'], 0)
+
+    def test_user_agent_is_cached(self):
+        aggregate.get_user_agent.cache_clear()
+        aggregate.aggregate_lines(_get_lines())
+        cache_info = aggregate.get_user_agent.cache_info()
+        self.assertEqual(cache_info.misses, 2)
+        self.assertEqual(cache_info.hits, 21)
+
+    def test_aggregate_gzipped_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, 'access.log.gz')
+            with gzip.open(filename, 'wt') as f:
+                f.writelines(_get_lines())
+            aggregates = aggregate.aggregate(filename, workers=2)
+        self.assertEqual(sum(row['total-requests'] for row in aggregate.get_stats_rows(aggregates)), 23)
+
+    def test_latency_rows(self):
+        lines = [_get_line('www.example.com', duration_seconds=i / 100) for i in range(1, 101)]
+        lines += [json.dumps(dict(json.loads(_get_line('api.example.com', duration_seconds=2)), BackendName='route-1'))]
+        lines += [json.dumps(dict(json.loads(_get_line('www.example.com', duration_seconds=3)), BackendName='route-1'))]
+        aggregates = aggregate.aggregate_lines(lines)
+        host_rows = {row['request_host']: row for row in aggregate.get_latency_rows(aggregates)}
+        self.assertEqual(host_rows['www.example.com']['requests'], 101)
+        self.assertAlmostEqual(host_rows['www.example.com']['latency-p50-ms'], 510, delta=510 * 0.01)
+        self.assertAlmostEqual(host_rows['www.example.com']['latency-p99-ms'], 1000, delta=1000 * 0.01)
+        self.assertEqual(host_rows['www.example.com']['latency-max-ms'], 3000)
+        route_rows = {row['route']: row for row in aggregate.get_latency_rows(aggregates, by_route=True)}
+        self.assertEqual(route_rows['route-1']['requests'], 2)
+        self.assertEqual(route_rows['route-1']['latency-max-ms'], 3000)
+        stats_row = [row for row in aggregate.get_stats_rows(aggregates) if row['request_host'] == 'api.example.com'][0]
+        self.assertAlmostEqual(stats_row['latency-p95-ms'], 2000, delta=2000 * 0.01)
+
+
+class LatencySketchTestCase(unittest.TestCase):
+
+    def test_quantiles(self):
+        sketch = latency.new()
+        self.assertIsNone(latency.quantile(sketch, 0.5))
+        for value in range(1, 10001):
+            latency.add(sketch, value)
+        latency.add(sketch, 0)
+        for name, q in latency.QUANTILES.items():
+            self.assertAlmostEqual(latency.quantile(sketch, q), q * 10000, delta=q * 10000 * latency.RELATIVE_ACCURACY)
+        self.assertEqual(latency.quantile(sketch, 1), 10000)
+        self.assertEqual(latency.quantile(sketch, 0), 0)
+
+    def test_merge_is_exact(self):
+        values = [(i * 7919) % 5000 / 3 for i in range(3000)]
+        chunks = [values[:1000], values[1000:1500], values[1500:]]
+        merged = latency.new()
+        for chunk in chunks:
+            sketch = latency.new()
+            for value in chunk:
+                latency.add(sketch, value)
+            latency.merge(merged, latency.loads(latency.dumps(sketch)))
+        expected = latency.new()
+        for value in values:
+            latency.add(expected, value)
+        self.assertEqual(merged, expected)
+        self.assertEqual(latency.get_summary(merged), latency.get_summary(expected))
+
+
+class AccessLogsCheckpointsTestCase(unittest.TestCase):
+
+    def _get_rows(self, lines):
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def test_process_only_new_rows(self):
+        rows = self._get_rows(_get_lines())
+        with tempfile.TemporaryDirectory() as state_path:
+            result = checkpoints.process_rows(rows[:10], state_path)
+            self.assertEqual(result['processed-rows'], 10)
+            result = checkpoints.process_rows(rows, state_path)
+            self.assertEqual(result['rows'], len(rows))
+            self.assertEqual(result['processed-rows'], len(rows) - 10)
+            result = checkpoints.process_rows(rows, state_path)
+            self.assertEqual(result['processed-rows'], 0)
+            self.assertEqual(checkpoints.get_watermark(state_path)['offset'], len(rows))
+            history = checkpoints.load_history(state_path=state_path)
+        expected = aggregate.aggregate_lines(_get_lines())
+        self.assertEqual({row['request_host']: row for row in aggregate.get_stats_rows(history)},
+                         {row['request_host']: row for row in aggregate.get_stats_rows(expected)})
+
+    def test_process_source_seeks_to_watermark(self):
+        lines = _get_lines()
+        with tempfile.TemporaryDirectory() as state_path:
+            filename = os.path.join(state_path, 'access.log')
+            with open(filename, 'w') as f:
+                f.writelines(lines[:10])
+            self.assertEqual(checkpoints.process_source(filename, state_path)['processed-rows'], 9)
+            self.assertEqual(checkpoints.get_watermark(state_path)['byte-offset'], os.path.getsize(filename))
+            with open(filename, 'a') as f:
+                f.writelines(lines[10:])
+            parsed_lines = []
+
+            def _parse(line):
+                parsed_lines.append(line)
+                return json.loads(line)
+
+            with open(filename, 'rb') as f:
+                result = checkpoints.process_lines(f, state_path, parse=_parse, seek=f.seek)
+            self.assertEqual(result, {'rows': 23, 'processed-rows': 14, 'hours': ['2019-06-01T10']})
+            # the first line and the new lines
+            self.assertEqual(parsed_lines, [line.encode() for line in lines[:1] + lines[10:]])
+            history = checkpoints.load_history(state_path=state_path)
+        self.assertEqual(history, aggregate.aggregate_lines(lines))
+
+    def test_interrupted_save_keeps_the_previous_state(self):
+        rows = self._get_rows(_get_lines())
+        with tempfile.TemporaryDirectory() as state_path:
+            checkpoints.process_rows(rows[:10], state_path)
+            save_json = checkpoints._save_json
+
+            def _save_json(filename, data):
+                if filename.endswith(checkpoints.STATE_FILENAME):
+                    raise OSError()
+                save_json(filename, data)
+
+            with patch('ckan_cloud_operator.monitoring.access_logs.checkpoints._save_json', side_effect=_save_json):
+                with self.assertRaises(OSError):
+                    checkpoints.process_rows(rows, state_path)
+            self.assertEqual(checkpoints.get_watermark(state_path)['offset'], 10)
+            self.assertEqual(checkpoints.process_rows(rows, state_path)['processed-rows'], len(rows) - 10)
+            history = checkpoints.load_history(state_path=state_path)
+            self.assertEqual(sorted(os.listdir(os.path.join(state_path, 'hours'))),
+                             ['2019-06-01T09.1.json', '2019-06-01T10.2.json', '2019-06-01T11.1.json'])
+        self.assertEqual(history, aggregate.aggregate_lines(_get_lines()))
+
+    def test_rotated_log(self):
+        rows = self._get_rows(_get_lines())
+        with tempfile.TemporaryDirectory() as state_path:
+            checkpoints.process_rows(rows, state_path)
+            rotated_rows = self._get_rows([_get_line('www.example.com', start_time='2019-06-01T12:00:00Z')])
+            result = checkpoints.process_rows(rotated_rows, state_path)
+            self.assertEqual(result['processed-rows'], 1)
+            self.assertEqual(result['hours'], ['2019-06-01T12'])
+            history = checkpoints.load_history(state_path=state_path)
+        self.assertEqual(history['www.example.com']['stats']['total-requests'], 3)
+
+    def test_history_range(self):
+        rows = self._get_rows(_get_lines())
+        with tempfile.TemporaryDirectory() as state_path:
+            checkpoints.process_rows(rows, state_path)
+            self.assertEqual(checkpoints.get_hours(state_path), ['2019-06-01T09', '2019-06-01T10', '2019-06-01T11'])
+            history = checkpoints.load_history('2019-06-01T10', '2019-06-01T10', state_path)
+        self.assertNotIn('api.example.com', history)
+        self.assertEqual(history['www.example.com']['stats']['total-requests'], 1)
+        self.assertEqual(history['www.example.com']['latency']['']['count'], 1)
@@ -0,0 +1,73 @@
+import io
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+from ckan_cloud_operator.monitoring import probe
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status_code = 200 if self.path.startswith('/api/3/action/') else 404
+        body = b'{"success": true}'
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MonitoringProbeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), _Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.hostname = '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_probe(self):
+        targets = [
+            {'hostname': self.hostname, 'target-type': 'ckan', 'instance-id': 'site1'},
+            {'hostname': self.hostname, 'target-type': 'app', 'instance-id': 'app1'},
+        ]
+        rows = probe.probe(targets, measurements=2, concurrency=2, scheme='http')
+        self.assertEqual(len(rows), 6)
+        ckan_rows = [row for row in rows if row['instance_id'] == 'site1']
+        self.assertEqual([row['status_code'] for row in ckan_rows], [200, 200, 200, 200])
+        self.assertEqual(sorted(row['measurement_num'] for row in ckan_rows), [1, 1, 2, 2])
+        for row in ckan_rows:
+            self.assertLessEqual(row['ttfb_seconds'], row['seconds'])
+        self.assertEqual([row['status_code'] for row in rows if row['instance_id'] == 'app1'], [404, 404])
+        f = io.StringIO()
+        probe.write_csv(rows, f)
+        self.assertEqual(f.getvalue().splitlines()[0], ','.join(probe.OUTPUT_FIELDS))
+
+    def test_probe_connection_error(self):
+        self.server.server_close()
+        targets = [{'hostname': self.hostname, 'target-type': 'app', 'instance-id': 'app1'}]
+        row, = probe.probe(targets, timeout=5, scheme='http')
+        self.assertEqual(row['status_code'], 0)
+        self.assertEqual(row['seconds'], 5)
+        self.assertTrue(row['comments'])
+
+    def test_get_targets(self):
+        routes = [
+            {'metadata': {'name': 'r1'}, 'spec': {'type': 'ckan-instance-subdomain', 'ckan-instance-id': 'site1'}},
+            {'metadata': {'name': 'r2'}, 'spec': {'type': 'ckan-instance-subdomain', 'ckan-instance-id': 'site1'}},
+            {'metadata': {'name': 'r3'}, 'spec': {'type': 'backend-url-subdomain'}},
+        ]
+        hostnames = {'r1': 'site1.example.com', 'r2': 'site1.example.com', 'r3': 'backend.example.com'}
+        with patch('ckan_cloud_operator.routers.manager.get_route_frontend_hostname',
+                   side_effect=lambda route: hostnames[route['metadata']['name']]):
+            targets = probe.get_targets(routes)
+        self.assertEqual(targets, [
+            {'hostname': 'site1.example.com', 'target-type': 'ckan', 'instance-id': 'site1'},
+            {'hostname': 'backend.example.com', 'target-type': 'backend-url', 'instance-id': 'r3'},
+        ])
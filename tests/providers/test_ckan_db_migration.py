@@ -0,0 +1,203 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+from ckan_cloud_operator.providers.ckan.db import migration
+
+
+MIGRATION_CONFIGS = {
+    'migration1': {},
+    'migration2': {'database-password': 'db2pass', 'datastore-password': 'ds2pass',
+                   'datastore-readonly-password': 'ro2pass', 'datastore-readonly-user-name': 'site2-datastore-ro'},
+}
+
+
+@patch('ckan_cloud_operator.providers.ckan.db.migration._wait_db_proxy_connections')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.db_proxy_manager.update')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.postgres_driver.create_base_dbs_bulk')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.postgres_driver.get_existing_dbs_and_roles')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.postgres_driver.connect')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.db_manager')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.crds_manager.config_set')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.crds_manager.config_get')
+class CreateBaseDbsAndRolesBulkTestCase(unittest.TestCase):
+
+    SPECS = [
+        {'migration-name': 'migration1', 'db-name': 'site1', 'datastore-name': 'site1-datastore'},
+        {'migration-name': 'migration2', 'db-name': 'site2', 'datastore-name': 'site2-datastore'},
+    ]
+
+    def test_bulk(self, config_get, config_set, db_manager, connect, get_existing_dbs_and_roles,
+                  create_base_dbs_bulk, db_proxy_update, wait_db_proxy_connections):
+        config_get.side_effect = lambda singular, name, **kwargs: MIGRATION_CONFIGS[name]
+        db_manager.get_admin_db_user.return_value = 'admin'
+        get_existing_dbs_and_roles.return_value = ({'site2'}, {'site2'})
+        create_base_dbs_bulk.return_value = (['site1', 'site1-datastore', 'site2-datastore'],
+                                             ['site1', 'site1-datastore', 'site1-datastore-ro', 'site2-datastore',
+                                              'site2-datastore-ro'])
+        results = migration.create_base_dbs_and_roles_bulk(self.SPECS)
+        config_set.assert_called_once()
+        self.assertEqual(config_set.call_args[0][1], 'migration1')
+        created_config = config_set.call_args[1]['values']
+        self.assertEqual(sorted(created_config), ['database-password', 'datastore-password',
+                                                  'datastore-readonly-password', 'datastore-readonly-user-name'])
+        connect.assert_called_once()
+        get_existing_dbs_and_roles.assert_called_once()
+        dbs, roles = create_base_dbs_bulk.call_args[0][1:]
+        self.assertEqual(dbs, ['site1', 'site1-datastore', 'site2', 'site2-datastore'])
+        self.assertEqual(roles[3:], [('site2', 'db2pass'), ('site2-datastore', 'ds2pass'),
+                                     ('site2-datastore-ro', 'ro2pass')])
+        self.assertEqual(create_base_dbs_bulk.call_args[1], {'grant_to_user': 'admin'})
+        db_proxy_update.assert_called_once_with(wait_updated=True)
+        credentials = wait_db_proxy_connections.call_args[0][0]
+        self.assertEqual(len(credentials), 6)
+        self.assertIn(('site2-datastore-ro', 'ro2pass', 'site2-datastore'), credentials)
+        self.assertEqual(results[0]['created-dbs'], ['site1', 'site1-datastore'])
+        self.assertEqual(results[1]['created-dbs'], ['site2-datastore'])
+        self.assertEqual(results[1]['created-roles'], ['site2-datastore', 'site2-datastore-ro'])
+
+    def test_existing_role_without_password(self, config_get, config_set, db_manager, connect,
+                                            get_existing_dbs_and_roles, create_base_dbs_bulk, db_proxy_update,
+                                            wait_db_proxy_connections):
+        config_get.side_effect = lambda singular, name, **kwargs: MIGRATION_CONFIGS[name]
+        get_existing_dbs_and_roles.return_value = (set(), {'site1'})
+        with self.assertRaisesRegex(AssertionError, 'role site1 exists'):
+            migration.create_base_dbs_and_roles_bulk(self.SPECS[:1])
+        create_base_dbs_bulk.assert_not_called()
+        db_proxy_update.assert_not_called()
+
+
+@patch('ckan_cloud_operator.providers.ckan.db.migration.kubectl.apply')
+@patch('ckan_cloud_operator.providers.ckan.db.migration._get_or_create_datastore_readonly_user_name')
+@patch('ckan_cloud_operator.providers.ckan.db.migration.get_db_import_urls')
+@patch('ckan_cloud_operator.providers.ckan.db.migration._gcloudsql')
+@patch('ckan_cloud_operator.providers.ckan.db.migration._initialize_postgis_extensions')
+@patch('ckan_cloud_operator.providers.ckan.db.migration._create_base_dbs_and_roles')
+class MigrationStepsTestCase(unittest.TestCase):
+
+    def _get_migration(self):
+        return {'metadata': {'name': 'dd-site1'},
+                'spec': {'type': 'deis-ckan', 'name': 'dd-site1', 'old-site-id': 'site1', 'db-name': 'site1',
+                         'datastore-name': 'site1-datastore'}}
+
+    def test_resume_from_failed_step(self, create_base_dbs_and_roles, initialize_postgis_extensions, gcloudsql,
+                                     get_db_import_urls, get_ro_name, kubectl_apply):
+        create_base_dbs_and_roles.side_effect = lambda *args, **kwargs: iter([{'step': 'create', 'msg': ''}])
+        initialize_postgis_extensions.side_effect = lambda *args: iter([{'step': 'postgis', 'msg': ''}])
+        get_db_import_urls.return_value = ('gs://db.sql', 'gs://datastore.sql')
+        gcloudsql.return_value.import_db.side_effect = [None, Exception('import failed')]
+        migration_resource = self._get_migration()
+        with self.assertRaisesRegex(Exception, 'import failed'):
+            list(migration.update(migration_resource))
+        self.assertEqual(migration_resource['spec']['completed-steps'],
+                         ['create-base-dbs-and-roles', 'initialize-postgis', 'import-db-data'])
+        self.assertEqual(migration_resource['spec']['failed-step'], 'import-datastore-data')
+        gcloudsql.return_value.import_db.side_effect = None
+        gcloudsql.return_value.import_db.reset_mock()
+        list(migration.update(migration_resource))
+        self.assertEqual(create_base_dbs_and_roles.call_count, 1)
+        gcloudsql.return_value.import_db.assert_called_once_with(
+            'gs://datastore.sql', 'site1-datastore', import_user='site1-datastore', db_prefix=None
+        )
+        self.assertNotIn('failed-step', migration_resource['spec'])
+        self.assertTrue(migration_resource['spec']['imported-data'])
+
+    def test_resume_from_fetched_resource(self, create_base_dbs_and_roles, initialize_postgis_extensions, gcloudsql,
+                                          get_db_import_urls, get_ro_name, kubectl_apply):
+        initialize_postgis_extensions.side_effect = lambda *args: iter([{'step': 'postgis', 'msg': ''}])
+        get_db_import_urls.return_value = ('gs://db.sql', 'gs://datastore.sql')
+        server_resource_version = ['5']
+
+        def _apply(resource):
+            # the server rejects an apply of a stale resource version
+            if resource['metadata'].get('resourceVersion') not in (None, server_resource_version[0]):
+                raise Exception('conflict')
+            server_resource_version[0] = str(int(server_resource_version[0]) + 1)
+
+        kubectl_apply.side_effect = _apply
+        migration_resource = self._get_migration()
+        migration_resource['metadata']['resourceVersion'] = '5'
+        migration_resource['spec']['completed-steps'] = ['create-base-dbs-and-roles']
+        list(migration.update(migration_resource))
+        create_base_dbs_and_roles.assert_not_called()
+        self.assertEqual(migration_resource['spec']['completed-steps'], [
+            'create-base-dbs-and-roles', 'initialize-postgis', 'import-db-data', 'import-datastore-data'
+        ])
+        self.assertEqual(kubectl_apply.call_count, 4)
+
+
+class MigrateBulkTestCase(unittest.TestCase):
+
+    def test_migrate_bulk(self):
+        lock = threading.Lock()
+        active_imports = {'current': 0, 'max': 0}
+
+        def _migrate(old_site_id, db_prefix):
+            with migration._import_slot():
+                with lock:
+                    active_imports['current'] += 1
+                    active_imports['max'] = max(active_imports['max'], active_imports['current'])
+                time.sleep(0.01)
+                with lock:
+                    active_imports['current'] -= 1
+            if old_site_id == 'site3':
+                raise Exception('import failed')
+
+        results = migration.migrate_bulk(['site1', 'site2', 'site3', 'site4'], workers=4, import_concurrency=2,
+                                         migrate_func=_migrate)
+        self.assertEqual([result['status'] for result in results],
+                         [migration.STATUS_SUCCESS, migration.STATUS_SUCCESS, migration.STATUS_FAILURE,
+                          migration.STATUS_SUCCESS])
+        self.assertEqual(results[2]['error'], 'import failed')
+        self.assertLessEqual(active_imports['max'], 2)
+        self.assertIsNone(migration._import_semaphore)
+
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.kubectl.apply')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.create_base_dbs_and_roles_bulk')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.migrate_deis_dbs')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.create')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.get_deis_dbs_migration_name_spec')
+    def test_migrate_bulk_create_dbs_errors(self, get_name_spec, create, migrate_deis_dbs,
+                                            create_base_dbs_and_roles_bulk, kubectl_apply):
+        def _get_name_spec(old_site_id, db_prefix):
+            if old_site_id == 'site2':
+                raise Exception('invalid site')
+            return old_site_id, {}
+
+        get_name_spec.side_effect = _get_name_spec
+        create.side_effect = lambda name, spec, **kwargs: {'spec': {'name': name, 'db-name': name,
+                                                                    'datastore-name': f'{name}-datastore'}}
+        create_base_dbs_and_roles_bulk.side_effect = Exception('bulk failed')
+        migrate_deis_dbs.return_value = iter([])
+        results = migration.migrate_bulk(['site1', 'site2', 'site3'], workers=2)
+        self.assertEqual([result['status'] for result in results],
+                         [migration.STATUS_SUCCESS, migration.STATUS_FAILURE, migration.STATUS_SUCCESS])
+        self.assertEqual((results[1]['error'], results[1]['failed-step']), ('invalid site', 'create-migration'))
+        create_base_dbs_and_roles_bulk.assert_called_once()
+        self.assertEqual([spec['migration-name'] for spec in create_base_dbs_and_roles_bulk.call_args[0][0]],
+                         ['site1', 'site3'])
+        # the failed bulk step is not recorded, each site migration creates its dbs
+        kubectl_apply.assert_not_called()
+        self.assertEqual(sorted(call[1]['old_site_id'] for call in migrate_deis_dbs.call_args_list), ['site1', 'site3'])
+
+
+class GetAllDbsUsersTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.db_manager.get_internal_unproxied_db_host_port')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.crds_manager.config_get')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.crds_manager.config_prefetch')
+    @patch('ckan_cloud_operator.providers.ckan.db.migration.crds_manager.get')
+    def test_prefetch_secrets(self, crds_get, config_prefetch, config_get, get_host_port):
+        crds_get.return_value = {'items': [
+            {'spec': {'name': 'migration1', 'type': 'new-db', 'db-name': 'site1'}},
+            {'spec': {'name': 'migration2', 'type': 'new-db', 'db-name': 'site2'}},
+        ]}
+        config_get.side_effect = lambda singular, name, key, **kwargs: f'{name}-{key}'
+        get_host_port.return_value = ('db-host', 5432)
+        dbs, users = migration.get_all_dbs_users()
+        config_prefetch.assert_called_once_with(migration.CRD_SINGULAR, is_secret=True)
+        get_host_port.assert_called_once_with()
+        self.assertEqual(dbs, [('site1', 'db-host', 5432), ('site2', 'db-host', 5432)])
+        self.assertEqual(users, [('site1', 'migration1-database-password'),
+                                 ('site2', 'migration2-database-password')])
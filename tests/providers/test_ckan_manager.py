@@ -0,0 +1,53 @@
+import base64
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.providers.ckan import manager
+
+
+def _get_secret(instance_id, **data):
+    return {
+        'metadata': {'name': f'{instance_id}-annotations', 'namespace': instance_id},
+        'data': {k: base64.b64encode(v.encode()).decode() for k, v in data.items()}
+    }
+
+
+def _get_instance_item(instance_id):
+    return {'id': instance_id, 'item': {'spec': {'db': {'name': instance_id},
+                                                 'datastore': {'name': f'{instance_id}-datastore'},
+                                                 'envvars': {'fromSecret': 'envvars'},
+                                                 'solrCloudCollection': {'name': instance_id}, 'storage': {}}}}
+
+
+class CkanManagerGetAllDbsUsersTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.providers.ckan.manager.ckan_db_migration_manager.get_all_dbs_users')
+    @patch('ckan_cloud_operator.providers.db.manager.get_internal_unproxied_db_host_port')
+    @patch('ckan_cloud_operator.kubectl.call')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_prefetch_annotations_secrets(self, get, call, get_host_port, get_migration_dbs_users):
+        get_host_port.return_value = ('db-host', 5432)
+        get_migration_dbs_users.return_value = [], []
+        secrets = {
+            instance_id: _get_secret(instance_id, databasePassword='pass1', datastorePassword='pass2',
+                                     datastoreReadonlyUser=f'{instance_id}-ro', datatastoreReadonlyPassword='pass3')
+            for instance_id in ('site1', 'site2', 'site3')
+        }
+
+        def _get(what, namespace=None, required=True):
+            if what.startswith('secrets --all-namespaces'):
+                # site3 secret was saved before the secrets were labeled
+                return {'items': [secrets['site1'], secrets['site2']]}
+            return secrets[namespace]
+
+        get.side_effect = _get
+        dbs, users = manager.get_all_dbs_users([_get_instance_item(i) for i in ('site1', 'site2', 'site3')])
+        self.assertEqual([db[0] for db in dbs], ['site1', 'site1-datastore', 'site2', 'site2-datastore',
+                                                 'site3', 'site3-datastore'])
+        self.assertIn(('site2-ro', 'pass3'), users)
+        self.assertEqual([c[0][0] for c in get.call_args_list], [
+            'secrets --all-namespaces -l ckan-cloud/instance-annotations-secret=true',
+            'secret site3-annotations',
+        ])
+        call.assert_called_once_with('label secret site3-annotations ckan-cloud/instance-annotations-secret=true '
+                                     '--overwrite', namespace='site3')
@@ -0,0 +1,197 @@
+import unittest
+from unittest.mock import patch
+
+import yaml
+
+from ckan_cloud_operator.providers.db.proxy.pgbouncer import manager
+
+
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.time.sleep')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.kubectl.call')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.get_pod_names')
+class PgBouncerConfigVersionTestCase(unittest.TestCase):
+
+    def test_wait_config_version(self, get_pod_names, kubectl_call, sleep):
+        get_pod_names.return_value = ['pgbouncer-1', 'pgbouncer-2']
+        # pgbouncer-2 volume is synced only on the third attempt
+        results = {'pgbouncer-1': [0], 'pgbouncer-2': [1, 1, 0]}
+        kubectl_call.side_effect = lambda cmd: results[cmd.split()[1]].pop(0)
+        manager.wait_config_version('abc123')
+        self.assertEqual(kubectl_call.call_count, 4)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertIn('abc123', kubectl_call.call_args[0][0])
+        self.assertIn('pgbouncer -q -u pgbouncer -d -R', kubectl_call.call_args[0][0])
+
+    def test_wait_config_version_timeout(self, get_pod_names, kubectl_call, sleep):
+        get_pod_names.return_value = ['pgbouncer-1']
+        kubectl_call.return_value = 1
+        with self.assertRaisesRegex(AssertionError, 'timed out'):
+            manager.wait_config_version('abc123', timeout=0)
+
+    def test_config_version(self, *args):
+        config = {'pgbouncer.ini': '[databases]', 'users.txt': '"user1" "pass1"'}
+        version = manager._get_config_version(config)
+        self.assertEqual(len(version), 16)
+        self.assertEqual(version, manager._get_config_version(dict(config)))
+        self.assertNotEqual(version, manager._get_config_version(dict(config, **{'users.txt': '"user1" "pass2"'})))
+
+
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._config_set')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._config_get')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.db_manager')
+class PgBouncerApplyConfigSecretTestCase(unittest.TestCase):
+
+    def _setup(self, db_manager, config_get, config_version=None):
+        db_manager.list_instance_items.return_value = [{'id': 'instance1', 'item': {}}]
+        db_manager.get_all_dbs_users.return_value = ([('site1', 'db-host', 5432)], [('site1', 'pass1')])
+        db_manager.get_admin_db_credentials.return_value = ('admin', 'admin-pass', 'postgres')
+        db_manager.get_all_dbs_pool_settings.return_value = {}
+        db_manager.get_all_db_instance_ids.return_value = {'site1': 'instance1', 'other-site': 'other-instance'}
+        db_manager.get_internal_unproxied_db_host_port.return_value = ('db-host', 5432)
+        configs = {'pool-mode': 'transaction', 'config-version': config_version}
+        config_get.side_effect = lambda key=None, default=None, **kwargs: configs.get(key) or default
+
+    def test_changed(self, db_manager, config_get, config_set):
+        self._setup(db_manager, config_get, config_version='old-version')
+        config_version, changed = manager._apply_config_secret()
+        self.assertTrue(changed)
+        config_set.assert_called_once()
+        self.assertEqual(config_set.call_args[1]['values']['config-version'], config_version)
+        self.assertIn('site1 = host=db-host port=5432 dbname=site1', config_set.call_args[1]['values']['pgbouncer.ini'])
+        self.assertEqual(yaml.safe_load(config_set.call_args[1]['values'][manager.CONFIG_METRICS_KEY]), {
+            'server-host': 'db-host', 'server-port': 5432, 'server-db-name': 'postgres',
+            'db-instance-ids': {'site1': 'instance1'},
+        })
+
+    def test_unchanged(self, db_manager, config_get, config_set):
+        self._setup(db_manager, config_get)
+        config_version, _ = manager._apply_config_secret()
+        self._setup(db_manager, config_get, config_version=config_version)
+        config_set.reset_mock()
+        self.assertEqual(manager._apply_config_secret(), (config_version, False))
+        config_set.assert_not_called()
+        # initialize always writes the config
+        self.assertEqual(manager._apply_config_secret(force=True), (config_version, True))
+        config_set.assert_called_once()
+
+    def test_db_pool_settings(self, db_manager, config_get, config_set):
+        self._setup(db_manager, config_get)
+        db_manager.get_all_dbs_pool_settings.return_value = {'site1': {'pool_size': 10, 'reserve_pool': 2}}
+        tuning = {'site1': 'pool_size=20 max_db_connections=30', 'site2': ''}
+        configs_get = config_get.side_effect
+        config_get.side_effect = lambda key=None, default=None, suffix=None, **kwargs: (
+            tuning if suffix == manager.TUNING_CONFIG_SUFFIX else configs_get(key, default, **kwargs)
+        )
+        self.assertEqual(manager.get_db_pool_settings(),
+                         {'site1': {'pool_size': 20, 'reserve_pool': 2, 'max_db_connections': 30}})
+        manager._apply_config_secret()
+        self.assertIn('site1 = host=db-host port=5432 dbname=site1 pool_size=20 reserve_pool=2 max_db_connections=30',
+                      config_set.call_args[1]['values']['pgbouncer.ini'])
+        # the instances are listed once and shared by the dbs users and the pool settings
+        db_manager.list_instance_items.assert_called_once_with()
+        instance_items = db_manager.list_instance_items.return_value
+        db_manager.get_all_dbs_users.assert_called_once_with(instance_items=instance_items)
+        db_manager.get_all_dbs_pool_settings.assert_called_with(instance_items=instance_items)
+        db_manager.get_all_db_instance_ids.assert_called_once_with(instance_items=instance_items)
+
+    def test_set_db_pool_settings(self, db_manager, config_get, config_set):
+        manager.set_db_pool_settings('site1', {'pool_size': 20, 'reserve_pool': None, 'max_db_connections': 30})
+        config_set.assert_called_once_with(values={'site1': 'pool_size=20 max_db_connections=30'},
+                                           suffix=manager.TUNING_CONFIG_SUFFIX)
+        with self.assertRaisesRegex(AssertionError, 'invalid pool setting'):
+            manager._parse_db_pool_settings('default_pool_size=10')
+
+    def test_db_prefix(self, db_manager, config_get, config_set):
+        self._setup(db_manager, config_get)
+        db_manager.get_all_dbs_users.return_value = (
+            [('site1', 'db-host', 5432), ('site2', 'prefix-db-host', 5432)],
+            [('site1', 'pass1'), ('site2', 'pass2')]
+        )
+        db_manager.get_internal_unproxied_db_host_port.return_value = ('prefix-db-host', '5432')
+        manager._apply_config_secret(db_prefix='prefix')
+        db_manager.get_internal_unproxied_db_host_port.assert_called_with(db_prefix='prefix')
+        db_manager.get_admin_db_credentials.assert_called_once_with(db_prefix='prefix')
+        self.assertEqual(config_set.call_args[1]['suffix'], 'prefix')
+        pgbouncer_ini = config_set.call_args[1]['values']['pgbouncer.ini']
+        self.assertIn('site2 = host=prefix-db-host', pgbouncer_ini)
+        self.assertNotIn('site1 = ', pgbouncer_ini)
+        # the prefix admin db and user are added, so the prefix admin can connect through the proxy
+        self.assertIn('postgres = host=prefix-db-host port=5432 dbname=postgres', pgbouncer_ini)
+        self.assertIn('admin_users = admin', pgbouncer_ini)
+        self.assertIn('"admin" "admin-pass"', config_set.call_args[1]['values']['users.txt'].splitlines())
+
+
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._config_get_volume_spec')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._get_resource_labels')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._get_resource_name')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._get_resource_annotations')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager._config_get')
+@patch('ckan_cloud_operator.providers.db.proxy.pgbouncer.manager.kubectl.apply')
+class PgBouncerDeploymentTestCase(unittest.TestCase):
+
+    def _setup(self, config_get, get_resource_name, get_resource_labels):
+        config_get.side_effect = lambda key, default=None, **kwargs: {'replicas': '3'}.get(key, default)
+        get_resource_name.side_effect = lambda suffix=None: '-'.join(filter(None, ['pgbouncer', suffix]))
+        get_resource_labels.side_effect = lambda for_deployment=False, suffix=None: {
+            'app': '-'.join(filter(None, ['pgbouncer', suffix]))
+        }
+
+    def test_deployment(self, kubectl_apply, config_get, get_resource_annotations, get_resource_name,
+                        get_resource_labels, config_get_volume_spec):
+        self._setup(config_get, get_resource_name, get_resource_labels)
+        get_resource_annotations.return_value = {}
+        manager._apply_deployment(db_prefix='prefix')
+        deployment = kubectl_apply.call_args[0][0]
+        self.assertEqual(deployment['metadata']['name'], 'pgbouncer-prefix')
+        self.assertEqual(deployment['spec']['replicas'], 3)
+        pod_anti_affinity = deployment['spec']['template']['spec']['affinity']['podAntiAffinity']
+        affinity_term = pod_anti_affinity['preferredDuringSchedulingIgnoredDuringExecution'][0]['podAffinityTerm']
+        self.assertEqual(affinity_term['labelSelector']['matchExpressions'][0]['values'], ['pgbouncer-prefix'])
+        config_get_volume_spec.assert_called_once_with('config', is_secret=True, suffix='prefix')
+
+    @patch('ckan_cloud_operator.config.manager.get')
+    def test_metrics_exporter(self, operator_config_get, kubectl_apply, config_get, get_resource_annotations,
+                              get_resource_name, get_resource_labels, config_get_volume_spec):
+        self._setup(config_get, get_resource_name, get_resource_labels)
+        config_get.side_effect = lambda key, default=None, **kwargs: {'metrics-exporter': 'y'}.get(key, default)
+        get_resource_annotations.return_value = {}
+        operator_config_get.return_value = 'viderum/ckan-cloud-operator:v1'
+        manager._apply_deployment()
+        pod_template = kubectl_apply.call_args[0][0]['spec']['template']
+        container = pod_template['spec']['containers'][1]
+        self.assertEqual(container['image'], 'viderum/ckan-cloud-operator:v1')
+        self.assertEqual(container['args'][:3], ['db', 'proxy', 'metrics'])
+        self.assertIn('--from-config-path', container['args'])
+        self.assertEqual(pod_template['metadata']['annotations']['prometheus.io/port'], '9127')
+
+    def test_pod_disruption_budget(self, kubectl_apply, config_get, get_resource_annotations, get_resource_name,
+                                   get_resource_labels, config_get_volume_spec):
+        self._setup(config_get, get_resource_name, get_resource_labels)
+        manager._apply_pod_disruption_budget()
+        pod_disruption_budget = kubectl_apply.call_args[0][0]
+        self.assertEqual(pod_disruption_budget['kind'], 'PodDisruptionBudget')
+        self.assertEqual(pod_disruption_budget['spec'], {'maxUnavailable': 1,
+                                                         'selector': {'matchLabels': {'app': 'pgbouncer'}}})
+
+
+class PgBouncerSuggestDbPoolSettingsTestCase(unittest.TestCase):
+
+    def test_suggest(self):
+        pools_samples = [
+            [{'database': 'busy', 'user': 'busy', 'sv_active': 6, 'cl_waiting': 4},
+             {'database': 'busy', 'user': 'busy-ro', 'sv_active': 2, 'cl_waiting': 0},
+             {'database': 'idle', 'user': 'idle', 'sv_active': 0, 'cl_waiting': 0},
+             {'database': 'pgbouncer', 'user': 'pgbouncer', 'sv_active': 0, 'cl_waiting': 0}],
+            [{'database': 'busy', 'user': 'busy', 'sv_active': 3, 'cl_waiting': 0}],
+        ]
+        stats = [
+            # 100 transactions per second of 50ms each = 5 concurrent transactions
+            {'database': 'busy', 'avg_xact_count': 100, 'avg_xact_time': 50000},
+            # 2000 transactions per second of 20ms = 40 concurrent transactions
+            {'database': 'huge', 'avg_xact_count': 2000, 'avg_xact_time': 20000},
+        ]
+        self.assertEqual(manager.suggest_db_pool_settings(pools_samples, stats), {
+            'busy': {'pool_size': 18, 'reserve_pool': 5, 'max_db_connections': 23},
+            'huge': {'pool_size': 50, 'reserve_pool': 13, 'max_db_connections': 63},
+            'idle': {'pool_size': 2, 'reserve_pool': 1, 'max_db_connections': 3},
+        })
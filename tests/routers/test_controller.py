@@ -0,0 +1,135 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.routers.annotations import CkanRoutersAnnotations
+from ckan_cloud_operator.routers import controller
+
+
+def _get_router(name, **annotations):
+    return {
+        'metadata': {
+            'name': name,
+            'annotations': {f'ckan-cloud/{k}': json.dumps(v) for k, v in annotations.items()}
+        },
+        'spec': {'type': 'traefik'}
+    }
+
+
+def _get_route(name, router_name, resource_version='1'):
+    return {
+        'metadata': {'name': name, 'resourceVersion': resource_version},
+        'spec': {'router_name': router_name}
+    }
+
+
+class RoutersControllerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        controller._INDEX_ROUTES_VERSION = None
+
+    def test_get_routes_versions(self):
+        routes = [_get_route('r1', 'router-1'), _get_route('r2', 'router-1'), _get_route('r3', 'router-2')]
+        versions = controller.get_routes_versions(routes)
+        self.assertEqual(sorted(versions), ['router-1', 'router-2'])
+        self.assertEqual(versions, controller.get_routes_versions(list(reversed(routes))))
+        routes[0]['metadata']['resourceVersion'] = '2'
+        changed_versions = controller.get_routes_versions(routes)
+        self.assertNotEqual(versions['router-1'], changed_versions['router-1'])
+        self.assertEqual(versions['router-2'], changed_versions['router-2'])
+
+    @patch('ckan_cloud_operator.routers.routes.manager.get_backend_url')
+    def test_get_routes_versions_with_endpoints(self, get_backend_url):
+        from tests.routers.test_route_endpoints import _get_index
+        get_backend_url.return_value = 'http://nginx.instance1:8080'
+        routes = [_get_route('r1', 'router-1'), _get_route('r2', 'router-2')]
+        routes[0]['spec']['backend-endpoints'] = True
+        versions = controller.get_routes_versions(routes, _get_index())
+        scaled_versions = controller.get_routes_versions(routes, _get_index(ips=('10.0.0.1', '10.0.0.2', '10.0.0.3')))
+        self.assertNotEqual(versions['router-1'], scaled_versions['router-1'])
+        self.assertEqual(versions['router-2'], scaled_versions['router-2'])
+        # endpoints are included only for the given routers
+        versions = controller.get_routes_versions(routes, _get_index(), endpoints_router_names={'router-2'})
+        scaled_versions = controller.get_routes_versions(routes, _get_index(ips=('10.0.0.1', '10.0.0.2', '10.0.0.3')),
+                                                         endpoints_router_names={'router-2'})
+        self.assertEqual(versions['router-1'], scaled_versions['router-1'])
+
+    @patch('ckan_cloud_operator.routers.routes.manager.get_backend_url')
+    @patch('ckan_cloud_operator.routers.routes.endpoints.get_index')
+    @patch('ckan_cloud_operator.routers.routes.index.update')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_process_dirty_routers_fetches_endpoints_only_for_hot_reload_routers(self, get, routes_index_update,
+                                                                                  get_index, get_backend_url):
+        from tests.routers.test_route_endpoints import _get_index
+        get_index.return_value = _get_index()
+        get_backend_url.return_value = 'http://nginx.instance1:8080'
+        routes = [_get_route('r1', 'router-1'), _get_route('r2', 'router-2')]
+        for route in routes:
+            route['spec']['backend-endpoints'] = True
+        routers = [_get_router('router-1'), _get_router('router-2')]
+        get.side_effect = lambda what: {
+            'CkanCloudRoute': {'items': routes},
+            'CkanCloudRouter': {'items': routers},
+        }[what]
+        controller.process_dirty_routers({}, quiet_period_seconds=30, now=100)
+        get_index.assert_not_called()
+        routers[1]['spec']['hot-reload'] = True
+        controller.process_dirty_routers({}, quiet_period_seconds=30, now=100)
+        get_index.assert_called_once_with([routes[1]])
+
+    def test_get_dirty_state(self):
+        annotations = CkanRoutersAnnotations('router-1', _get_router('router-1', **{'routes-version': 'abc'}))
+        self.assertIsNone(controller.get_dirty_state(annotations, 'abc'))
+        self.assertEqual(controller.get_dirty_state(annotations, 'def'), ('def', None))
+        annotations = CkanRoutersAnnotations('router-1', _get_router('router-1', **{
+            'routes-version': 'abc', 'update-requested-at': 20, 'update-completed-at': 10
+        }))
+        self.assertEqual(controller.get_dirty_state(annotations, 'abc'), (None, 20))
+        annotations = CkanRoutersAnnotations('router-1', _get_router('router-1', **{
+            'routes-version': 'abc', 'update-requested-at': 20, 'update-completed-at': 30
+        }))
+        self.assertIsNone(controller.get_dirty_state(annotations, 'abc'))
+
+    @patch('ckan_cloud_operator.routers.routes.index.update')
+    @patch.object(CkanRoutersAnnotations, 'json_annotate')
+    @patch('ckan_cloud_operator.routers.manager.update')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_process_dirty_routers_coalesces_updates(self, get, update, json_annotate, routes_index_update):
+        routes = [_get_route('r1', 'router-1')]
+        get.side_effect = lambda what: {
+            'CkanCloudRoute': {'items': routes},
+            'CkanCloudRouter': {'items': [_get_router('router-1')]},
+        }[what]
+        dirty_routers = {}
+        controller.process_dirty_routers(dirty_routers, quiet_period_seconds=30, now=100)
+        self.assertEqual(list(dirty_routers), ['router-1'])
+        # more route changes during the quiet period restart the quiet period
+        routes.append(_get_route('r2', 'router-1'))
+        controller.process_dirty_routers(dirty_routers, quiet_period_seconds=30, now=120)
+        controller.process_dirty_routers(dirty_routers, quiet_period_seconds=30, now=140)
+        update.assert_not_called()
+        controller.process_dirty_routers(dirty_routers, quiet_period_seconds=30, now=150)
+        update.assert_called_once_with('router-1', enqueue=False)
+        self.assertEqual(dirty_routers, {})
+        # the index is written only when the routes changed
+        self.assertEqual(routes_index_update.call_count, 2)
+        routes_index_update.assert_called_with(routes)
+        # the routes version is recorded by the routers manager update
+        json_annotate.assert_called_once_with('update-completed-at', 150)
+
+    @patch('ckan_cloud_operator.routers.routes.index.update')
+    @patch.object(CkanRoutersAnnotations, 'json_annotate')
+    @patch('ckan_cloud_operator.routers.manager.update')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_process_dirty_routers_retries_failed_update(self, get, update, json_annotate, routes_index_update):
+        get.side_effect = lambda what: {
+            'CkanCloudRoute': {'items': []},
+            'CkanCloudRouter': {'items': [_get_router('router-1', **{'update-requested-at': 10})]},
+        }[what]
+        update.side_effect = Exception('update failed')
+        dirty_routers = {}
+        controller.process_dirty_routers(dirty_routers, quiet_period_seconds=30, now=100)
+        controller.process_dirty_routers(dirty_routers, quiet_period_seconds=30, now=130)
+        self.assertEqual(update.call_count, 1)
+        self.assertEqual(dirty_routers['router-1'][1], 130)
+        json_annotate.assert_not_called()
@@ -77,16 +77,34 @@ class RoutersManagerTestCase(unittest.TestCase):
         }
         self.assertEqual(manager.get_traefik_router_spec(**options), expected_spec)
 
+    @patch('ckan_cloud_operator.routers.controller.get_router_routes_version')
     @patch('ckan_cloud_operator.routers.manager._init_router')
     @patch('ckan_cloud_operator.routers.traefik.manager')
     @patch('ckan_cloud_operator.routers.manager.routes_manager.list')
-    def test_update(self, list, traefik_manager, _init_router):
-        _init_router.return_value = 'router', {'update': True}, 'traefik', {}, {}, {'manager': traefik_manager}
+    def test_update(self, list, traefik_manager, _init_router, get_router_routes_version):
+        annotations = MagicMock()
+        _init_router.return_value = 'router', {'update': True}, 'traefik', annotations, {}, {'manager': traefik_manager}
         list.return_value = 'router'
         manager.update('datapusher', wait_ready=True)
         _init_router.assert_called_once_with('datapusher')
         list.assert_called_once_with({})
-        traefik_manager.update.assert_called_once_with('datapusher', True, {'update': True}, {}, 'router', dry_run=False)
+        traefik_manager.update.assert_called_once_with('datapusher', True, {'update': True}, annotations, 'router',
+                                                       dry_run=False)
+
+    @patch('ckan_cloud_operator.routers.controller.get_router_routes_version')
+    @patch('ckan_cloud_operator.routers.manager._init_router')
+    @patch('ckan_cloud_operator.routers.traefik.manager')
+    @patch('ckan_cloud_operator.routers.manager.routes_manager.list')
+    def test_update_records_routes_version(self, list, traefik_manager, _init_router, get_router_routes_version):
+        annotations = MagicMock()
+        _init_router.return_value = 'router', {}, 'traefik', annotations, {}, {'manager': traefik_manager}
+        get_router_routes_version.return_value = 'abc'
+        manager.update('datapusher', enqueue=False)
+        get_router_routes_version.assert_called_once_with('router', list.return_value)
+        annotations.json_annotate.assert_called_once_with('routes-version', 'abc')
+        annotations.json_annotate.reset_mock()
+        manager.update('datapusher', dry_run=True)
+        annotations.json_annotate.assert_not_called()
 
     @patch('ckan_cloud_operator.kubectl.get')
     def test_list(self, get):
@@ -214,3 +232,106 @@ class RoutersManagerTestCase(unittest.TestCase):
         _init_router.return_value = 'router', {'update': True}, 'traefik', {}, {}, {'manager': traefik_manager}
         manager.delete('datapusher')
         traefik_manager.delete.assert_called_once_with('datapusher')
+
+    @patch('ckan_cloud_operator.providers.cluster.manager.get_provider_id')
+    @patch('ckan_cloud_operator.labels.manager.get_label_prefix')
+    @patch('subprocess.getstatusoutput')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_list_full_uses_snapshot(self, get, getstatusoutput, get_label_prefix, get_provider_id):
+        get_label_prefix.return_value = 'ckan-cloud'
+        get_provider_id.return_value = 'gcloud'
+        getstatusoutput.return_value = 0, 'log line'
+        router_names = ['router-1', 'router-2', 'router-3']
+
+        def _get_item(kind, name, router_name, **kwargs):
+            return {
+                'kind': kind,
+                'metadata': {'name': name, 'namespace': 'ckan-cloud', 'creationTimestamp': 'now', 'generation': 1,
+                             'annotations': {}, 'labels': {'ckan-cloud/router-name': router_name,
+                                                           'ckan-cloud/router-type': 'traefik'}},
+                'status': {},
+                **kwargs
+            }
+
+        resources = {
+            'CkanCloudRouter': [dict(_get_item('CkanCloudRouter', name, name), spec={'type': 'traefik'})
+                                for name in router_names],
+            'CkanCloudRoute': [_get_item('CkanCloudRoute', f'route-{name}', name,
+                                         spec={'type': 'backend-url-subdomain', 'root-domain': 'example.com'})
+                               for name in router_names],
+            'deployment -l ckan-cloud/router-name': [_get_item('Deployment', f'router-traefik-{name}', name)
+                                                     for name in router_names],
+            'pods -l ckan-cloud/router-name': [
+                _get_item('Pod', f'router-traefik-{name}-pod', name,
+                          spec={'containers': [{'name': 'traefik', 'image': 'traefik'}]})
+                for name in router_names
+            ],
+            'service -l ckan-cloud/router-name': [
+                _get_item('Service', f'loadbalancer-router-traefik-{name}', name,
+                          status={'loadBalancer': {'ingress': [{'ip': f'1.2.3.{i}'}]}})
+                for i, name in enumerate(router_names)
+            ],
+        }
+        get.side_effect = lambda what, *args, **kwargs: {'items': resources[what]}
+        routers = manager.list(full=True, async_print=False)
+        self.assertEqual(len(get.call_args_list), len(resources))
+        self.assertEqual([router['name'] for router in routers], router_names)
+        self.assertEqual([router['dns']['load-balancer-ip'] for router in routers], ['1.2.3.0', '1.2.3.1', '1.2.3.2'])
+        self.assertEqual([router['routes'] for router in routers],
+                         [[route['spec']] for route in resources['CkanCloudRoute']])
+        self.assertTrue(all(router['ready'] for router in routers))
+        self.assertEqual([len(router['deployment']['pods']) for router in routers], [1, 1, 1])
+        self.assertEqual(manager.list(async_print=False),
+                         [{'name': name, 'type': 'traefik', 'ready': True} for name in router_names])
+
+
+class RoutersManagerRoutesLookupTestCase(unittest.TestCase):
+
+    def _get_routes(self):
+        return {
+            'r1': {'metadata': {'name': 'r1'}, 'spec': {'ckan-instance-id': 'instance1', 'root-domain': 'default',
+                                                       'sub-domain': 'site1', 'route-target-resource-id': 'instance1'}},
+            'r2': {'metadata': {'name': 'r2'}, 'spec': {'deis-instance-id': 'instance1', 'root-domain': 'example.com',
+                                                       'sub-domain': 'site1', 'route-target-resource-id': 'instance1'}},
+            'r3': {'metadata': {'name': 'r3'}, 'spec': {'ckan-instance-id': 'instance2', 'root-domain': 'example.com',
+                                                       'sub-domain': 'site2', 'route-target-resource-id': 'instance2'}},
+        }
+
+    @patch('ckan_cloud_operator.routers.manager.routes_index.get_index')
+    @patch('ckan_cloud_operator.routers.manager.routes_index.load')
+    @patch('ckan_cloud_operator.kubectl.get_items_by_labels')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_routes_from_index(self, get, get_items_by_labels, load, get_index):
+        routes = self._get_routes()
+        index = {
+            'hostnames': {'site1.default.local': {'route': 'r1'}, 'site1.example.com': {'route': 'r2'},
+                          'site2.example.com': {'route': 'r3'}},
+            # r4 was deleted after the index snapshot was saved
+            'targets': {'instance1': ['r1', 'r2', 'r4'], 'instance2': ['r3']},
+            'routers': {},
+            'conflicts': {},
+        }
+        load.return_value = get_index.return_value = index
+        get.side_effect = lambda what, required: routes.get(what.replace('CkanCloudRoute ', ''))
+        self.assertEqual(manager.get_ckan_instance_routes('instance1'), [routes['r1']])
+        self.assertEqual(manager.get_deis_instance_routes('instance1'), [routes['r2']])
+        self.assertEqual(manager.get_backend_url_routes('instance1'), [routes['r1'], routes['r2']])
+        self.assertEqual(manager.get_app_instance_routes('instance1'), [])
+        with patch('ckan_cloud_operator.routers.manager.get_default_root_domain', return_value='default.local'):
+            self.assertEqual(manager.get_domain_routes('example.com'), [routes['r2'], routes['r3']])
+            self.assertEqual(manager.get_domain_routes('example.com', 'site2'), [routes['r3']])
+            self.assertEqual(manager.get_domain_routes('default.local', 'site1'), [routes['r1']])
+        get_items_by_labels.assert_not_called()
+
+    @patch('ckan_cloud_operator.routers.manager.routes_index.load')
+    @patch('ckan_cloud_operator.kubectl.get_items_by_labels')
+    def test_routes_without_index(self, get_items_by_labels, load):
+        load.return_value = None
+        manager.get_ckan_instance_routes('instance1')
+        get_items_by_labels.assert_called_with('CkanCloudRoute', {'ckan-cloud/route-ckan-instance-id': 'instance1'},
+                                               required=False)
+        with patch('ckan_cloud_operator.routers.manager.get_default_root_domain', return_value='default.local'):
+            manager.get_domain_routes('example.com', 'site2')
+        get_items_by_labels.assert_called_with('CkanCloudRoute', {'ckan-cloud/route-root-domain': 'example.com',
+                                                                  'ckan-cloud/route-sub-domain': 'site2'},
+                                               required=False)
@@ -0,0 +1,130 @@
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator import cloudflare
+from ckan_cloud_operator.monitoring.access_logs import checkpoints
+from ckan_cloud_operator.routers import manager
+from ckan_cloud_operator.routers import rate_limits
+
+
+def _get_row(host, start_time):
+    return {'RequestHost': host, 'DownstreamStatus': 200, 'Duration': 100000000, 'StartUTC': start_time}
+
+
+class RateLimitsTestCase(unittest.TestCase):
+
+    def test_get_peak_host_rates(self):
+        rows = [
+            *[_get_row('site1.example.com', '2019-06-01T10:00:10Z') for _ in range(60)],
+            *[_get_row('site1.example.com', '2019-06-01T10:01:10Z') for _ in range(30)],
+            *[_get_row('site1.example.com', f'2019-06-01T11:{minute:02}:10Z') for minute in range(60) for _ in range(90)],
+            *[_get_row('site1.example.com', '2019-06-01T11:59:50Z') for _ in range(30)],
+            _get_row('site2.example.com', '2019-06-01T11:30:00Z'),
+        ]
+        with tempfile.TemporaryDirectory() as state_path:
+            checkpoints.process_rows(rows, state_path)
+            # the peak minute, not the hourly average
+            self.assertEqual(rate_limits.get_peak_host_rates(state_path=state_path),
+                             {'site1.example.com': 2, 'site2.example.com': 1 / 60})
+            self.assertEqual(rate_limits.get_peak_host_rates(to_hour='2019-06-01T10', state_path=state_path),
+                             {'site1.example.com': 1})
+
+    def test_get_rules(self):
+        rules = rate_limits.get_rules({'site1.example.com': 2, 'site2.example.com': 0.01, 'other.example.org': 5},
+                                      'example.com')
+        self.assertEqual(len(rules), 2)
+        rule = rules['ckan-cloud-operator: site1.example.com/api/*']
+        self.assertEqual(rule['threshold'], 240)
+        self.assertEqual(rule['match']['request']['url'], 'site1.example.com/api/*')
+        self.assertEqual(rules['ckan-cloud-operator: site2.example.com/api/*']['threshold'],
+                         rate_limits.DEFAULT_MIN_THRESHOLD)
+
+    def test_get_diff(self):
+        rules = rate_limits.get_rules({'site1.example.com': 2, 'site2.example.com': 2}, 'example.com')
+        site1_api, site2_api = [json.loads(json.dumps(rule)) for rule in rules.values()]
+        site1_api['threshold'] = 100
+        existing_rules = [
+            dict(site1_api, id='2'),
+            dict(site2_api, id='3', description='ckan-cloud-operator: site3.example.com/api/*'),
+            {'id': '4', 'description': 'manually added rule'},
+        ]
+        diff = rate_limits.get_diff(rules, existing_rules)
+        self.assertEqual([rule['description'] for rule in diff['create']], [site2_api['description']])
+        self.assertEqual([(rule['id'], rule['threshold']) for rule in diff['update']], [('2', 240)])
+        self.assertEqual([rule['id'] for rule in diff['delete']], ['3'])
+        self.assertEqual(rate_limits.get_diff(rules, existing_rules, delete_stale=False)['delete'], [])
+
+    @patch('ckan_cloud_operator.cloudflare.get_zone_dns_records')
+    @patch('ckan_cloud_operator.cloudflare.apply_rate_limits_diff')
+    @patch('ckan_cloud_operator.cloudflare.get_zone_rate_limits')
+    @patch('ckan_cloud_operator.cloudflare.get_zone_id')
+    @patch('ckan_cloud_operator.providers.routers.manager.get_cloudflare_credentials')
+    def test_sync_cloudflare_rate_limits(self, get_cloudflare_credentials, get_zone_id, get_zone_rate_limits,
+                                         apply_rate_limits_diff, get_zone_dns_records):
+        get_zone_dns_records.return_value = [{'name': 'site1.example.com', 'proxied': True}]
+        get_cloudflare_credentials.return_value = ('admin@example.com', 'key')
+        get_zone_id.return_value = 'zone1'
+        get_zone_rate_limits.return_value = {'result': []}
+        diff = manager.sync_cloudflare_rate_limits('example.com', {'site1.example.com': 2}, mode='ban')
+        self.assertEqual(len(diff['create']), 1)
+        self.assertEqual(diff['create'][0]['action']['mode'], 'ban')
+        apply_rate_limits_diff.assert_called_once_with('admin@example.com', 'key', 'zone1', diff)
+        apply_rate_limits_diff.reset_mock()
+        manager.sync_cloudflare_rate_limits('example.com', {'site1.example.com': 2}, dry_run=True)
+        apply_rate_limits_diff.assert_not_called()
+
+    @patch('ckan_cloud_operator.cloudflare.get_zone_dns_records')
+    @patch('ckan_cloud_operator.cloudflare.apply_rate_limits_diff')
+    @patch('ckan_cloud_operator.cloudflare.get_zone_rate_limits')
+    @patch('ckan_cloud_operator.cloudflare.get_zone_id')
+    @patch('ckan_cloud_operator.providers.routers.manager.get_cloudflare_credentials')
+    def test_sync_zone_quota(self, get_cloudflare_credentials, get_zone_id, get_zone_rate_limits,
+                             apply_rate_limits_diff, get_zone_dns_records):
+        get_zone_dns_records.return_value = [{'name': f'site{i}.example.com', 'proxied': True} for i in (1, 2)]
+        get_cloudflare_credentials.return_value = ('admin@example.com', 'key')
+        get_zone_id.return_value = 'zone1'
+        get_zone_rate_limits.return_value = {'result': [
+            {'id': '1', 'description': 'manually added rule'},
+            {'id': '2', 'description': 'ckan-cloud-operator: old.example.com/api/*'},
+        ]}
+        host_rates = {'site1.example.com': 2, 'site2.example.com': 2}
+        with self.assertRaisesRegex(Exception, 'exceed the zone rules quota: 4 rules > 2'):
+            manager.sync_cloudflare_rate_limits('example.com', host_rates, max_rules=2, delete_stale=False)
+        apply_rate_limits_diff.assert_not_called()
+        manager.sync_cloudflare_rate_limits('example.com', host_rates, max_rules=3)
+        apply_rate_limits_diff.assert_called_once()
+
+    @patch('ckan_cloud_operator.cloudflare.get_zone_dns_records')
+    @patch('ckan_cloud_operator.cloudflare.apply_rate_limits_diff')
+    @patch('ckan_cloud_operator.cloudflare.get_zone_rate_limits')
+    @patch('ckan_cloud_operator.cloudflare.get_zone_id')
+    @patch('ckan_cloud_operator.providers.routers.manager.get_cloudflare_credentials')
+    def test_sync_skips_unproxied_hosts(self, get_cloudflare_credentials, get_zone_id, get_zone_rate_limits,
+                                        apply_rate_limits_diff, get_zone_dns_records):
+        get_cloudflare_credentials.return_value = ('admin@example.com', 'key')
+        get_zone_id.return_value = 'zone1'
+        get_zone_rate_limits.return_value = {'result': []}
+        get_zone_dns_records.return_value = [
+            {'name': 'site1.example.com', 'proxied': True},
+            {'name': 'site2.example.com', 'proxied': False},
+        ]
+        host_rates = {'site1.example.com': 2, 'site2.example.com': 2, 'site3.example.com': 2, 'other.example.org': 2}
+        diff = manager.sync_cloudflare_rate_limits('example.com', host_rates)
+        self.assertEqual([rule['match']['request']['url'] for rule in diff['create']], ['site1.example.com/api/*'])
+        self.assertEqual(diff['unproxied-hosts'], ['site2.example.com', 'site3.example.com'])
+        get_zone_dns_records.assert_called_once_with('admin@example.com', 'key', 'zone1')
+
+    @patch('ckan_cloud_operator.cloudflare.curl')
+    def test_get_zone_rate_limits_pages(self, curl):
+        curl.side_effect = [
+            {'success': True, 'result': [{'id': '1'}], 'result_info': {'page': 1, 'total_pages': 2}},
+            {'success': True, 'result': [{'id': '2'}], 'result_info': {'page': 2, 'total_pages': 2}},
+        ]
+        self.assertEqual(cloudflare.get_zone_rate_limits('admin@example.com', 'key', 'example.com', zone_id='zone1')
+                         ['result'], [{'id': '1'}, {'id': '2'}])
+        self.assertEqual([call[0][2] for call in curl.call_args_list], [
+            f'zones/zone1/rate_limits?page=1&per_page={cloudflare.RATE_LIMITS_PER_PAGE}',
+            f'zones/zone1/rate_limits?page=2&per_page={cloudflare.RATE_LIMITS_PER_PAGE}',
+        ])
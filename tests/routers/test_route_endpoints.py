@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.routers.routes import endpoints
+
+
+def _get_index(ips=('10.0.0.1', '10.0.0.2'), namespace='instance1', name='nginx'):
+    return {
+        'services': {
+            (namespace, name): {'spec': {'ports': [{'name': 'http', 'port': 8080}, {'name': 'other', 'port': 9000}]}}
+        },
+        'endpoints': {
+            (namespace, name): {'subsets': [{
+                'addresses': [{'ip': ip} for ip in ips],
+                'ports': [{'name': 'other', 'port': 9090}, {'name': 'http', 'port': 80}],
+            }]}
+        },
+    }
+
+
+class RouteEndpointsTestCase(unittest.TestCase):
+
+    def test_get_backend_service(self):
+        self.assertEqual(endpoints.get_backend_service('http://nginx.instance1:8080'), ('instance1', 'nginx', 8080))
+        self.assertEqual(endpoints.get_backend_service('http://nginx'), ('ckan-cloud', 'nginx', 80))
+        self.assertEqual(endpoints.get_backend_service('http://nginx.instance1.svc.cluster.local:8080'),
+                         ('instance1', 'nginx', 8080))
+        self.assertIsNone(endpoints.get_backend_service('https://www.example.com'))
+
+    def test_get_backend_servers(self):
+        self.assertEqual(endpoints.get_backend_servers('http://nginx.instance1:8080', _get_index(('10.0.0.2', '10.0.0.1'))),
+                         ['http://10.0.0.1:80', 'http://10.0.0.2:80'])
+        self.assertEqual(endpoints.get_backend_servers('http://nginx.instance2:8080', _get_index()), [])
+        self.assertEqual(endpoints.get_backend_servers('http://nginx.instance1:8080', _get_index(ips=())), [])
+
+    @patch('ckan_cloud_operator.routers.routes.manager.get_backend_url')
+    def test_get_route_backend_servers_caches_backend_url(self, get_backend_url):
+        get_backend_url.return_value = 'http://nginx.instance1:8080'
+        route = {'metadata': {'name': 'route-1', 'resourceVersion': '1'}, 'spec': {'backend-endpoints': True}}
+        for _ in range(3):
+            self.assertEqual(len(endpoints.get_route_backend_servers(route, _get_index())), 2)
+        get_backend_url.assert_called_once_with(route)
+        route['metadata']['resourceVersion'] = '2'
+        endpoints.get_route_backend_servers(route, _get_index())
+        self.assertEqual(get_backend_url.call_count, 2)
+
+    @patch('ckan_cloud_operator.kubectl.get')
+    @patch('ckan_cloud_operator.routers.routes.manager.get_backend_url')
+    def test_get_index_lists_only_the_routes_namespaces(self, get_backend_url, get):
+        get_backend_url.side_effect = lambda route: route['spec']['backend-url']
+        routes = [
+            {'metadata': {'name': f'index-route-{i}', 'resourceVersion': '1'}, 'spec': spec}
+            for i, spec in enumerate([
+                {'backend-endpoints': True, 'backend-url': 'http://nginx.instance1:8080'},
+                {'backend-endpoints': True, 'backend-url': 'http://nginx.instance1:8080'},
+                {'backend-endpoints': True, 'backend-url': 'http://solr.instance2:8983'},
+                {'backend-url': 'http://nginx.instance3:8080'},
+            ])
+        ]
+        get.side_effect = lambda what, namespace, required: {'items': [
+            {'kind': 'Service', 'metadata': {'namespace': namespace, 'name': 'nginx'}},
+            {'kind': 'Endpoints', 'metadata': {'namespace': namespace, 'name': 'nginx'}},
+        ]}
+        index = endpoints.get_index(routes)
+        self.assertEqual([c[1]['namespace'] for c in get.call_args_list], ['instance1', 'instance2'])
+        get.assert_called_with('services,endpoints', namespace='instance2', required=False)
+        self.assertEqual(sorted(index['services']), [('instance1', 'nginx'), ('instance2', 'nginx')])
+        self.assertEqual(sorted(index['endpoints']), [('instance1', 'nginx'), ('instance2', 'nginx')])
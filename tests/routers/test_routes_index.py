@@ -0,0 +1,108 @@
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.routers.routes import index
+
+
+def _get_route(name, sub_domain, target_id, router_name='instances-default', root_domain='example.com', **spec):
+    return {
+        'metadata': {'name': name},
+        'spec': {
+            'type': 'ckan-instance-subdomain',
+            'root-domain': root_domain,
+            'sub-domain': sub_domain,
+            'router_name': router_name,
+            'route-target-type': 'ckan-instance',
+            'route-target-resource-id': target_id,
+            **spec
+        }
+    }
+
+
+class RoutesIndexTestCase(unittest.TestCase):
+
+    def test_get_route_hostnames(self):
+        route = _get_route('cc1', 'www', 'site1', **{'extra-no-dns-subdomains': ['old']})
+        self.assertEqual(index.get_route_hostnames(route), ['www.example.com', 'old.example.com'])
+        route = _get_route('cc1', 'www', 'site1', root_domain='default')
+        self.assertEqual(index.get_route_hostnames(route, 'default.io'), ['www.default.io'])
+
+    @patch('ckan_cloud_operator.routers.routes.index._get_default_root_domain')
+    def test_build(self, _get_default_root_domain):
+        _get_default_root_domain.return_value = 'default.io'
+        routes = [
+            _get_route('cc2', 'www', 'site1', router_name='prod-1'),
+            _get_route('cc1', 'site1', 'site1', root_domain='default'),
+            _get_route('cc3', 'www', 'site2'),
+        ]
+        built = index.build(routes)
+        self.assertEqual(built['hostnames']['site1.default.io'], {
+            'route': 'cc1', 'router': 'instances-default', 'target-type': 'ckan-instance', 'target-id': 'site1'
+        })
+        self.assertEqual(built['hostnames']['www.example.com']['route'], 'cc2')
+        self.assertEqual(built['targets'], {'site1': ['cc1', 'cc2'], 'site2': ['cc3']})
+        self.assertEqual(built['routers'], {'instances-default': ['cc1', 'cc3'], 'prod-1': ['cc2']})
+        self.assertEqual(built['conflicts'], {'www.example.com': ['cc2', 'cc3']})
+        _get_default_root_domain.assert_called_once()
+        self.assertEqual(index.get_hostname_conflicts(routes), {'www.example.com': ['cc2', 'cc3']})
+
+    @patch('ckan_cloud_operator.kubectl.create_or_replace')
+    @patch('ckan_cloud_operator.routers.routes.index._fetch')
+    def test_update_saves_only_changes(self, fetch, create_or_replace):
+        routes = [_get_route('cc1', 'www', 'site1')]
+        fetch.return_value = (index.build(routes), '10')
+        create_or_replace.return_value = True
+        with patch('ckan_cloud_operator.labels.manager.get_label_prefix', return_value='ckan-cloud'):
+            index.update(routes)
+            create_or_replace.assert_not_called()
+            index.update(routes + [_get_route('cc2', 'api', 'site2')])
+        self.assertEqual(create_or_replace.call_count, 1)
+        configmap = create_or_replace.call_args[0][0]
+        self.assertIn('index.json.gz', configmap['binaryData'])
+        self.assertEqual(configmap['metadata']['resourceVersion'], '10')
+
+    @patch('ckan_cloud_operator.kubectl.create_or_replace')
+    @patch('ckan_cloud_operator.routers.routes.index._fetch')
+    def test_add_route_retries_on_conflict(self, fetch, create_or_replace):
+        # another process added cc2 between the first read and the write
+        fetch.side_effect = [
+            (index.build([_get_route('cc1', 'www', 'site1')]), '10'),
+            (index.build([_get_route('cc1', 'www', 'site1'), _get_route('cc2', 'api', 'site2')]), '11'),
+        ]
+        create_or_replace.side_effect = [False, True]
+        with patch('ckan_cloud_operator.labels.manager.get_label_prefix', return_value='ckan-cloud'):
+            updated = index.add_route(_get_route('cc3', 'data', 'site3'))
+        self.assertEqual(sorted(route['route'] for route in updated['hostnames'].values()), ['cc1', 'cc2', 'cc3'])
+        self.assertEqual(create_or_replace.call_args[0][0]['metadata']['resourceVersion'], '11')
+
+    @patch('ckan_cloud_operator.kubectl.create_or_replace')
+    @patch('ckan_cloud_operator.routers.routes.index._fetch')
+    def test_add_route_without_index(self, fetch, create_or_replace):
+        fetch.return_value = (None, None)
+        self.assertIsNone(index.add_route(_get_route('cc1', 'www', 'site1')))
+        create_or_replace.assert_not_called()
+
+    @patch('ckan_cloud_operator.kubectl.create_or_replace')
+    @patch('ckan_cloud_operator.routers.routes.index._fetch')
+    def test_remove_router_routes(self, fetch, create_or_replace):
+        fetch.return_value = (index.build([_get_route('cc1', 'www', 'site1'),
+                                           _get_route('cc2', 'api', 'site2', router_name='prod-1')]), '10')
+        create_or_replace.return_value = True
+        with patch('ckan_cloud_operator.labels.manager.get_label_prefix', return_value='ckan-cloud'):
+            updated = index.remove_router_routes('prod-1')
+        self.assertEqual(list(updated['hostnames']), ['www.example.com'])
+        self.assertEqual(updated['routers'], {'instances-default': ['cc1']})
+
+    def test_remove_routes(self):
+        built = index.build([
+            _get_route('cc1', 'www', 'site1'),
+            _get_route('cc2', 'www', 'site2'),
+            _get_route('cc3', 'api', 'site2', router_name='prod-1'),
+        ])
+        index._remove_routes(built, {'cc1', 'cc3'})
+        self.assertEqual(built, {
+            'hostnames': {},
+            'targets': {'site2': ['cc2']},
+            'routers': {'instances-default': ['cc2']},
+            'conflicts': {},
+        })
@@ -98,17 +98,21 @@ class RoutersManagerTestCase(unittest.TestCase):
         traefik_deployment.get.return_value = {'router-type': 'traefik'}
         self.assertEqual(manager.get('datapushers', attr='all'), {'dns': {'root-domain': 'ckan.io'}, 'deployment': {'router-type': 'traefik'}})
 
+    @patch('ckan_cloud_operator.routers.traefik.deployment._delete_stale_shards')
     @patch('ckan_cloud_operator.kubectl.get')
-    def test_update_new_deployment(self, get):
+    def test_update_new_deployment(self, get, delete_stale_shards):
         get.return_value = None
         annotations = MagicMock()
 
         manager.update('datapushers', False, {'router-type': 'traefik'}, annotations, {'root-domain': 'ckan.io'})
         get.assert_called_once_with('deployment router-traefik-datapushers', required=False)
         self.assertEqual(annotations.update_status.call_count, 1)
+        # shards of a previously sharded router are deleted
+        delete_stale_shards.assert_called_once_with('datapushers', 1)
 
+    @patch('ckan_cloud_operator.routers.traefik.deployment._delete_stale_shards')
     @patch('ckan_cloud_operator.kubectl.get')
-    def test_update_old_deployment(self, get):
+    def test_update_old_deployment(self, get, delete_stale_shards):
         get.side_effect = [
             {
                 'metadata': {
@@ -147,3 +151,17 @@ class RoutersManagerTestCase(unittest.TestCase):
             manager.update('datapushers', False, {'router-type': 'traefik'}, annotations, {'root-domain': 'ckan.io'})
         self.assertEqual(get.call_count, 2)
         self.assertEqual(annotations.update_status.call_count, 1)
+
+    @patch('ckan_cloud_operator.routers.traefik.deployment._delete_stale_shards')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._wait_config_hash')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._update')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_update_hot_reload(self, get, _update, _wait_config_hash, delete_stale_shards):
+        get.return_value = {'metadata': {'generation': 1}}
+        _update.return_value = 'abcdef'
+        annotations = MagicMock()
+        annotations.update_status.side_effect = lambda key, status, update_func, force_update: update_func()
+
+        manager.update('datapushers', False, {'type': 'traefik', 'hot-reload': True}, annotations, [])
+        _wait_config_hash.assert_called_once_with('router-traefik-datapushers', 'abcdef')
+        get.assert_called_once_with('deployment router-traefik-datapushers', required=False)
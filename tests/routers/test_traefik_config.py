@@ -0,0 +1,206 @@
+import unittest
+from unittest.mock import patch
+
+import toml
+
+from ckan_cloud_operator.routers.traefik import config
+
+
+def _get_route(sub_domain, root_domain='example.com', **spec):
+    return {
+        'metadata': {'name': f'route-{sub_domain}'},
+        'spec': {
+            'type': 'backend-url-subdomain',
+            'root-domain': root_domain,
+            'sub-domain': sub_domain,
+            'backend-url': f'http://{sub_domain}:5000',
+            **spec
+        }
+    }
+
+
+class TraefikConfigTestCase(unittest.TestCase):
+
+    def test_get_hot_reload_configs(self):
+        full_config = config.get([_get_route('www'), _get_route('api')], 'admin@example.com')
+        static_config, rules_config, config_hash = config.get_hot_reload_configs(full_config)
+        self.assertNotIn('frontends', static_config)
+        self.assertNotIn('backends', static_config)
+        self.assertEqual(static_config['file'], {'filename': config.HOT_RELOAD_RULES_PATH, 'watch': True})
+        self.assertEqual(static_config['api']['entryPoint'], 'traefik')
+        self.assertTrue(static_config['acme']['onHostRule'])
+        self.assertEqual(sorted(rules_config['frontends']), ['route-api', 'route-www'])
+        self.assertEqual(sorted(rules_config['backends']),
+                         sorted(['route-api', 'route-www', config.get_config_hash_backend_name(config_hash)]))
+        # the full config is not modified and the rules can be serialized
+        self.assertEqual(sorted(full_config['backends']), ['route-api', 'route-www'])
+        toml.dumps(rules_config)
+
+    def test_hot_reload_config_hash_changes_with_routes(self):
+        _, _, config_hash = config.get_hot_reload_configs(config.get([_get_route('www')], None))
+        _, _, same_config_hash = config.get_hot_reload_configs(config.get([_get_route('www')], None))
+        _, _, other_config_hash = config.get_hot_reload_configs(config.get([_get_route('www'), _get_route('api')], None))
+        self.assertEqual(config_hash, same_config_hash)
+        self.assertNotEqual(config_hash, other_config_hash)
+
+    def test_hot_reload_static_config_hash_does_not_change_with_routes(self):
+        from ckan_cloud_operator.routers.traefik import deployment
+        spec = {'hot-reload': True, 'wildcard-ssl-domain': 'example.com'}
+        config_data, _ = deployment._get_config_data(spec, [_get_route('www')], 'admin@example.com')
+        other_config_data, _ = deployment._get_config_data(
+            spec, [_get_route('www'), _get_route('api'), _get_route('a.b'), _get_route('www2', 'other.com')],
+            'admin@example.com'
+        )
+        self.assertNotEqual(config_data, other_config_data)
+        self.assertEqual(deployment.get_static_config_hash(config_data),
+                         deployment.get_static_config_hash(other_config_data))
+        # only the wildcard certificate is requested upfront
+        self.assertEqual(toml.loads(config_data['traefik.toml'])['acme']['domains'], [{'main': '*.example.com'}])
+
+    def test_conflicting_hostnames(self):
+        routes = [
+            _get_route('www'),
+            dict(_get_route('www'), metadata={'name': 'route-www-2'}),
+            _get_route('api', **{'extra-no-dns-subdomains': ['www']}),
+        ]
+        with self.assertRaisesRegex(Exception, 'Conflicting route hostnames'):
+            config.get(routes, None)
+        # force doesn't skip the conflicting routes, the caller has to opt in explicitly
+        with self.assertRaisesRegex(Exception, 'Conflicting route hostnames'):
+            config.get(routes, None, force=True)
+        full_config = config.get(routes, None, skip_conflicting_routes=True)
+        # the route with the lowest name keeps the hostname
+        self.assertEqual(sorted(full_config['frontends']), ['route-api'])
+
+    def test_acme_domains_small_root_domain(self):
+        domains = {'example.com': ['www', 'api', 'www']}
+        self.assertEqual(list(config.get_acme_domains(domains)), [
+            {'main': 'example.com', 'sans': ['api.example.com', 'www.example.com']}
+        ])
+
+    def test_acme_domains_wildcard(self):
+        domains = {'example.com': ['www', 'api', 'a.b'], 'other.com': ['www']}
+        self.assertEqual(list(config.get_acme_domains(domains, wildcard_ssl_domain='other.com,example.com')), [
+            {'main': '*.example.com'},
+            {'main': 'example.com', 'sans': ['a.b.example.com']},
+            {'main': '*.other.com'},
+        ])
+
+    def test_acme_domains_external_domains(self):
+        domains = {'example.com': ['www', 'api']}
+        self.assertEqual(list(config.get_acme_domains(domains, external_domains=True)), [
+            {'main': 'www.example.com'}, {'main': 'api.example.com'}
+        ])
+
+    def test_acme_domains_groups(self):
+        sub_domains = [f'site{i}' for i in range(1000)]
+        certificates = list(config.get_acme_domains({'example.com': sub_domains}, group_size=50))
+        names = [[c['main'], *c.get('sans', [])] for c in certificates]
+        self.assertTrue(all(len(certificate_names) <= 50 for certificate_names in names))
+        self.assertEqual(sorted(n for certificate_names in names for n in certificate_names),
+                         sorted(f'{s}.example.com' for s in sub_domains))
+        # adding a hostname changes only a single certificate
+        added_certificates = list(config.get_acme_domains({'example.com': sub_domains + ['new']}, group_size=50))
+        changed = [c for c in added_certificates if c not in certificates]
+        self.assertEqual(len(changed), 1)
+        self.assertLessEqual(len(added_certificates) - len(certificates), 1)
+
+    def test_acme_domains_invalid_group_size(self):
+        with self.assertRaisesRegex(AssertionError, 'invalid acme group size'):
+            list(config.get_acme_domains({'example.com': ['www']}, group_size=101))
+
+    def test_fast_serializer(self):
+        from ckan_cloud_operator.routers.traefik import benchmark, serializer
+        routes, backend_urls = benchmark.get_routes(50)
+        traefik_config = config.get(routes, 'admin@example.com', enable_access_log=True, backend_urls=backend_urls)
+        self.assertEqual(traefik_config['backends']['cc-benchmark-1']['servers']['server1']['url'],
+                         'http://nginx.instance1:8080')
+        traefik_config['frontends']['cc-benchmark-0']['routes']['route1']['rule'] = 'Host:"quoted\\\\".example.com'
+        data = serializer.dumps(traefik_config, 'fast')
+        self.assertEqual(toml.loads(data), toml.loads(toml.dumps(traefik_config)))
+        self.assertEqual(toml.loads(data), traefik_config)
+        with self.assertRaisesRegex(AssertionError, 'invalid config serializer'):
+            serializer.dumps(traefik_config, 'json')
+
+    def test_benchmark(self):
+        from ckan_cloud_operator.routers.traefik import benchmark
+        result = benchmark.run(100)
+        self.assertEqual(result['routes'], 100)
+        self.assertAlmostEqual(result['toml']['size-bytes'], result['fast']['size-bytes'],
+                               delta=result['toml']['size-bytes'] * 0.01)
+        self.assertLess(result['fast']['configmap-limit-percent'], 100)
+
+    @patch('ckan_cloud_operator.routers.routes.endpoints.get_index')
+    def test_endpoints_backends(self, get_index):
+        from tests.routers.test_route_endpoints import _get_index
+        get_index.return_value = _get_index()
+        routes = [
+            _get_route('www', **{'backend-url': 'http://nginx.instance1:8080', 'backend-endpoints': True,
+                                 'health-check-path': '/api/3/action/status_show', 'sticky-sessions': True}),
+            _get_route('api', **{'backend-url': 'http://nginx.instance2:8080', 'backend-endpoints': True}),
+            _get_route('old'),
+        ]
+        backends = config.get(routes, 'admin@example.com', resolve_endpoints=True)['backends']
+        get_index.assert_called_once_with(routes)
+        self.assertEqual(backends['route-www'], {
+            'servers': {
+                'server1': {'url': 'http://10.0.0.1:80', 'weight': 1},
+                'server2': {'url': 'http://10.0.0.2:80', 'weight': 1},
+            },
+            'healthCheck': {'path': '/api/3/action/status_show', 'interval': config.ENDPOINTS_HEALTH_CHECK_INTERVAL},
+            'loadBalancer': {'method': 'wrr', 'stickiness': {}},
+        })
+        # no ready endpoints - falls back to the service url
+        self.assertEqual(backends['route-api'], {'servers': {'server1': {'url': 'http://nginx.instance2:8080'}}})
+        self.assertEqual(backends['route-old'], {'servers': {'server1': {'url': 'http://old:5000'}}})
+
+    @patch('ckan_cloud_operator.routers.routes.endpoints.get_index')
+    def test_endpoints_backends_without_resolve_endpoints(self, get_index):
+        routes = [_get_route('www', **{'backend-url': 'http://nginx.instance1:8080', 'backend-endpoints': True})]
+        backends = config.get(routes, 'admin@example.com')['backends']
+        get_index.assert_not_called()
+        self.assertEqual(backends['route-www'], {'servers': {'server1': {'url': 'http://nginx.instance1:8080'}}})
+
+    @patch('ckan_cloud_operator.routers.routes.endpoints.get_index')
+    def test_endpoints_index_is_not_fetched_without_endpoints_routes(self, get_index):
+        config.get([_get_route('www')], 'admin@example.com', resolve_endpoints=True)
+        get_index.assert_not_called()
+
+    def test_static_assets_max_age(self):
+        routes = [
+            _get_route('www', **{'static-assets-max-age': 60, 'extra-no-dns-subdomains': ['www2']}),
+            _get_route('api', **{'static-assets-max-age': 60, 'static-assets-paths': ['/static/']}),
+            _get_route('private', **{'static-assets-max-age': 60, 'httpauth-secret': 'private-auth'}),
+            _get_route('old'),
+        ]
+        frontends = config.get(routes, 'admin@example.com')['frontends']
+        self.assertEqual(sorted(frontends), ['route-api', 'route-api-static-private', 'route-api-static-public',
+                                             'route-old', 'route-private', 'route-www', 'route-www-static-private',
+                                             'route-www-static-public'])
+        self.assertEqual(frontends['route-www-static-public']['routes']['route1']['rule'],
+                         'Host:www.example.com,www2.example.com;PathPrefix:/webassets/,/base/,/fanstatic/')
+        public, private = frontends['route-api-static-public'], frontends['route-api-static-private']
+        self.assertEqual(public['routes'], {'route1': {'rule': 'Host:api.example.com;PathPrefix:/static/'}})
+        self.assertEqual(public['backend'], 'route-api')
+        self.assertEqual(public['priority'], config.STATIC_ASSETS_FRONTEND_PRIORITY)
+        self.assertEqual(public['headers']['customResponseHeaders'],
+                         {'Cache-Control': 'public, max-age=60, s-maxage=60'})
+        self.assertEqual(private['routes'], {
+            'route1': {'rule': 'Host:api.example.com;PathPrefix:/static/;HeadersRegexp:Cookie,.+'},
+            'route2': {'rule': 'Host:api.example.com;PathPrefix:/static/;HeadersRegexp:Authorization,.+'},
+        })
+        self.assertGreater(private['priority'], public['priority'])
+        self.assertNotIn('customResponseHeaders', private['headers'])
+        self.assertNotIn('customResponseHeaders', frontends['route-api']['headers'])
+        self.assertEqual(frontends['route-old'], {
+            'backend': 'route-old',
+            'passHostHeader': True,
+            'headers': {'SSLRedirect': True},
+            'routes': {'route1': {'rule': 'Host:old.example.com'}},
+        })
+
+    def test_compress(self):
+        self.assertNotIn('compress', config.get([_get_route('www')], 'admin@example.com')['entryPoints']['http'])
+        entry_points = config.get([_get_route('www')], 'admin@example.com', compress=True)['entryPoints']
+        self.assertEqual(sorted(entry_points), ['http', 'https'])
+        self.assertTrue(all(entry_point['compress'] for entry_point in entry_points.values()))
@@ -0,0 +1,93 @@
+import unittest
+from unittest.mock import patch
+
+from ckan_cloud_operator.routers.traefik import deployment, shards
+
+
+def _get_route(sub_domain, root_domain='example.com'):
+    return {
+        'metadata': {'name': f'route-{sub_domain}'},
+        'spec': {
+            'type': 'backend-url-subdomain',
+            'root-domain': root_domain,
+            'sub-domain': sub_domain,
+            'backend-url': f'http://{sub_domain}:5000',
+        }
+    }
+
+
+class TraefikShardsTestCase(unittest.TestCase):
+
+    def test_get_num_shards(self):
+        self.assertEqual(shards.get_num_shards({}), 1)
+        self.assertEqual(shards.get_num_shards(None), 1)
+        self.assertEqual(shards.get_num_shards({'shards': '4'}), 4)
+        with self.assertRaisesRegex(AssertionError, 'invalid number of router shards'):
+            shards.get_num_shards({'shards': -1})
+
+    def test_get_shard_index_is_stable(self):
+        for num_shards in (1, 3, 8):
+            for i in range(50):
+                hostname = f'site{i}.example.com'
+                shard_index = shards.get_shard_index(hostname, num_shards)
+                self.assertTrue(0 <= shard_index < num_shards)
+                self.assertEqual(shard_index, shards.get_shard_index(hostname, num_shards))
+
+    def test_adding_a_shard_moves_few_hostnames(self):
+        hostnames = [f'site{i}.example.com' for i in range(2000)]
+        moved = [
+            hostname for hostname in hostnames
+            if shards.get_shard_index(hostname, 4) != shards.get_shard_index(hostname, 5)
+        ]
+        # ideally 1/5 of the hostnames move, all of them to the new shard
+        self.assertLess(len(moved), len(hostnames) * 0.3)
+        self.assertTrue(all(shards.get_shard_index(hostname, 5) == 4 for hostname in moved))
+
+    def test_group_routes(self):
+        routes = [_get_route(f'site{i}') for i in range(100)]
+        grouped = shards.group_routes(routes, 4)
+        self.assertEqual(sorted(grouped.keys()), [0, 1, 2, 3])
+        self.assertEqual(sum(len(shard_routes) for shard_routes in grouped.values()), 100)
+        self.assertTrue(all(len(shard_routes) > 0 for shard_routes in grouped.values()))
+        self.assertEqual(shards.group_routes([], 2), {0: [], 1: []})
+
+
+class TraefikShardsDeploymentTestCase(unittest.TestCase):
+
+    @patch('ckan_cloud_operator.routers.traefik.deployment._delete_stale_shards')
+    @patch('ckan_cloud_operator.routers.traefik.deployment.get_labels')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._apply_deployment')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._update_dns_records')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._apply_load_balancer')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._run_pre_deployment_hooks')
+    @patch('ckan_cloud_operator.routers.traefik.deployment._get_config_data')
+    @patch('ckan_cloud_operator.routers.traefik.deployment.get_cloudflare_credentials')
+    @patch('ckan_cloud_operator.kubectl.apply')
+    @patch('ckan_cloud_operator.kubectl.get')
+    def test_update_shards_repairs_dns_of_unchanged_shards(self, get, apply, get_cloudflare_credentials,
+                                                          get_config_data, run_pre_deployment_hooks,
+                                                          apply_load_balancer, update_dns_records,
+                                                          apply_deployment, get_labels, delete_stale_shards):
+        get_cloudflare_credentials.return_value = 'admin@example.com', 'auth-key'
+        get_config_data.side_effect = lambda spec, routes, cloudflare_email: (
+            {'traefik.toml': str(len(routes))}, None
+        )
+        routes = [_get_route(f'site{i}') for i in range(20)]
+        grouped = shards.group_routes(routes, 2)
+        # shard 0 is unchanged, shard 1 has a new route
+        get.side_effect = lambda what, required=True, **kwargs: {
+            'configmap router-traefik-router1-shard-0': {'data': {'traefik.toml': str(len(grouped[0]))}},
+            'configmap router-traefik-router1-shard-1': {'data': {'traefik.toml': '0'}},
+        }.get(what, {'metadata': {'generation': 3}})
+        run_pre_deployment_hooks.side_effect = lambda router_name, router_type, shard_routes: (
+            {'example.com': [route['spec']['sub-domain'] for route in shard_routes]}, []
+        )
+        apply_load_balancer.return_value = '1.2.3.4'
+        updated = deployment._update_shards('router1', {'type': 'traefik', 'shards': 2}, None, routes, 2)
+        self.assertEqual(list(updated.keys()), ['router-traefik-router1-shard-1'])
+        self.assertEqual(update_dns_records.call_count, 2)
+        self.assertEqual(sorted(call[0][0]['example.com'][0] for call in update_dns_records.call_args_list),
+                         sorted(grouped[i][0]['spec']['sub-domain'] for i in (0, 1)))
+        apply_deployment.assert_called_once()
+        self.assertEqual(apply_deployment.call_args[1]['shard_index'], 1)
+        self.assertEqual(apply.call_count, 1)